@@ -0,0 +1,158 @@
+# benchmarks/bench_parse.py
+"""
+保存済み出馬表 HTML（benchmarks/fixtures/shutuba*.html）を使い、
+1レースあたりのパース時間を比較する。ネットワーク・BigQuery は不要。
+
+  before : 行ごとに query_selector / inner_text を呼ぶ従来方式（Playwright）
+  after  : page.eval_on_selector_all による1往復抽出（Playwright）
+  static : page.content() 相当の HTML を BeautifulSoup で1回パース（ブラウザ不要）
+
+使い方: python -m benchmarks.bench_parse [--repeat 20]
+Chromium が無い環境では static のみ計測する。
+"""
+
+import re
+import sys
+import glob
+import time
+import argparse
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+import scripts.netkeiba as nk
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures"
+
+
+# --- 従来方式（計測比較用にそのまま保持） ---
+def legacy_fetch_horses(page) -> list[dict]:
+    rows = page.query_selector_all("table.Shutuba_Table tbody tr.HorseList")
+    horses = []
+    for r in rows:
+        name_el = r.query_selector("td.HorseInfo .HorseName a")
+        if not name_el:
+            continue
+        waku_el = r.query_selector("td[class^='Waku'] span")
+        waku_txt = waku_el.inner_text().strip() if waku_el else ""
+        num_el = r.query_selector("td[class^='Umaban']")
+        num_txt = num_el.inner_text().strip() if num_el else ""
+        name = r.query_selector("td.HorseInfo .HorseName a").inner_text().strip()
+        sex_age = r.query_selector("td.Barei").inner_text().strip()
+        wt_el = r.query_selector("td.Weight")
+        wt_txt = wt_el.inner_text().strip() if wt_el else ""
+        m_wt = re.search(r"(\d+)", wt_txt)
+        jockey = r.query_selector("td.Jockey a").inner_text().strip()
+        trainer = r.query_selector("td.Trainer a").inner_text().strip()
+        odds_td = r.query_selector("td.Txt_R.Popular")
+        odds_span = odds_td.query_selector("span") if odds_td else None
+        odds_txt = odds_span.inner_text().strip() if odds_span else ""
+        horses.append({
+            "waku":     int(waku_txt) if waku_txt.isdigit() else None,
+            "number":   int(num_txt)   if num_txt.isdigit()   else None,
+            "name":     name,
+            "sex_age":  sex_age,
+            "weight":   int(m_wt.group(1)) if m_wt else None,
+            "jockey":   jockey,
+            "trainer":  trainer,
+            "expect_odds": float(odds_txt) if re.match(r"^\d+(\.\d+)?$", odds_txt) else None,
+        })
+    return horses
+
+
+def legacy_odds_rows(page) -> list[dict]:
+    odds_list = []
+    for row in page.query_selector_all("table.Shutuba_Table tbody tr.HorseList"):
+        number_el = row.query_selector("td[class^='Umaban']")
+        number_txt = number_el.inner_text().strip() if number_el else ""
+        odds_td = row.query_selector("td.Txt_R.Popular")
+        odds_span = odds_td.query_selector("span") if odds_td else None
+        odds_txt = odds_span.inner_text().strip() if odds_span else ""
+        entry = nk.odds_entry(number_txt, odds_txt)
+        if entry is not None:
+            odds_list.append(entry)
+    return odds_list
+
+
+# --- 新方式 ---
+def evaluate_horses(page) -> list[dict]:
+    return nk.horses_from_rows(page.eval_on_selector_all(nk.HORSE_ROW_SELECTOR, nk.HORSE_ROWS_JS))
+
+
+def evaluate_odds_rows(page) -> list[dict]:
+    return nk.odds_list_from_rows(page.eval_on_selector_all(nk.HORSE_ROW_SELECTOR, nk.ODDS_ROWS_JS))
+
+
+def static_parse(html: str):
+    soup = BeautifulSoup(html, nk.HTML_PARSER)
+    return nk.parse_horses(soup), nk.parse_odds_rows(soup)
+
+
+def _strip_ts(odds_list):
+    return [(o["number"], o["odds"]) for o in odds_list]
+
+
+def _time_ms(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def bench_fixture(path: str, repeat: int, page=None) -> dict:
+    html = Path(path).read_text(encoding="utf-8")
+    result = {"fixture": Path(path).name}
+    result["static_ms"] = _time_ms(lambda: static_parse(html), repeat)
+
+    if page is not None:
+        page.set_content(html)
+        before = (legacy_fetch_horses(page), _strip_ts(legacy_odds_rows(page)))
+        after = (evaluate_horses(page), _strip_ts(evaluate_odds_rows(page)))
+        static_h, static_o = static_parse(html)
+        # 出力が従来と完全一致することを確認してから計測する
+        assert before == after, "evaluate 方式の出力が従来方式と一致しません"
+        assert before == (static_h, _strip_ts(static_o)), "静的パースの出力が従来方式と一致しません"
+        result["before_ms"] = _time_ms(lambda: (legacy_fetch_horses(page), legacy_odds_rows(page)), repeat)
+        result["after_ms"] = _time_ms(lambda: (evaluate_horses(page), evaluate_odds_rows(page)), repeat)
+    return result
+
+
+def _open_page():
+    try:
+        from playwright.sync_api import sync_playwright, Error as PlaywrightError
+        pw = sync_playwright().start()
+        try:
+            browser = pw.chromium.launch(headless=True)
+        except PlaywrightError as e:
+            pw.stop()
+            print(f"[WARN] Chromium を起動できないため Playwright の計測を省略: {e}".splitlines()[0],
+                  file=sys.stderr)
+            return None, None
+        return pw, browser
+    except ImportError:
+        return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    fixtures = sorted(glob.glob(str(FIXTURE_DIR / "shutuba*.html")))
+    pw, browser = _open_page()
+    page = browser.new_page() if browser else None
+    try:
+        for path in fixtures:
+            r = bench_fixture(path, args.repeat, page)
+            line = f"[BENCH] {r['fixture']}: static {r['static_ms']:7.2f} ms"
+            if "before_ms" in r:
+                line += f" | before {r['before_ms']:7.2f} ms | after {r['after_ms']:7.2f} ms"
+            print(line)
+    finally:
+        if browser:
+            browser.close()
+            pw.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+# benchmarks/bench_suite.py
+"""
+ホットパスの回帰を見るためのオフライン計測スイート。ネットワーク・BigQuery は不要。
+保存済みの netkeiba HTML（benchmarks/fixtures/）をローカルの HTTP サーバーから配信して計測する。
+
+  parse_shutuba    : 出馬表の取得（ローカル HTTP）＋ 馬柱・オッズ行のパース
+  fetch_horses     : Playwright の fetch_horses / オッズ行の一括抽出（Chromium がある場合のみ）
+  race_list        : レース一覧の取得＋パースと、開催タイトルからの race_id 生成（fixture の race_id と照合）
+  build_plan       : 3場×12レースの合成開催日のスナップショット計画（fixed モード）
+  sampler_day      : 同じ開催日を適応サンプラーで10秒刻みに1日分回す
+  fluct_cube       : calc_fluctuation の日単位バッチ（合成スナップショット）
+  fluct_incremental: IncrementalFluctuation の逐次更新（同じ合成スナップショット）
+
+結果は JSON で出力する（--out でファイル、--compare で以前の JSON との比）。
+
+使い方: python -m benchmarks.bench_suite [--repeat 20] [--out bench.json] [--compare base.json]
+"""
+
+import os
+import sys
+import json
+import asyncio
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from functools import partial
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pandas as pd
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures"
+JST = timezone(timedelta(hours=9))
+
+# 状態ファイルを書くモジュールは import 前に一時ディレクトリへ向ける
+_STATE = tempfile.mkdtemp(prefix="bench_suite_")
+os.environ.setdefault("SAMPLER_STATE_DIR", _STATE)
+os.environ.setdefault("FLUCT_STATE_PATH", os.path.join(_STATE, "fluctuation_state.json"))
+
+import scripts.netkeiba as nk                                   # noqa: E402
+import scripts.sampler as sampler                               # noqa: E402
+from scripts.scheduler import build_plan                        # noqa: E402
+from scripts.upsert_entries import race_specs_from_titles       # noqa: E402
+from scripts.calc_fluctuation import (                          # noqa: E402
+    LABEL_ORDER, IncrementalFluctuation, build_odds_cube, fluctuation_from_cube,
+)
+
+
+# --- 計測 ---
+def _measure(fn, repeat: int, warmup: int = 1) -> dict:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        "repeat": repeat,
+        "mean_ms": round(sum(times) / len(times), 4),
+        "p50_ms": round(times[len(times) // 2], 4),
+        "p95_ms": round(times[min(int(0.95 * len(times)), len(times) - 1)], 4),
+        "min_ms": round(times[0], 4),
+    }
+
+
+# --- fixture 配信 ---
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve_fixtures():
+    """fixtures/ を 127.0.0.1 の空きポートで配信する。(server, base_url) を返す。"""
+    handler = partial(_QuietHandler, directory=str(FIXTURE_DIR))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# --- 合成データ ---
+VENUES = [("東京", "05", 0), ("京都", "08", 5), ("函館", "02", 10)]   # (場名, コード, 発走のずれ[分])
+
+
+def synth_day(date_str: str = "2025-06-01") -> list[tuple[str, datetime]]:
+    """3場×12レース。各場 9:50 から30分おき、場ごとに5分ずつずらす。"""
+    base = datetime.fromisoformat(f"{date_str}T09:50:00").replace(tzinfo=JST)
+    return [
+        (f"{date_str[:4]}{code}0212{no:02d}", base + timedelta(minutes=30 * (no - 1) + shift))
+        for _, code, shift in VENUES for no in range(1, 13)
+    ]
+
+
+def synth_snapshots(races, horses: int = 16, seed: int = 1) -> pd.DataFrame:
+    """(race_id, horse_no, label, odds_avg) の縦持ち。2% の欠損を入れる。"""
+    rnd = random.Random(seed)
+    rows = []
+    for rid, _ in races:
+        for hn in range(1, horses + 1):
+            odds = rnd.uniform(1.5, 150)
+            for label in LABEL_ORDER:
+                odds = max(1.0, odds * rnd.uniform(0.85, 1.15))
+                if rnd.random() >= 0.02:
+                    rows.append({"race_id": rid, "horse_no": hn, "label": label,
+                                 "odds_avg": round(odds, 1)})
+    return pd.DataFrame(rows)
+
+
+# --- 各ベンチマーク ---
+def bench_parse_shutuba(base_url: str, repeat: int) -> dict:
+    url = f"{base_url}/shutuba.html"
+
+    def run():
+        soup = nk.fetch_soup(url)
+        return nk.parse_horses(soup), nk.parse_odds_rows(soup)
+    horses, odds = run()
+    assert horses and odds, "shutuba fixture のパース結果が空です"
+    return {**_measure(run, repeat), "items": len(horses)}
+
+
+def bench_fetch_horses(base_url: str, repeat: int):
+    """Chromium が無い環境では None（計測を省略）。"""
+    from playwright.async_api import async_playwright, Error as PlaywrightError
+    from scripts.upsert_entries import fetch_horses
+
+    loop = asyncio.new_event_loop()
+    pw = loop.run_until_complete(async_playwright().start())
+    try:
+        try:
+            browser = loop.run_until_complete(pw.chromium.launch(headless=True))
+        except PlaywrightError as e:
+            print(f"[WARN] Chromium を起動できないため Playwright の計測を省略: {e}".splitlines()[0],
+                  file=sys.stderr)
+            return None
+        page = loop.run_until_complete(browser.new_page())
+        loop.run_until_complete(page.goto(f"{base_url}/shutuba.html"))
+
+        async def _once():
+            rows = await page.eval_on_selector_all(nk.HORSE_ROW_SELECTOR, nk.ODDS_ROWS_JS)
+            return await fetch_horses(page), nk.odds_list_from_rows(rows)
+        run = lambda: loop.run_until_complete(_once())   # noqa: E731
+        try:
+            return {**_measure(run, repeat), "items": len(run()[0])}
+        finally:
+            loop.run_until_complete(browser.close())
+    finally:
+        loop.run_until_complete(pw.stop())
+        loop.close()
+
+
+def bench_race_list(base_url: str, repeat: int) -> dict:
+    url = f"{base_url}/race_list_sub.html"
+
+    def run():
+        soup = nk.fetch_soup(url)
+        titles = [el.get_text(strip=True) for el in soup.select(".RaceList_DataTitle")]
+        return nk.parse_race_list(soup), race_specs_from_titles("20250601", titles)
+    listed, specs = run()
+    # 開催タイトルから組み立てた race_id が、一覧に載っている race_id と一致すること
+    generated = [nk.RACE_ID_RE.search(s["url"]).group(1) for s in specs]
+    assert generated == [r["race_id"] for r in listed], "race_id の生成結果が一覧と一致しません"
+    return {**_measure(run, repeat), "items": len(specs)}
+
+
+def bench_build_plan(races, repeat: int) -> dict:
+    plan = build_plan(races)
+    return {**_measure(lambda: build_plan(races), repeat), "items": len(plan),
+            "snapshots": sum(len(b["items"]) for b in plan)}
+
+
+def bench_sampler_day(races, repeat: int) -> dict:
+    first = min(st for _, st in races) - timedelta(hours=2)
+    last = max(st for _, st in races) + timedelta(minutes=15)
+    ticks = int((last - first).total_seconds() // 10)
+    requests = 0
+
+    def run():
+        nonlocal requests
+        s = sampler.AdaptiveSampler(races, f"bench-{time.perf_counter_ns()}")
+        requests = 0
+        for i in range(ticks):
+            now = first + timedelta(seconds=10 * i)
+            for rid, label, _ in s.due(now):
+                s.mark(rid, label, now)
+                requests += 1
+        os.remove(s.path)
+    return {**_measure(run, max(1, repeat // 10), warmup=0), "items": ticks, "requests": requests}
+
+
+def bench_fluct_cube(df: pd.DataFrame, repeat: int) -> dict:
+    def run():
+        race_ids, horse_nos, cube = build_odds_cube(df)
+        return fluctuation_from_cube(race_ids, horse_nos, cube)
+    return {**_measure(run, repeat), "items": len(run())}
+
+
+def bench_fluct_incremental(df: pd.DataFrame, repeat: int) -> dict:
+    groups = [(rid, label, dict(zip(g["horse_no"], g["odds_avg"])))
+              for (label_i, rid, label), g in df.assign(
+                  label_i=df["label"].map(LABEL_ORDER.index)).groupby(["label_i", "race_id", "label"])]
+    rows = 0
+
+    def run():
+        nonlocal rows
+        inc = IncrementalFluctuation(os.path.join(_STATE, f"inc-{time.perf_counter_ns()}.json"))
+        rows = sum(len(inc.update(rid, label, odds)) for rid, label, odds in groups)
+        os.remove(inc.path)
+    return {**_measure(run, repeat), "items": len(groups), "rows": rows}
+
+
+# --- 出力 ---
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, baseline: dict):
+    """p50 の比（current / baseline）を表示する。1 より大きければ遅くなっている。"""
+    print(f"[BENCH] {baseline.get('commit')} → {current.get('commit')} (p50 比)", file=sys.stderr)
+    for name, r in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not r or not base:
+            continue
+        ratio = r["p50_ms"] / base["p50_ms"] if base["p50_ms"] else float("nan")
+        flag = "  <-- 遅化" if ratio > 1.2 else ""
+        print(f"[BENCH]   {name:<18} {base['p50_ms']:9.3f} → {r['p50_ms']:9.3f} ms  x{ratio:5.2f}{flag}",
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--out", help="結果 JSON の書き出し先（省略時は標準出力）")
+    parser.add_argument("--compare", help="比較する以前の結果 JSON")
+    parser.add_argument("--only", nargs="*", help="実行するベンチマーク名")
+    args = parser.parse_args()
+
+    server, base_url = serve_fixtures()
+    races = synth_day()
+    snapshots = synth_snapshots(races)
+    benches = {
+        "parse_shutuba":     lambda: bench_parse_shutuba(base_url, args.repeat),
+        "fetch_horses":      lambda: bench_fetch_horses(base_url, args.repeat),
+        "race_list":         lambda: bench_race_list(base_url, args.repeat),
+        "build_plan":        lambda: bench_build_plan(races, args.repeat),
+        "sampler_day":       lambda: bench_sampler_day(races, args.repeat),
+        "fluct_cube":        lambda: bench_fluct_cube(snapshots, args.repeat),
+        "fluct_incremental": lambda: bench_fluct_incremental(snapshots, args.repeat),
+    }
+    results = {}
+    try:
+        for name, fn in benches.items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = fn()
+            r = results[name]
+            print(f"[BENCH] {name:<18} " + (f"p50 {r['p50_ms']:9.3f} ms  p95 {r['p95_ms']:9.3f} ms"
+                                             if r else "省略"), file=sys.stderr)
+    finally:
+        server.shutdown()
+
+    out = {
+        "commit": _commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(out, ensure_ascii=False, indent=1)
+    if args.out:
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    if args.compare:
+        compare(out, json.loads(Path(args.compare).read_text(encoding="utf-8")))
+
+
+if __name__ == "__main__":
+    main()
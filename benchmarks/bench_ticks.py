@@ -0,0 +1,94 @@
+# benchmarks/bench_ticks.py
+"""
+高頻度取得を想定した合成データで、オッズの保存形式ごとの行数とサイズを比較する。
+ネットワーク・BigQuery は不要。
+
+  snapshot : odds_snapshot の行（1頭1行）
+  record   : jra_odds.odds の行（odds_list に1頭ずつ timestamp を持つ従来形式）
+  ticks    : scripts/odds_ticks.py の差分ティック（1スナップショット1行・変化した馬のみ）
+
+ティックから to_odds_records / odds_at で復元した値が元データと一致することも確認する。
+
+使い方: python -m benchmarks.bench_ticks [--races 36] [--samples 60] [--change 0.15]
+"""
+
+import json
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from scripts.odds_ticks import TickEncoder, to_odds_records, odds_at
+
+JST = timezone(timedelta(hours=9))
+
+
+def synth_records(races: int, samples: int, change: float, seed: int = 1) -> list[dict]:
+    """各サンプルで change の割合の馬だけオッズが動く、レース×サンプルのレコード列。"""
+    rnd = random.Random(seed)
+    base = datetime(2025, 6, 1, 10, 0, tzinfo=JST)
+    out = []
+    for r in range(races):
+        n_horses = rnd.randint(10, 18)
+        odds = {n: round(rnd.uniform(1.5, 150), 1) for n in range(1, n_horses + 1)}
+        for s in range(samples):
+            for n in odds:
+                if rnd.random() < change:
+                    odds[n] = max(1.0, round(odds[n] * rnd.uniform(0.9, 1.1), 1))
+            ts = (base + timedelta(minutes=30 * r, seconds=45 * s)).astimezone(timezone.utc)
+            out.append({
+                "race_id": f"2025050{r:05d}",
+                "minutes_before_race": samples - s,
+                "odds_list": [{"number": n, "odds": v, "timestamp": ts.isoformat()}
+                              for n, v in sorted(odds.items())],
+            })
+    return out
+
+
+def snapshot_rows(records: list[dict]) -> list[dict]:
+    return [
+        {"race_id": rec["race_id"], "horse_no": o["number"], "snapshot_at": o["timestamp"],
+         "odds_jra": None, "odds_netkeiba": o["odds"], "odds_avg": o["odds"], "label": "interim"}
+        for rec in records for o in rec["odds_list"]
+    ]
+
+
+def _size(rows: list[dict]) -> int:
+    return sum(len(json.dumps(r, ensure_ascii=False)) + 1 for r in rows)   # NDJSON のバイト数
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--races", type=int, default=36)
+    parser.add_argument("--samples", type=int, default=60)
+    parser.add_argument("--change", type=float, default=0.15, help="1サンプルで動く馬の割合")
+    args = parser.parse_args()
+
+    records = synth_records(args.races, args.samples, args.change)
+    encoder = TickEncoder()
+    ticks = [t for t in (encoder.encode(rec) for rec in records) if t is not None]
+
+    # 復元確認（差分の無いスナップショットはティックにならないので、値が変わった時点で比較）
+    restored = {(r["race_id"], r["odds_list"][0]["timestamp"]): r for r in to_odds_records(ticks)}
+    for rec in records:
+        key = (rec["race_id"], rec["odds_list"][0]["timestamp"])
+        if key in restored:
+            assert restored[key]["odds_list"] == rec["odds_list"], key
+        at = datetime.fromisoformat(rec["odds_list"][0]["timestamp"])
+        race_ticks = [t for t in ticks if t["race_id"] == rec["race_id"]]
+        assert odds_at(race_ticks, at) == {o["number"]: o["odds"] for o in rec["odds_list"]}, key
+
+    rows = {
+        "snapshot": snapshot_rows(records),
+        "record": records,
+        "ticks": ticks,
+    }
+    base_size = _size(rows["snapshot"])
+    print(f"{args.races} races x {args.samples} samples, change={args.change:.0%}")
+    for name, r in rows.items():
+        size = _size(r)
+        print(f"  {name:<9} rows={len(r):>7}  bytes={size:>10,}  ({size / base_size:6.1%} of snapshot)")
+    print("  round trip: OK")
+
+
+if __name__ == "__main__":
+    main()
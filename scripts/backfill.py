@@ -0,0 +1,269 @@
+# scripts/backfill.py
+
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import date, datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import requests
+from google.api_core.exceptions import GoogleAPIError
+from google.cloud import bigquery
+
+import scripts.netkeiba as nk
+from scripts.ratelimit import SharedRateLimiter, retry_with_backoff
+from scripts.odds_spool import get_spool
+import scripts.schema as schema
+from scripts.collect_results import to_result_rows
+
+# --- 設定 ---
+BACKFILL_PROCESSES = int(os.getenv("BACKFILL_PROCESSES", "4"))    # 日付を振り分けるプロセス数
+BACKFILL_RPS       = float(os.getenv("BACKFILL_RPS", "1.0"))      # 全プロセス合計の毎秒リクエスト上限
+BACKFILL_RETRIES   = int(os.getenv("BACKFILL_RETRIES", "3"))      # ページごとの最大試行回数
+STATE_DIR          = os.getenv("BACKFILL_STATE_DIR", "data/state")
+FLUSH_EVERY_DATES  = 10   # この日数ごとにスプールを BigQuery へ流す
+
+# --- ワーカープロセス側 ---
+_limiter = None
+
+
+def _init_worker(limiter: SharedRateLimiter):
+    """各プロセスで1回だけ呼ばれる。HTTP セッションはプロセスごとに作り直す。"""
+    global _limiter
+    _limiter = limiter
+    nk.SESSION = nk._build_session()
+
+
+def _get_soup(url: str, retries: int):
+    def _attempt():
+        _limiter.wait()
+        return nk.fetch_soup(url)
+    return retry_with_backoff(_attempt, attempts=retries, label=url,
+                              retry_on=(requests.RequestException,))
+
+
+def fetch_result(spec: dict, date_str: str, retries: int = BACKFILL_RETRIES) -> dict:
+    """
+    結果ページ1枚から race（出走馬付き）・最終オッズ（post_race ラベル）・着順の行を作る。
+    結果表が無い（中止・未確定）レースは None。
+    """
+    url = nk.RESULT_URL.format(race_id=spec["race_id"])
+    soup = _get_soup(url, retries)
+    info = nk.parse_race_info(soup)
+    results = nk.parse_results(soup)
+    if info is None or not results:
+        return None
+
+    start = datetime.strptime(f"{date_str} {info['start_time'] or '00:00'}", "%Y-%m-%d %H:%M")
+    race = {
+        "race_id":    spec["race_id"],
+        "race_date":  date_str,
+        "venue":      spec["venue"],
+        **info,
+        "start_time": start.isoformat(),
+        "detail_url": url,
+        "horses": [
+            {k: h[k] for k in ("waku", "number", "name", "sex_age", "weight",
+                               "jockey", "trainer", "expect_odds")}
+            for h in results
+        ],
+    }
+    # 確定オッズは JRA 発表値なので odds_jra に入れ、post_race ラベルとして扱う
+    snapshot_at = (start + timedelta(minutes=10)).isoformat()
+    odds_rows = [
+        {"race_id": spec["race_id"], "horse_no": h["number"], "snapshot_at": snapshot_at,
+         "odds_jra": h["final_odds"], "odds_netkeiba": None, "odds_avg": h["final_odds"],
+         "label": "post_race"}
+        for h in results if h["number"] is not None and h["final_odds"] is not None
+    ]
+    result_rows = to_result_rows(spec["race_id"], date_str, results)
+    return {"race": race, "odds": odds_rows, "results": result_rows}
+
+
+def backfill_date(date_str: str, retries: int = BACKFILL_RETRIES, race_ids: list[str] = None) -> dict:
+    """
+    1開催日分（レース一覧＋各レースの結果ページ）を取得する。ワーカープロセスで実行される。
+    race_ids を渡すとそのレースだけを取り直す（前回失敗したレースの再取得）。
+    """
+    started = time.perf_counter()
+    soup = _get_soup(nk.RACE_LIST_SUB_URL.format(kaisai_date=date_str.replace("-", "")), retries)
+    specs = nk.parse_race_list(soup)
+    if race_ids is not None:
+        wanted = set(race_ids)
+        specs = [spec for spec in specs if spec["race_id"] in wanted]
+    out = {"date": date_str, "races": [], "odds": [], "results": [], "failed": []}
+    for spec in specs:
+        try:
+            rec = fetch_result(spec, date_str, retries)
+        except Exception as e:
+            print(f"[ERROR] {spec['race_id']} の取得失敗: {e}", file=sys.stderr)
+            rec = None
+        if rec is None:
+            out["failed"].append(spec["race_id"])
+            continue
+        out["races"].append(rec["race"])
+        out["odds"].extend(rec["odds"])
+        out["results"].extend(rec["results"])
+    out["elapsed"] = time.perf_counter() - started
+    return out
+
+
+# --- 親プロセス側 ---
+class BackfillState:
+    """
+    完了した日付と失敗を JSON に記録するチェックポイント。
+    日付は全レースをスプールに書き終えた時点で done にするので、途中で落ちても再実行すれば続きから取得する。
+    失敗したレースがある日付は done にせず failed に race_id を残し、次回はそのレースだけを取り直す
+    （日付ごと失敗した場合は文字列のエラーが入り、次回は1日分を取り直す）。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done, self.failed = {}, {}
+        self.partial = {}   # 失敗を残した日付で取得済みのレース数
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            self.done = state.get("done", {})
+            self.failed = state.get("failed", {})
+            self.partial = state.get("partial", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"done": self.done, "failed": self.failed, "partial": self.partial},
+                      f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+    def todo(self, dates: list[str]) -> list[tuple[str, list]]:
+        """未完了の (日付, 取り直す race_id のリスト or None=1日分) を返す。"""
+        out = []
+        for d in dates:
+            if d in self.done:
+                continue
+            retry = self.failed.get(d)
+            out.append((d, retry if isinstance(retry, list) and retry else None))
+        return out
+
+    def record(self, date_str: str, out: dict):
+        """backfill_date の結果を反映する。失敗したレースが残っていれば done にしない。"""
+        got = self.partial.pop(date_str, 0) + len(out["races"])
+        if out["failed"]:
+            self.failed[date_str] = out["failed"]
+            self.partial[date_str] = got
+        else:
+            self.failed.pop(date_str, None)
+            self.done[date_str] = got
+
+    def record_error(self, date_str: str, error: Exception):
+        """日付ごと失敗した（レース一覧が取れないなど）。前回の失敗レースの記録があればそちらを残す。"""
+        if not isinstance(self.failed.get(date_str), list):
+            self.failed[date_str] = str(error)
+
+
+def dates_from_range(start: str, end: str) -> list[str]:
+    d0, d1 = date.fromisoformat(start), date.fromisoformat(end)
+    return [(d0 + timedelta(days=i)).isoformat() for i in range((d1 - d0).days + 1)]
+
+
+def dates_from_ics(path: str, start: str = None, end: str = None) -> list[str]:
+    """カレンダー（ICS）の開催日だけを対象にする。start / end で絞り込める。"""
+    from scripts.upsert_calendar import fetch_calendar_from_ics
+    days = sorted({ev["race_date"].isoformat() for ev in fetch_calendar_from_ics(path)})
+    return [d for d in days if (not start or d >= start) and (not end or d <= end)]
+
+
+def run_backfill(dates: list[str], state_path: str, processes: int = BACKFILL_PROCESSES,
+                 rps: float = BACKFILL_RPS, retries: int = BACKFILL_RETRIES):
+    """
+    dates をプロセスプールに1日ずつ振り分けて取得し、結果をスプール経由で BigQuery に登録する。
+    リクエスト数は全プロセス合計で rps 回/秒以下。完了した日付は state_path に記録し、次回は飛ばす。
+    """
+    state = BackfillState(state_path)
+    todo = state.todo(dates)
+    retries_only = sum(1 for _, ids in todo if ids)
+    print(f"[INFO] バックフィル対象 {len(todo)} 日（うち失敗レースの取り直し {retries_only} 日、"
+          f"完了済み {len(dates) - len(todo)} 日をスキップ） processes={processes}, rps={rps}")
+    if not todo:
+        return
+
+    client = bigquery.Client()
+    schema.require(client)
+    tables = {key: schema.table_id(name, client.project) for key, name in
+              (("races", "race"), ("odds", "odds_snapshot"), ("results", "race_results"))}
+    spool = get_spool()
+    limiter = SharedRateLimiter(rps)
+
+    started = time.perf_counter()
+    total_races = 0
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(limiter,)) as ex:
+        futures = {ex.submit(backfill_date, d, retries, ids): d for d, ids in todo}
+        for n, fut in enumerate(as_completed(futures), 1):
+            d = futures[fut]
+            try:
+                out = fut.result()
+            except Exception as e:
+                print(f"[ERROR] {d} の取得失敗: {e}", file=sys.stderr)
+                state.record_error(d, e)
+                state.save()
+                continue
+
+            for key, table_id in tables.items():
+                if out[key]:
+                    spool.append(table_id, out[key])
+            state.record(d, out)
+            state.save()
+
+            total_races += len(out["races"])
+            minutes = (time.perf_counter() - started) / 60
+            print(f"[INFO] {d}: {len(out['races'])} レース ({out['elapsed']:.1f}s) "
+                  f"[{n}/{len(todo)} 日, 累計 {total_races} レース, "
+                  f"{total_races / minutes if minutes else 0:.1f} レース/分]")
+
+            if n % FLUSH_EVERY_DATES == 0:
+                _flush(spool, client)
+    _flush(spool, client)
+
+    minutes = (time.perf_counter() - started) / 60
+    print(f"[INFO] バックフィル完了: {total_races} レース / {minutes:.1f} 分 "
+          f"({total_races / minutes if minutes else 0:.1f} レース/分)")
+    if state.failed:
+        print(f"[WARN] 失敗を含む日付 {len(state.failed)} 件（{state_path} の failed を参照、"
+              f"再実行すると失敗したレースだけを取り直す）", file=sys.stderr)
+
+
+def _flush(spool, client):
+    try:
+        spool.flush(client)
+    except GoogleAPIError as e:
+        # 行はスプールに残るので、次回の flush（python -m scripts.odds_spool flush）で登録される
+        print(f"[WARN] BigQuery登録を保留（スプールに保持）: {e}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="過去開催のレース・確定オッズ・着順を一括取得する")
+    parser.add_argument("--start", help="YYYY-MM-DD")
+    parser.add_argument("--end", help="YYYY-MM-DD")
+    parser.add_argument("--ics", help="開催日をカレンダー（ICS）から取る")
+    parser.add_argument("--processes", type=int, default=BACKFILL_PROCESSES)
+    parser.add_argument("--rps", type=float, default=BACKFILL_RPS)
+    parser.add_argument("--retries", type=int, default=BACKFILL_RETRIES)
+    parser.add_argument("--state", help="チェックポイントファイル（既定: data/state/backfill_<範囲>.json）")
+    args = parser.parse_args()
+
+    if args.ics:
+        dates = dates_from_ics(args.ics, args.start, args.end)
+    elif args.start and args.end:
+        dates = dates_from_range(args.start, args.end)
+    else:
+        parser.error("--start と --end、または --ics を指定してください")
+    if not dates:
+        print("[WARN] 対象日がありません", file=sys.stderr)
+        sys.exit(1)
+
+    state_path = args.state or os.path.join(STATE_DIR, f"backfill_{dates[0]}_{dates[-1]}.json")
+    run_backfill(dates, state_path, args.processes, args.rps, args.retries)
@@ -0,0 +1,134 @@
+# scripts/bq_merge.py
+
+import uuid
+import argparse
+from datetime import date, datetime, timedelta, timezone
+
+from google.cloud import bigquery
+
+import scripts.metrics as metrics
+import scripts.schema as schema
+
+# --- 設定 ---
+STAGING_PREFIX  = "_stage_"   # 一時テーブル名の接頭辞（jra_odds 内に作り、MERGE 後に消す）
+STAGING_EXPIRES = 3600        # 消し損ねた一時テーブルの自動削除までの秒数
+
+
+def dedupe(rows: list[dict], keys: list[str]) -> list[dict]:
+    """自然キーが同じ行は後勝ちで1行にする（MERGE は1つの対象行に複数のソース行が当たるとエラーになる）。"""
+    latest = {}
+    for r in rows:
+        latest[tuple(r.get(k) for k in keys)] = r
+    return list(latest.values())
+
+
+def _partition_range(name: str, rows: list[dict]):
+    """
+    行が属するパーティション列の範囲 [lo, hi)（日単位）を返す。MERGE の ON に入れて対象テーブルの
+    スキャンをそのパーティションだけにする。列が無い・値が欠けている行があれば None（全体を見る）。
+    パーティション列が自然キーに含まれないテーブルも None。キーが同じでもパーティションの値は
+    変わりうる（延期で race_date が変わった race、取り直しで snapshot_at が変わった odds_snapshot）ので、
+    範囲で絞ると別パーティションの既存行と一致せず二重に INSERT してしまう。
+    """
+    col, _ = schema.TABLES[name]["partition"]
+    if col not in schema.TABLES[name].get("keys", []):
+        return None
+    values = [r.get(col) for r in rows]
+    if not values or any(v is None for v in values):
+        return None
+    days = [date.fromisoformat(str(v)[:10]) for v in values]
+    field_type = next(f.field_type for f in schema.TABLES[name]["fields"] if f.name == col)
+    lo, hi = min(days), max(days) + timedelta(days=1)
+    if field_type == "DATE":
+        return col, field_type, lo, hi
+    # DATETIME / TIMESTAMP は日付の 0 時で区切る（odds_snapshot は日本時間の壁時計、odds_ticks は UTC）
+    lo, hi = datetime.combine(lo, datetime.min.time()), datetime.combine(hi, datetime.min.time())
+    if field_type == "TIMESTAMP":
+        lo, hi = lo.replace(tzinfo=timezone.utc), hi.replace(tzinfo=timezone.utc)
+    return col, field_type, lo, hi
+
+
+def merge_sql(name: str, target: str, staging: str, prune: bool = True) -> str:
+    """staging の行を自然キーで target に MERGE する文。キー以外の列は値が変わった行だけ更新する。"""
+    spec = schema.TABLES[name]
+    keys = spec["keys"]
+    cols = [f.name for f in spec["fields"]]
+    values = [c for c in cols if c not in keys]
+    on = " AND ".join(f"T.{k} = S.{k}" for k in keys)
+    if prune:
+        on += f" AND T.{spec['partition'][0]} >= @lo AND T.{spec['partition'][0]} < @hi"
+    sql = f"MERGE `{target}` T\nUSING `{staging}` S\nON {on}\n"
+    if values:
+        # 再実行で同じ値を入れ直した行は「更新」に数えない
+        changed = (f"TO_JSON_STRING(STRUCT({', '.join(f'T.{c}' for c in values)})) != "
+                   f"TO_JSON_STRING(STRUCT({', '.join(f'S.{c}' for c in values)}))")
+        sql += (f"WHEN MATCHED AND {changed} THEN\n"
+                f"  UPDATE SET {', '.join(f'{c} = S.{c}' for c in values)}\n")
+    sql += (f"WHEN NOT MATCHED THEN\n"
+            f"  INSERT ({', '.join(cols)}) VALUES ({', '.join(f'S.{c}' for c in cols)})")
+    return sql
+
+
+def merge_rows(client: bigquery.Client, name: str, rows: list[dict]) -> dict:
+    """
+    rows を jra_odds.<name> に自然キー（schema.TABLES の keys）で upsert する。
+    一時テーブルへロードジョブで入れてから MERGE するので、ストリーミングバッファを使わず、
+    同じ行を何度流しても重複しない。戻り値は {"inserted", "updated", "unchanged"} の行数。
+    """
+    spec = schema.TABLES[name]
+    rows = dedupe(rows, spec["keys"])
+    if not rows:
+        return {"inserted": 0, "updated": 0, "unchanged": 0}
+
+    target = schema.table_id(name, client.project)
+    staging = bigquery.Table(
+        schema.table_id(f"{STAGING_PREFIX}{name}_{uuid.uuid4().hex[:12]}", client.project),
+        schema=spec["fields"])
+    staging.expires = datetime.now(timezone.utc) + timedelta(seconds=STAGING_EXPIRES)
+    prune = _partition_range(name, rows)
+    params = [] if prune is None else [
+        bigquery.ScalarQueryParameter("lo", prune[1], prune[2]),
+        bigquery.ScalarQueryParameter("hi", prune[1], prune[3]),
+    ]
+
+    with metrics.span("bq.merge", table=name, rows=len(rows)):
+        client.create_table(staging)
+        try:
+            client.load_table_from_json(
+                rows, staging,
+                job_config=bigquery.LoadJobConfig(
+                    schema=spec["fields"],
+                    source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+                    write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE),
+            ).result()
+            job = client.query(
+                merge_sql(name, target, str(staging.reference), prune is not None),
+                job_config=bigquery.QueryJobConfig(query_parameters=params))
+            job.result()
+        finally:
+            client.delete_table(staging, not_found_ok=True)
+
+    stats = job.dml_stats
+    inserted = stats.inserted_row_count if stats else 0
+    updated = stats.updated_row_count if stats else 0
+    metrics.inc("rows_written", inserted + updated, stage="bq.merge")
+    return {"inserted": inserted, "updated": updated, "unchanged": len(rows) - inserted - updated}
+
+
+def describe(name: str, result: dict) -> str:
+    return (f"{name}: 追加 {result['inserted']} / 更新 {result['updated']} / "
+            f"変更なし {result['unchanged']} 行")
+
+
+def keyed(table_id: str) -> str:
+    """テーブル ID が自然キーを持つ jra_odds のテーブルならその名前、そうでなければ None。"""
+    name = table_id.rsplit(".", 1)[-1]
+    return name if schema.TABLES.get(name, {}).get("keys") else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="自然キーで upsert する MERGE 文を表示する")
+    parser.add_argument("table", choices=[n for n, s in schema.TABLES.items() if s.get("keys")])
+    args = parser.parse_args()
+    print(merge_sql(args.table, schema.table_id(args.table, "<project>"),
+                    schema.table_id(f"{STAGING_PREFIX}{args.table}_<id>", "<project>")))
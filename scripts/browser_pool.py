@@ -0,0 +1,245 @@
+# scripts/browser_pool.py
+
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import atexit
+import threading
+from contextlib import asynccontextmanager
+
+from playwright.async_api import async_playwright, Error as PlaywrightError
+
+import scripts.metrics as metrics
+import scripts.navigation as nav
+from scripts.netkeiba import USER_AGENTS
+
+# --- 共通設定 ---
+VIEWPORT = {"width": 1200, "height": 800}
+
+# ブラウザを作り直すまでに貸し出すコンテキスト数
+MAX_USES_PER_BROWSER = 50
+# 同時に開くページ（コンテキスト）の上限。超えた分は空くまで待つ
+MAX_PAGES = int(os.getenv("BROWSER_MAX_PAGES", "4"))
+
+
+class BrowserPool:
+    """
+    常駐する headless Chromium を1つ保持し、呼び出しごとに
+    独立したコンテキスト（Cookie・キャッシュ分離）とページを貸し出す。
+
+    ・Chromium は最初にページが要求されたときに起動する（HTTP だけで済む間は起動しない）
+    ・MAX_USES_PER_BROWSER 回貸し出したらブラウザを再起動（使用中のページが閉じてから古い方を閉じる）
+    ・ブラウザがクラッシュ／切断されていたら次回貸し出し時に再起動
+    Playwright（async API）は専用スレッドのイベントループだけで動かす。ページを使う処理は
+    async def fn(page, *args) として、どのスレッドからでも run()（結果を待つ）/ submit()
+    （concurrent.futures.Future を返す）で渡せる。同時に開くページは max_pages まで。
+    """
+
+    def __init__(self, max_uses: int = MAX_USES_PER_BROWSER, headless: bool = True,
+                 max_pages: int = MAX_PAGES):
+        self.max_uses = max_uses
+        self.headless = headless
+        self._pw = None
+        self._browser = None
+        self._uses = 0
+        self._open = {}   # ブラウザ → 開いているページ数（再起動で外したブラウザの後始末用）
+        self._lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(max_pages)
+        self.stats = {"launches": 0, "launch_ms": [], "acquire_ms": []}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="browser-pool", daemon=True)
+        self._thread.start()
+
+    # --- ブラウザ管理（専用スレッドのループ内で呼ぶ） ---
+    async def _launch(self):
+        start = time.perf_counter()
+        if self._pw is None:
+            self._pw = await async_playwright().start()
+        self._browser = await self._pw.chromium.launch(headless=self.headless)
+        self._open[self._browser] = 0
+        self._uses = 0
+        self.stats["launches"] += 1
+        self.stats["launch_ms"].append((time.perf_counter() - start) * 1000)
+        metrics.observe("browser.launch", self.stats["launch_ms"][-1] / 1000)
+        print(f"[INFO] Chromium 起動 ({self.stats['launch_ms'][-1]:.0f} ms)")
+
+    async def _close_browser(self, browser):
+        self._open.pop(browser, None)
+        try:
+            await browser.close()
+        except PlaywrightError:
+            pass
+
+    async def _recycle(self, reason: str):
+        logging.info(f"[INFO] Chromium 再起動: {reason}")
+        browser, self._browser = self._browser, None
+        if browser is not None and not self._open.get(browser):
+            await self._close_browser(browser)
+
+    async def _ensure_browser(self):
+        async with self._lock:
+            if self._browser is not None and not self._browser.is_connected():
+                await self._recycle("ブラウザ切断を検知")
+            if self._browser is not None and self._uses >= self.max_uses:
+                await self._recycle(f"{self._uses} 回使用")
+            if self._browser is None:
+                await self._launch()
+            self._uses += 1
+            self._open[self._browser] += 1
+            return self._browser
+
+    @asynccontextmanager
+    async def page(self):
+        """
+        独立したコンテキストのページを貸し出し、終了時にコンテキストごと破棄する。
+        コンテキストには画像・フォント・外部ホストなどを止めるルートを設定する（navigation 参照）。
+        専用スレッドのループ内でだけ使える（他のスレッドからは run() / submit()）。
+        """
+        async with self._slots:
+            start = time.perf_counter()
+            browser = await self._ensure_browser()
+            context = None
+            try:
+                context = await browser.new_context(
+                    user_agent=random.choice(USER_AGENTS),
+                    viewport=VIEWPORT,
+                )
+                await nav.prepare_context_async(context)
+                page = await context.new_page()
+                self.stats["acquire_ms"].append((time.perf_counter() - start) * 1000)
+                metrics.observe("browser.page", self.stats["acquire_ms"][-1] / 1000)
+                yield page
+            except PlaywrightError:
+                # クラッシュ由来なら次回貸し出し時に作り直す
+                if not browser.is_connected():
+                    async with self._lock:
+                        if self._browser is browser:
+                            await self._recycle("ページ操作中に切断")
+                raise
+            finally:
+                if context is not None:
+                    try:
+                        await context.close()
+                    except PlaywrightError:
+                        pass
+                if browser in self._open:
+                    self._open[browser] -= 1
+                    if browser is not self._browser and not self._open[browser]:
+                        await self._close_browser(browser)
+
+    async def _with_page(self, fn, args):
+        async with self.page() as page:
+            return await fn(page, *args)
+
+    def submit(self, fn, *args):
+        """fn(page, *args) を専用スレッドで貸し出したページに対して実行する。concurrent.futures.Future を返す。"""
+        return asyncio.run_coroutine_threadsafe(self._with_page(fn, args), self._loop)
+
+    def run(self, fn, *args, timeout: float = None):
+        """submit() して結果を待つ。timeout 秒を超えたらページを閉じて TimeoutError。"""
+        fut = self.submit(fn, *args)
+        try:
+            return fut.result(timeout)
+        except TimeoutError:
+            fut.cancel()
+            raise
+
+    async def _shutdown(self):
+        for browser in list(self._open):
+            await self._close_browser(browser)
+        self._browser = None
+        if self._pw is not None:
+            await self._pw.stop()
+            self._pw = None
+
+    def close(self):
+        """ブラウザと専用スレッドを止める（どのスレッドから呼んでもよい）。"""
+        if not self._thread.is_alive():
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+# --- プロセス内で共有するプール ---
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> BrowserPool:
+    """プロセスで1つの BrowserPool を返す（初回のみ生成。Chromium は最初の貸し出しで起動）。"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool()
+        return _pool
+
+
+@atexit.register
+def close_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        try:
+            pool.close()
+        except Exception as e:
+            logging.warning(f"[WARNING] ブラウザ終了失敗: {e}")
+
+
+# --- 起動コスト計測 ---
+def bench(url: str, iterations: int):
+    """
+    毎回起動する従来方式とプール方式で、
+    ページ取得〜goto 完了までのレイテンシ(ms)を比較する。
+    """
+    async def _cold():
+        async with async_playwright() as p:
+            browser = await p.chromium.launch(headless=True)
+            page = await browser.new_page(
+                user_agent=random.choice(USER_AGENTS),
+                viewport=VIEWPORT
+            )
+            await page.goto(url)
+            await browser.close()
+
+    async def _goto(page):
+        await page.goto(url)
+
+    cold = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        asyncio.run(_cold())
+        cold.append((time.perf_counter() - start) * 1000)
+
+    pool = BrowserPool()
+    warm = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        pool.run(_goto)
+        warm.append((time.perf_counter() - start) * 1000)
+    pool.close()
+
+    def _avg(xs):
+        return sum(xs) / len(xs) if xs else 0.0
+
+    print(f"[BENCH] url={url} iterations={iterations}")
+    print(f"[BENCH] 毎回起動       : avg {_avg(cold):8.1f} ms")
+    print(f"[BENCH] プール初回     : {warm[0]:8.1f} ms (起動 {pool.stats['launch_ms'][0]:.1f} ms を含む)")
+    print(f"[BENCH] プール定常状態 : avg {_avg(warm[1:]):8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", type=int, default=10, help="計測回数")
+    parser.add_argument("--url", default="about:blank")
+    args = parser.parse_args()
+    if args.bench < 2:
+        print("--bench は 2 以上を指定してください", file=sys.stderr)
+        sys.exit(1)
+    bench(args.url, args.bench)
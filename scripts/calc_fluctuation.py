@@ -1,15 +1,46 @@
+import os
+import json
+import time
 import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+import numpy as np
 import pandas as pd
 from google.cloud import bigquery
 
+import scripts.bq_merge as bq_merge
+import scripts.metrics as metrics
+import scripts.mirror as mirror
+import scripts.schema as schema
+
+# スナップショットの時系列順ラベルと、変動を出す隣接ペア
+LABEL_ORDER = ["1h_before", "30m_before", "5m_before", "post_race"]
+LABEL_PAIRS = list(zip(LABEL_ORDER[:-1], LABEL_ORDER[1:]))
+# 日単位バッチで追加する集約指標の from_label / to_label
+FIRST_TO_LAST = ("first", "last")   # 最初に取れたラベル → 最後に取れたラベル
+MAX_SWING     = ("min", "max")      # ラベル間の最小オッズ → 最大オッズ
+
+STATE_PATH = os.getenv("FLUCT_STATE_PATH", "data/state/fluctuation_state.json")
+JST = timezone(timedelta(hours=9))
+
 def calc_fluctuation(race_id: str):
     client = bigquery.Client()
-    sql = f"""
-      SELECT horse_no, label, odds_avg
-      FROM `{client.project}.jra_odds.odds_snapshot`
-      WHERE race_id = '{race_id}'
-    """
-    df = client.query(sql).to_dataframe()
+    if mirror.use_mirror():
+        df = mirror.query(
+            "SELECT horse_no, label, odds_avg, dt AS race_date FROM odds_snapshot WHERE race_id = ?",
+            [race_id])
+    else:
+        sql = f"""
+          SELECT horse_no, label, odds_avg, DATE(snapshot_at) AS race_date
+          FROM `{schema.table_id("odds_snapshot", client.project)}`
+          WHERE race_id = '{race_id}'
+        """
+        with metrics.span("bq.query", table="odds_snapshot", race_id=race_id):
+            df = client.query(sql).to_dataframe()
+    if df.empty:
+        print(f"No snapshots for {race_id}.")
+        return
+    race_date = pd.Timestamp(df["race_date"].min()).date().isoformat()
     pivot = df.pivot(index="horse_no", columns="label", values="odds_avg")
     out = []
     for hn, row in pivot.iterrows():
@@ -19,21 +50,241 @@ def calc_fluctuation(race_id: str):
                 rate = diff / row[frm] * 100
                 out.append({
                     "race_id": race_id,
-                    "horse_no": hn,
+                    "race_date": race_date,
+                    "horse_no": int(hn),
                     "from_label": frm,
                     "to_label": to,
                     "fluctuation_value": diff,
                     "fluctuation_rate": rate
                 })
     if out:
-        errors = client.insert_rows_json(f"{client.project}.jra_odds.odds_fluctuation", out)
-        if errors:
-            print("Fluctuation insert errors:", errors)
-        else:
-            print(f"Inserted {len(out)} fluctuation rows for {race_id}.")
+        result = bq_merge.merge_rows(client, "odds_fluctuation", out)
+        print(f"Upserted fluctuation rows for {race_id}: {bq_merge.describe('odds_fluctuation', result)}")
+
+# --- 日単位バッチ（races × horses × labels のキューブでベクトル計算） ---
+def build_odds_cube(df: pd.DataFrame):
+    """
+    (race_id, horse_no, label, odds_avg) の縦持ち DataFrame を
+    races × horses × labels の密な配列に詰める。欠損は NaN。
+    同じ (race_id, horse_no, label) が複数あれば後勝ち。
+    """
+    df = df[df["label"].isin(LABEL_ORDER)].drop_duplicates(
+        ["race_id", "horse_no", "label"], keep="last")
+    race_idx, race_ids = pd.factorize(df["race_id"], sort=True)
+    horse_idx, horse_nos = pd.factorize(df["horse_no"], sort=True)
+    label_idx = pd.Categorical(df["label"], categories=LABEL_ORDER).codes
+
+    cube = np.full((len(race_ids), len(horse_nos), len(LABEL_ORDER)), np.nan)
+    cube[race_idx, horse_idx, label_idx] = df["odds_avg"].to_numpy(dtype=float)
+    return np.asarray(race_ids), np.asarray(horse_nos), cube
+
+
+def _pair_frame(race_ids, horse_nos, frm_vals, to_vals, diff, labels) -> pd.DataFrame:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = diff / frm_vals * 100
+    r, h = np.nonzero(np.isfinite(diff) & np.isfinite(rate))
+    return pd.DataFrame({
+        "race_id": race_ids[r],
+        "horse_no": horse_nos[h].astype(int),
+        "from_label": labels[0],
+        "to_label": labels[1],
+        "fluctuation_value": diff[r, h],
+        "fluctuation_rate": rate[r, h],
+    })
+
+
+def fluctuation_from_cube(race_ids, horse_nos, cube) -> pd.DataFrame:
+    """
+    キューブから odds_fluctuation 行を一括計算する（Python ループは指標の種類数だけ）。
+    ・隣接ラベルペアごとの変動値・変動率
+    ・最初→最後に取れたラベル間の変動（from_label='first', to_label='last'）
+    ・ラベル間の最大振れ幅 max-min と min 比の率（from_label='min', to_label='max'）
+    """
+    frames = []
+    pos = {label: i for i, label in enumerate(LABEL_ORDER)}
+    for frm, to in LABEL_PAIRS:
+        a, b = cube[:, :, pos[frm]], cube[:, :, pos[to]]
+        frames.append(_pair_frame(race_ids, horse_nos, a, b, b - a, (frm, to)))
+
+    valid = ~np.isnan(cube)
+    n_valid = valid.sum(axis=2)
+    n_labels = cube.shape[2]
+    first_i = np.argmax(valid, axis=2)
+    last_i = n_labels - 1 - np.argmax(valid[:, :, ::-1], axis=2)
+    first = np.take_along_axis(cube, first_i[..., None], axis=2)[..., 0]
+    last = np.take_along_axis(cube, last_i[..., None], axis=2)[..., 0]
+    enough = n_valid >= 2
+    frames.append(_pair_frame(race_ids, horse_nos, first,
+                              last, np.where(enough, last - first, np.nan), FIRST_TO_LAST))
+
+    with np.errstate(invalid="ignore"):
+        lo = np.where(enough, np.nanmin(np.where(valid, cube, np.inf), axis=2), np.nan)
+        hi = np.where(enough, np.nanmax(np.where(valid, cube, -np.inf), axis=2), np.nan)
+    frames.append(_pair_frame(race_ids, horse_nos, lo, hi, hi - lo, MAX_SWING))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def calc_fluctuation_date(date_str: str):
+    """
+    date_str（YYYY-MM-DD）の全レースのスナップショットを1クエリで読み込み、
+    変動を一括計算して odds_fluctuation に1回のロードジョブで登録する。
+    """
+    labels = ", ".join(f"'{label}'" for label in LABEL_ORDER)
+    if mirror.use_mirror():
+        # ローカルミラーの当日パーティションから読む（BigQuery への問い合わせなし）
+        df = mirror.query(f"""
+          SELECT race_id, horse_no, label, odds_avg
+          FROM odds_snapshot
+          WHERE dt = CAST(? AS DATE) AND label IN ({labels})
+        """, [date_str])
+    else:
+        client = bigquery.Client()
+        sql = f"""
+          SELECT race_id, horse_no, label, odds_avg
+          FROM `{schema.table_id("odds_snapshot", client.project)}`
+          WHERE DATE(snapshot_at) = '{date_str}' AND label IN ({labels})
+        """
+        with metrics.span("bq.query", table="odds_snapshot", date=date_str):
+            df = client.query(sql).to_dataframe()
+    if df.empty:
+        print(f"No snapshots for {date_str}.")
+        return
+
+    started = time.perf_counter()
+    with metrics.span("fluct.compute", date=date_str):
+        race_ids, horse_nos, cube = build_odds_cube(df)
+        out = fluctuation_from_cube(race_ids, horse_nos, cube)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(f"Computed {len(out)} fluctuation rows for {len(race_ids)} races "
+          f"in {elapsed_ms:.1f} ms.")
+
+    if out.empty:
+        return
+    out["race_date"] = date_str
+    client = bigquery.Client()
+    result = bq_merge.merge_rows(client, "odds_fluctuation", out.to_dict(orient="records"))
+    print(f"Upserted fluctuation rows for {date_str}: {bq_merge.describe('odds_fluctuation', result)}")
+
+# --- スナップショット到着ごとの増分計算 ---
+SAVE_SECONDS = int(os.getenv("FLUCT_SAVE_SECONDS", "30"))   # 状態ファイルの書き出し間隔（秒）
+
+
+def _fluct_row(race_id, race_date, hn, frm, to, base, odds) -> dict:
+    diff = odds - base
+    return {
+        "race_id": race_id,
+        "race_date": race_date,
+        "horse_no": int(hn),
+        "from_label": frm,
+        "to_label": to,
+        "fluctuation_value": diff,
+        "fluctuation_rate": diff / base * 100
+    }
+
+
+def _stored_labels(v) -> dict:
+    """状態ファイルの馬ごとの値を {ラベル: オッズ} にする（旧形式 [ラベル, オッズ] / {"first", "last"} も読む）。"""
+    if isinstance(v, list):
+        return {v[0]: v[1]}
+    if "first" in v and isinstance(v["first"], list):
+        return {v["first"][0]: v["first"][1], v["last"][0]: v["last"][1]}
+    return v
+
+
+class IncrementalFluctuation:
+    """
+    レース・馬ごとに取得済みラベルのオッズ（最大 len(LABEL_ORDER) 個）だけを保持し、
+    新しいスナップショットが届くたびに、そのラベルが関わる odds_fluctuation 行を返す。
+    ・LABEL_ORDER で隣り合うラベルのペア（途中のラベルが欠けたペアは出さない）
+    ・最初→最後（from_label='first', to_label='last'）と最大振れ幅（'min' → 'max'）
+    どれも日単位バッチ（fluctuation_from_cube）と同じ定義で、集約行は届くたびに作り直して
+    odds_fluctuation の MERGE で前回分を上書きする。1回の update は O(頭数) で、
+    過去のスナップショットを読み直さない。
+
+    状態は日付単位で STATE_PATH（JSON）に保存し、プロセス再起動後も続きから計算する。
+    書き出しは新しい馬を記録したときと、前回から save_seconds 秒以上経ったときだけにし、
+    残りは flush() で書き出す。日付が変わると状態は破棄される。
+    """
+
+    def __init__(self, path: str = STATE_PATH, save_seconds: int = SAVE_SECONDS):
+        self.path = path
+        self.save_seconds = save_seconds
+        self._lock = threading.Lock()
+        self._today = datetime.now(JST).date().isoformat()
+        self._races = {}
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("date") == self._today:
+                self._races = {rid: {hn: _stored_labels(v) for hn, v in horses.items()}
+                               for rid, horses in state.get("races", {}).items()}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"date": self._today, "races": self._races}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _rows_for(self, race_id: str, hn, label: str, seen: dict) -> list[dict]:
+        out = []
+        for frm, to in LABEL_PAIRS:
+            if label in (frm, to) and seen.get(frm) and seen.get(to) is not None:
+                out.append(_fluct_row(race_id, self._today, hn, frm, to, seen[frm], seen[to]))
+        if len(seen) < 2:
+            return out
+        ordered = [seen[l] for l in LABEL_ORDER if l in seen]
+        if ordered[0]:
+            out.append(_fluct_row(race_id, self._today, hn, *FIRST_TO_LAST, ordered[0], ordered[-1]))
+        lo, hi = min(ordered), max(ordered)
+        if lo:
+            out.append(_fluct_row(race_id, self._today, hn, *MAX_SWING, lo, hi))
+        return out
+
+    def update(self, race_id: str, label: str, odds_by_horse: dict) -> list[dict]:
+        """odds_by_horse: {馬番: odds_avg}。odds_fluctuation に追加・更新すべき行を返す。"""
+        if label not in LABEL_ORDER:
+            return []
+        out = []
+        with self._lock:
+            today = datetime.now(JST).date().isoformat()
+            if today != self._today:
+                self._today, self._races = today, {}
+            horses = self._races.setdefault(race_id, {})
+            new_horse = False
+            for hn, odds in odds_by_horse.items():
+                if odds is None:
+                    continue
+                seen = horses.get(str(hn))
+                if seen is None:
+                    seen = horses[str(hn)] = {}
+                    new_horse = True
+                seen[label] = odds
+                out.extend(self._rows_for(race_id, hn, label, seen))
+            self._dirty = True
+            # 新しい馬はすぐ書き出す（再起動後に隣のラベルとのペアを作れるように）。それ以外は間引く
+            if new_horse or time.monotonic() - self._saved_at >= self.save_seconds:
+                self._save()
+        return out
+
+    def flush(self):
+        """未書き出しの状態があれば保存する（scheduler の終了時に呼ぶ）。"""
+        with self._lock:
+            if self._dirty:
+                self._save()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--race_id", required=True)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--race_id")
+    group.add_argument("--date", help="YYYY-MM-DD の全レースを一括計算")
     args = parser.parse_args()
-    calc_fluctuation(args.race_id)
+    if args.date:
+        calc_fluctuation_date(args.date)
+    else:
+        calc_fluctuation(args.race_id)
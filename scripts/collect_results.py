@@ -0,0 +1,196 @@
+# scripts/collect_results.py
+
+import os
+import sys
+import json
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+
+import requests
+from google.cloud import bigquery
+
+import scripts.bq_merge as bq_merge
+import scripts.metrics as metrics
+import scripts.netkeiba as nk
+import scripts.schema as schema
+from scripts.ratelimit import RateLimiter, retry_with_backoff
+
+JST = timezone(timedelta(hours=9))
+
+# --- 設定 ---
+RESULTS_RETRY_SECONDS = int(os.getenv("RESULTS_RETRY_SECONDS", "300"))       # 未確定レースの再取得間隔
+RESULTS_GIVE_UP = timedelta(hours=float(os.getenv("RESULTS_GIVE_UP_HOURS", "2")))  # これを過ぎたら諦める
+RESULTS_RPS     = float(os.getenv("RESULTS_RPS", "1.0"))   # 取りこぼし補完時の毎秒リクエスト上限
+RESULTS_RETRIES = int(os.getenv("RESULTS_RETRIES", "3"))
+STATE_DIR = os.getenv("RESULTS_STATE_DIR", "data/state")
+
+
+def to_result_rows(race_id: str, date_str: str, results: list[dict]) -> list[dict]:
+    """parse_results の結果を race_results の行にする（馬番の無い行は除く）。"""
+    return [
+        {"race_id": race_id, "race_date": date_str, "horse_no": h["number"],
+         "finish_position": h["finish_position"], "popularity": h["popularity"],
+         "final_odds": h["final_odds"]}
+        for h in results if h["number"] is not None
+    ]
+
+
+def fetch_result_rows(race_id: str, date_str: str) -> list[dict]:
+    """
+    結果ページを1回取得して race_results の行を返す。
+    着順がまだ1頭も確定していない（結果ページ未掲載・審議中など）場合は None。
+    """
+    soup = nk.fetch_soup(nk.RESULT_URL.format(race_id=race_id))
+    with metrics.span("parse.results", race_id=race_id):
+        results = nk.parse_results(soup)
+    if not any(h["finish_position"] is not None for h in results):
+        return None
+    rows = to_result_rows(race_id, date_str, results)
+    metrics.inc("rows_parsed", len(rows), stage="parse.results")
+    return rows
+
+
+def missing_race_ids(client: bigquery.Client, date_str: str) -> list[str]:
+    """race に登録済みで race_results に無い当日のレース。"""
+    sql = f"""
+      SELECT race_id FROM `{schema.table_id("race", client.project)}`
+      WHERE race_date = '{date_str}'
+        AND race_id NOT IN (
+          SELECT race_id FROM `{schema.table_id("race_results", client.project)}`
+          WHERE race_date = '{date_str}')
+      GROUP BY race_id
+      ORDER BY race_id
+    """
+    return [row["race_id"] for row in client.query(sql)]
+
+
+class ResultsCollector:
+    """
+    1開催日分の着順と確定単勝オッズを集め、最後に1回のロードジョブで race_results に登録する。
+
+    scheduler は post_race スナップショットの直後に collect() で結果ページを取りに行き、
+    まだ確定していなければ pending に残して RESULTS_RETRY_SECONDS ごとに collect_pending() で取り直す。
+    集めた行と pending は STATE_DIR/results_<date>.json に保存し、再起動後も引き継ぐ。
+    """
+
+    def __init__(self, date_str: str = None):
+        self.date_str = date_str or datetime.now(JST).date().isoformat()
+        self.path = os.path.join(STATE_DIR, f"results_{self.date_str}.json")
+        self._lock = threading.Lock()
+        self.rows, self.pending, self.loaded = {}, {}, []
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+            self.rows = state.get("rows", {})
+            self.pending = state.get("pending", {})
+            self.loaded = state.get("loaded", [])
+
+    def _save(self):
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"rows": self.rows, "pending": self.pending, "loaded": self.loaded},
+                      f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def collect(self, race_id: str, now: datetime = None) -> bool:
+        """1レースの結果を取りに行く。確定していなければ pending に積んで False。"""
+        now = now or datetime.now(JST)
+        with self._lock:
+            if race_id in self.rows:
+                return True
+            self.pending.setdefault(race_id, now.isoformat())
+        try:
+            rows = fetch_result_rows(race_id, self.date_str)
+        except requests.RequestException as e:
+            metrics.inc("failures", stage="http.get")
+            print(f"[WARN] 結果ページ取得失敗 race_id={race_id}: {e}", file=sys.stderr)
+            rows = None
+        with self._lock:
+            if rows:
+                self.rows[race_id] = rows
+                self.pending.pop(race_id, None)
+            elif now - datetime.fromisoformat(self.pending[race_id]) > RESULTS_GIVE_UP:
+                print(f"[WARN] 結果未確定のまま打ち切り race_id={race_id}"
+                      f"（python -m scripts.collect_results --date {self.date_str} で補完）",
+                      file=sys.stderr)
+                self.pending.pop(race_id)
+            self._save()
+        return bool(rows)
+
+    def collect_pending(self, now: datetime = None) -> int:
+        """pending のレースを取り直し、確定したレース数を返す。"""
+        with self._lock:
+            race_ids = list(self.pending)
+        return sum(self.collect(rid, now) for rid in race_ids)
+
+    def load(self, client: bigquery.Client = None) -> int:
+        """
+        集めた行のうち未登録のレース分を1回の MERGE で race_results に upsert する
+        （(race_id, horse_no) で突き合わせるので、バックフィル済みのレースも重複しない）。登録した行数を返す。
+        """
+        with self._lock:
+            race_ids = [rid for rid in self.rows if rid not in self.loaded]
+        if not race_ids:
+            return 0
+        client = client or bigquery.Client()
+        schema.require(client)
+        rows = [r for rid in race_ids for r in self.rows[rid]]
+        result = bq_merge.merge_rows(client, "race_results", rows)
+        with self._lock:
+            self.loaded.extend(race_ids)
+            self._save()
+        print(f"[INFO] 着順 {len(race_ids)} レースを1回の MERGE で登録（{bq_merge.describe('race_results', result)}）")
+        return result["inserted"] + result["updated"]
+
+    def summary(self) -> str:
+        return (f"結果 {len(self.rows)} レース取得 / 未確定 {len(self.pending)} / "
+                f"登録済み {len(self.loaded)}")
+
+
+def backfill_results(dates: list[str], rps: float = RESULTS_RPS, retries: int = RESULTS_RETRIES):
+    """各日付について race にあって race_results に無いレースの結果を取り、日ごとに1回で登録する。"""
+    client = bigquery.Client()
+    schema.require(client)
+    limiter = RateLimiter(rps)
+    for date_str in dates:
+        race_ids = missing_race_ids(client, date_str)
+        if not race_ids:
+            print(f"[INFO] {date_str}: 取りこぼしなし")
+            continue
+        print(f"[INFO] {date_str}: 結果未登録 {len(race_ids)} レース")
+        collector = ResultsCollector(date_str)
+        for rid in race_ids:
+            def _attempt(rid=rid):
+                limiter.wait()
+                return fetch_result_rows(rid, date_str)
+            try:
+                rows = retry_with_backoff(_attempt, attempts=retries, label=rid,
+                                          retry_on=(requests.RequestException,))
+            except requests.RequestException as e:
+                print(f"[ERROR] {rid} の結果取得失敗: {e}", file=sys.stderr)
+                continue
+            if rows:
+                collector.rows[rid] = rows
+            else:
+                print(f"[WARN] {rid}: 結果未確定（中止・未掲載）", file=sys.stderr)
+        collector.load(client)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="race_results の取りこぼしを結果ページから補完する")
+    parser.add_argument("--date", help="YYYY-MM-DD")
+    parser.add_argument("--start", help="YYYY-MM-DD")
+    parser.add_argument("--end", help="YYYY-MM-DD")
+    parser.add_argument("--rps", type=float, default=RESULTS_RPS)
+    args = parser.parse_args()
+
+    if args.date:
+        dates = [args.date]
+    elif args.start and args.end:
+        from scripts.backfill import dates_from_range
+        dates = dates_from_range(args.start, args.end)
+    else:
+        parser.error("--date、または --start と --end を指定してください")
+    backfill_results(dates, args.rps)
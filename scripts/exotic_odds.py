@@ -0,0 +1,248 @@
+# scripts/exotic_odds.py
+
+import os
+import sys
+import zlib
+import base64
+import argparse
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import requests
+from google.cloud import bigquery
+
+import scripts.metrics as metrics
+import scripts.netkeiba as nk
+import scripts.schema as schema
+from scripts.ratelimit import RateLimiter
+
+# --- 券種 ---
+# 名前 → (API の type, 選ぶ頭数, 着順を区別するか)
+BET_TYPES = {
+    "umaren":     (4, 2, False),   # 馬連
+    "wide":       (5, 2, False),   # ワイド（オッズは下限・上限の2値）
+    "umatan":     (6, 2, True),    # 馬単
+    "sanrenpuku": (7, 3, False),   # 3連複
+    "sanrentan":  (8, 3, True),    # 3連単
+}
+RANGE_BETS = {"wide"}
+
+# --- 設定 ---
+# scheduler で取得する券種（カンマ区切り、既定は空 = 取得しない）。指定時は 1h/30m/5m前・レース後の
+# ラベルでだけ取り、1レース×券種ごとに1リクエストをサンプラーの1日予算から引く
+EXOTIC_BETS = [b.strip() for b in os.getenv("EXOTIC_BETS", "").split(",")
+               if b.strip() in BET_TYPES]
+EXOTIC_WORKERS = int(os.getenv("EXOTIC_WORKERS", "4"))   # 券種×レースの同時取得数
+EXOTIC_RPS     = float(os.getenv("EXOTIC_RPS", "2.0"))   # オッズ API への毎秒リクエスト上限（全ワーカー合計）
+
+# 保存形式: 組番の正準順（combos の順）に並べたオッズ ×10 を uint32 リトルエンディアンで並べ、zlib 圧縮。
+# 0 は発売なし・取消。ワイドは組番ごとに (下限, 上限) の2値
+_SCALE = 10
+_DTYPE = "<u4"
+
+
+@functools.lru_cache(maxsize=None)
+def combos(bet: str, n: int) -> np.ndarray:
+    """n 頭立ての組番（0 始まりの馬番）を正準順で並べた (組数, 頭数) 配列。"""
+    _, k, ordered = BET_TYPES[bet]
+    gen = itertools.permutations(range(n), k) if ordered else itertools.combinations(range(n), k)
+    return np.array(list(gen), dtype=np.intp).reshape(-1, k)
+
+
+def _shape(bet: str, n: int) -> tuple:
+    _, k, _ = BET_TYPES[bet]
+    return (n,) * k + ((2,) if bet in RANGE_BETS else ())
+
+
+# --- 密行列 ⇔ ベクトル ---
+def to_vector(matrix: np.ndarray, bet: str) -> np.ndarray:
+    """密行列から正準順のオッズを取り出す（(組数,) またはワイドは (組数, 2)）。"""
+    return matrix[tuple(combos(bet, matrix.shape[0]).T)]
+
+
+def to_matrix(vector: np.ndarray, bet: str, n: int) -> np.ndarray:
+    """正準順のオッズを、馬番-1 で引ける密行列（順序なしの券種は昇順の組番のセルだけ）に戻す。"""
+    matrix = np.full(_shape(bet, n), np.nan, dtype=np.float32)
+    matrix[tuple(combos(bet, n).T)] = vector
+    return matrix
+
+
+def parse_api(odds: dict, bet: str, n: int = None) -> np.ndarray:
+    """
+    fetch_odds_api の {組番: [オッズ, (上限), 人気]} を密行列にする。
+    n を省略すると組番に現れた最大の馬番を頭数とする。数値でないオッズ（取消など）は NaN。
+    """
+    _, k, ordered = BET_TYPES[bet]
+    if not odds:
+        return np.full(_shape(bet, n or 0), np.nan, dtype=np.float32)
+    keys = [key for key in odds if len(key) == 2 * k and key.isdigit()]
+    digits = np.frombuffer("".join(keys).encode("ascii"), dtype=np.uint8).reshape(-1, 2 * k) - 48
+    idx = (digits[:, 0::2].astype(np.intp) * 10 + digits[:, 1::2]) - 1
+    if not ordered:
+        idx.sort(axis=1)
+    n = n or int(idx.max()) + 1
+    cols = 2 if bet in RANGE_BETS else 1
+    values = np.empty((len(keys), cols), dtype=np.float32)
+    for c in range(cols):
+        values[:, c] = pd.to_numeric(
+            pd.Series([odds[key][c] if len(odds[key]) > c else "" for key in keys]),
+            errors="coerce")
+    matrix = np.full(_shape(bet, n), np.nan, dtype=np.float32)
+    keep = (idx < n).all(axis=1)
+    matrix[tuple(idx[keep].T)] = values[keep] if cols == 2 else values[keep, 0]
+    return matrix
+
+
+# --- 符号化 ---
+def encode(matrix: np.ndarray, bet: str) -> bytes:
+    vector = to_vector(matrix, bet)
+    scaled = np.nan_to_num(np.rint(vector * _SCALE), nan=0).astype(_DTYPE)
+    return zlib.compress(scaled.tobytes())
+
+
+def decode(blob: bytes, bet: str, n: int) -> np.ndarray:
+    vector = np.frombuffer(zlib.decompress(blob), dtype=_DTYPE).astype(np.float32) / _SCALE
+    if bet in RANGE_BETS:
+        vector = vector.reshape(-1, 2)
+    vector[vector == 0] = np.nan
+    return to_matrix(vector, bet, n)
+
+
+def to_row(race_id: str, race_date: str, bet: str, label: str, matrix: np.ndarray,
+           snapshot_at: datetime) -> dict:
+    """odds_exotic の1行（odds は BYTES 列なので JSON ロード用に base64 にする）。"""
+    return {
+        "race_id":     race_id,
+        "race_date":   race_date,
+        "bet_type":    bet,
+        "label":       label,
+        "snapshot_at": snapshot_at.astimezone(timezone.utc).isoformat(),
+        "n_horses":    matrix.shape[0],
+        "odds":        base64.b64encode(encode(matrix, bet)).decode("ascii"),
+    }
+
+
+# --- 取得 ---
+def fetch_exotic(race_id: str, bets: list[str] = None, n: int = None) -> dict:
+    """1レースの各券種を取得し {券種: 密行列} を返す（取れなかった券種は含めない）。"""
+    out = {}
+    for bet in bets or EXOTIC_BETS:
+        _limiter.wait()
+        odds = nk.fetch_odds_api(race_id, BET_TYPES[bet][0])
+        if not odds:
+            continue
+        with metrics.span(f"parse.exotic_{bet}", race_id=race_id):
+            out[bet] = parse_api(odds, bet, n)
+        metrics.inc("rows_parsed", len(odds), stage=f"parse.exotic_{bet}")
+    return out
+
+
+_executor = None
+_limiter = RateLimiter(EXOTIC_RPS)
+
+
+def capture(targets: list[tuple], bets: list[str] = None) -> list[dict]:
+    """
+    targets: (race_id, race_date, label, 頭数) のリスト。
+    全レース×券種を EXOTIC_WORKERS 本で並列に取得し、odds_exotic の行を返す。
+    頭数は単勝で取れた最大馬番（None なら組番から判定）。失敗した券種は警告して飛ばす。
+    """
+    global _executor
+    bets = bets or EXOTIC_BETS
+    if not targets or not bets:
+        return []
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=EXOTIC_WORKERS, thread_name_prefix="exotic")
+    snapshot_at = datetime.now(timezone.utc)
+
+    def _one(target, bet):
+        race_id, race_date, label, n = target
+        try:
+            matrix = fetch_exotic(race_id, [bet], n).get(bet)
+        except (requests.RequestException, ValueError) as e:
+            metrics.inc("failures", stage=f"exotic.{bet}")
+            print(f"[WARN] {bet} オッズ取得失敗 race_id={race_id}: {e}", file=sys.stderr)
+            return None
+        if matrix is None:
+            return None
+        return to_row(race_id, race_date, bet, label, matrix, snapshot_at)
+
+    futures = [_executor.submit(_one, t, bet) for t in targets for bet in bets]
+    return [row for row in (f.result() for f in futures) if row is not None]
+
+
+# --- 変動（スナップショット間をまとめてベクトル計算） ---
+def fluctuation(stack: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    stack: 時系列に並べた同じ券種・同じ頭数のオッズ（(T, 組数) または (T, 組数, 2)）。
+    隣接スナップショット間の変動値と変動率(%)を (T-1, ...) の配列で返す（どちらかが NaN なら NaN）。
+    """
+    prev, cur = stack[:-1], stack[1:]
+    diff = cur - prev
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = diff / prev * 100
+    return diff, rate
+
+
+def combo_labels(bet: str, n: int) -> np.ndarray:
+    """正準順の組番の表記（馬連・3連複は "1-2"、馬単・3連単は "1>2"）。"""
+    sep = ">" if BET_TYPES[bet][2] else "-"
+    return np.array([sep.join(str(h + 1) for h in c) for c in combos(bet, n)])
+
+
+def load_race(client: bigquery.Client, race_id: str, race_date: str, bet: str) -> pd.DataFrame:
+    """1レース・1券種の odds_exotic を時系列順に読む（race_date パーティションだけを読む）。"""
+    sql = f"""
+      SELECT label, snapshot_at, n_horses, odds
+      FROM `{schema.table_id("odds_exotic", client.project)}`
+      WHERE race_date = '{race_date}' AND race_id = '{race_id}' AND bet_type = '{bet}'
+      ORDER BY snapshot_at
+    """
+    return client.query(sql).to_dataframe()
+
+
+def race_movers(df: pd.DataFrame, bet: str, top: int = 20) -> pd.DataFrame:
+    """
+    load_race の結果から、最初→最後のスナップショットで変動率の絶対値が大きい組番を返す。
+    頭数が途中で変わった場合（取消の反映など）は最後のスナップショットの頭数に揃える。
+    """
+    n = int(df["n_horses"].iloc[-1])
+    vectors = np.stack([to_vector(decode(bytes(b), bet, n), bet)
+                        for b, h in zip(df["odds"], df["n_horses"]) if h == n])
+    if bet in RANGE_BETS:
+        vectors = vectors[..., 0]   # ワイドは下限で比べる
+    diff, rate = fluctuation(vectors[[0, -1]])
+    out = pd.DataFrame({
+        "combo": combo_labels(bet, n), "first": vectors[0], "last": vectors[-1],
+        "fluctuation_value": diff[0], "fluctuation_rate": rate[0],
+    }).dropna()
+    return out.reindex(out["fluctuation_rate"].abs().sort_values(ascending=False).index).head(top)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="馬連・ワイド・馬単・3連複・3連単のオッズ")
+    parser.add_argument("--race_id", required=True)
+    parser.add_argument("--bets", nargs="*", choices=list(BET_TYPES), default=EXOTIC_BETS or list(BET_TYPES))
+    parser.add_argument("--date", help="YYYY-MM-DD。指定時は保存済みスナップショットから変動の大きい組番を表示")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.date:
+        client = bigquery.Client()
+        for bet in args.bets:
+            df = load_race(client, args.race_id, args.date, bet)
+            if len(df) < 2:
+                print(f"[INFO] {bet}: スナップショットが {len(df)} 件のため変動なし")
+                continue
+            print(f"[INFO] {bet}: {len(df)} スナップショット")
+            print(race_movers(df, bet, args.top).to_string(index=False))
+    else:
+        for bet, matrix in fetch_exotic(args.race_id, args.bets).items():
+            vector = to_vector(matrix, bet)
+            blob = encode(matrix, bet)
+            print(f"[INFO] {bet}: {matrix.shape[0]} 頭 {np.isfinite(vector).sum()}/{len(vector)} 組 "
+                  f"→ {len(blob)} バイト（float32 の {len(blob) / max(vector.nbytes, 1):.0%}）")
@@ -1,10 +1,181 @@
 import argparse
+from datetime import date, datetime
 import gspread
 from google.oauth2.service_account import Credentials
 import pandas as pd
 from google.cloud import bigquery
 
-def export_date(date_str: str):
+import scripts.metrics as metrics
+import scripts.mirror as mirror
+import scripts.schema as schema
+
+# シートの列（README の列順）と、クエリ結果の列名の対応
+COLUMNS = [
+    ("競馬場名", "venue"), ("レース番号", "race_no"), ("発走時刻", "start_time"),
+    ("レース名", "race_name"), ("レースクラス", "race_class"), ("芝/ダート", "track_surface"),
+    ("距離", "distance_m"), ("頭数", "entries_count"), ("枠", "waku"), ("馬番", "horse_no"),
+    ("馬体重", "weight"), ("馬名", "horse_name"), ("騎手", "jockey"),
+    ("レース1時間前オッズ", "odds_1h"), ("レース30分前オッズ", "odds_30m"),
+    ("レース5分前オッズ", "odds_5m"), ("レース後オッズ", "odds_post"),
+    ("オッズ変動値", "fluctuation_value"), ("オッズ変動率", "fluctuation_rate"),
+    ("レース結果", "finish_position"),
+]
+
+
+def query_day(client: bigquery.Client, date_str: str) -> pd.DataFrame:
+    """
+    1日分の レース × 出走馬 × オッズ(4ラベル) × 変動 × 着順 を1クエリで取得する。
+    スナップショットはラベルごとの自己結合ではなく条件付き集約で横持ちにし、
+    変動・着順も (race_id, horse_no) で1行に集約してから結合する（重複行で膨らまない）。
+    """
+    if mirror.use_mirror():
+        return query_day_mirror(date_str)
+    ds = f"{client.project}.{schema.DATASET}"
+    # 各テーブルをパーティション列で当日に絞ってから race_id で結合する
+    sql = f"""
+      WITH day_race AS (
+        SELECT * FROM `{ds}.race`
+        WHERE race_date = '{date_str}'
+      ),
+      snap AS (
+        SELECT race_id, horse_no,
+               MAX(IF(label = '1h_before',  odds_avg, NULL)) AS odds_1h,
+               MAX(IF(label = '30m_before', odds_avg, NULL)) AS odds_30m,
+               MAX(IF(label = '5m_before',  odds_avg, NULL)) AS odds_5m,
+               MAX(IF(label = 'post_race',  odds_avg, NULL)) AS odds_post
+        FROM `{ds}.odds_snapshot`
+        WHERE DATE(snapshot_at) = '{date_str}'
+          AND race_id IN (SELECT race_id FROM day_race)
+        GROUP BY race_id, horse_no
+      ),
+      fluct AS (
+        SELECT race_id, horse_no,
+               ANY_VALUE(fluctuation_value) AS fluctuation_value,
+               ANY_VALUE(fluctuation_rate)  AS fluctuation_rate
+        FROM `{ds}.odds_fluctuation`
+        WHERE race_date = '{date_str}'
+          AND race_id IN (SELECT race_id FROM day_race)
+          AND from_label = 'first' AND to_label = 'last'
+        GROUP BY race_id, horse_no
+      ),
+      result AS (
+        SELECT race_id, horse_no, ANY_VALUE(finish_position) AS finish_position
+        FROM `{ds}.race_results`
+        WHERE race_date = '{date_str}'
+          AND race_id IN (SELECT race_id FROM day_race)
+        GROUP BY race_id, horse_no
+      )
+      SELECT r.race_id, r.venue, r.race_no, FORMAT_TIMESTAMP('%H:%M', r.start_time) AS start_time,
+             r.race_name, r.race_class, r.track_surface, r.distance_m, r.entries_count,
+             h.waku, h.number AS horse_no, h.weight, h.name AS horse_name, h.jockey,
+             s.odds_1h, s.odds_30m, s.odds_5m, s.odds_post,
+             f.fluctuation_value, f.fluctuation_rate,
+             rr.finish_position
+      FROM day_race r, UNNEST(r.horses) AS h
+      LEFT JOIN snap   s  ON s.race_id  = r.race_id AND s.horse_no  = h.number
+      LEFT JOIN fluct  f  ON f.race_id  = r.race_id AND f.horse_no  = h.number
+      LEFT JOIN result rr ON rr.race_id = r.race_id AND rr.horse_no = h.number
+      ORDER BY r.venue, r.race_no, h.waku, h.number
+    """
+    return client.query(sql).to_dataframe()
+
+
+def query_day_mirror(date_str: str) -> pd.DataFrame:
+    """query_day と同じ結果をローカルミラー（DuckDB）から取得する。"""
+    return mirror.query("""
+      WITH day_race AS (
+        SELECT * EXCLUDE (horses), UNNEST(horses) AS h
+        FROM race WHERE dt = CAST(? AS DATE)
+      ),
+      snap AS (
+        SELECT race_id, horse_no,
+               MAX(odds_avg) FILTER (WHERE label = '1h_before')  AS odds_1h,
+               MAX(odds_avg) FILTER (WHERE label = '30m_before') AS odds_30m,
+               MAX(odds_avg) FILTER (WHERE label = '5m_before')  AS odds_5m,
+               MAX(odds_avg) FILTER (WHERE label = 'post_race')  AS odds_post
+        FROM odds_snapshot
+        WHERE race_id IN (SELECT race_id FROM day_race)
+        GROUP BY race_id, horse_no
+      ),
+      fluct AS (
+        SELECT race_id, horse_no,
+               ANY_VALUE(fluctuation_value) AS fluctuation_value,
+               ANY_VALUE(fluctuation_rate)  AS fluctuation_rate
+        FROM odds_fluctuation
+        WHERE race_id IN (SELECT race_id FROM day_race)
+          AND from_label = 'first' AND to_label = 'last'
+        GROUP BY race_id, horse_no
+      ),
+      result AS (
+        SELECT race_id, horse_no, ANY_VALUE(finish_position) AS finish_position
+        FROM race_results
+        WHERE race_id IN (SELECT race_id FROM day_race)
+        GROUP BY race_id, horse_no
+      )
+      SELECT r.race_id, r.venue, r.race_no, strftime(r.start_time, '%H:%M') AS start_time,
+             r.race_name, r.race_class, r.track_surface, r.distance_m, r.entries_count,
+             r.h.waku, r.h.number AS horse_no, r.h.weight, r.h.name AS horse_name, r.h.jockey,
+             s.odds_1h, s.odds_30m, s.odds_5m, s.odds_post,
+             f.fluctuation_value, f.fluctuation_rate,
+             rr.finish_position
+      FROM day_race r
+      LEFT JOIN snap   s  ON s.race_id  = r.race_id AND s.horse_no  = r.h.number
+      LEFT JOIN fluct  f  ON f.race_id  = r.race_id AND f.horse_no  = r.h.number
+      LEFT JOIN result rr ON rr.race_id = r.race_id AND rr.horse_no = r.h.number
+      ORDER BY r.venue, r.race_no, r.h.waku, r.h.number
+    """, [date_str])
+
+
+def to_cell(v):
+    """セルに書ける JSON 値にする（欠損は空文字、日時は文字列、numpy スカラーは Python 型）。"""
+    if v is None or (not isinstance(v, str) and pd.isna(v)):
+        return ""
+    if isinstance(v, datetime):   # pd.Timestamp を含む。start_time は日本時間の壁時計なのでそのまま書く
+        return v.strftime("%Y-%m-%d %H:%M")
+    if isinstance(v, date):
+        return v.isoformat()
+    if hasattr(v, "item"):   # numpy スカラー → Python 型
+        return v.item()
+    return v
+
+
+def build_grids(df: pd.DataFrame) -> dict:
+    """レースごとのタブ名 → ヘッダー付き2次元配列。"""
+    header = [title for title, _ in COLUMNS]
+    cols = [col for _, col in COLUMNS]
+    grids = {}
+    for (venue, race_no), group in df.groupby(["venue", "race_no"], sort=False):
+        rows = [[to_cell(v) for v in rec] for rec in group[cols].itertuples(index=False)]
+        grids[f"{venue}{race_no}R"] = [header] + rows
+    return grids
+
+
+def write_grids(sh, grids: dict):
+    """
+    全タブをまとめて書き込む。API 呼び出しは
+    シート一覧取得・不足タブ追加(batch_update)・クリア・値書き込み(values_batch_update)の最大4回。
+    """
+    existing = {ws.title for ws in sh.worksheets()}
+    add_requests = [
+        {"addSheet": {"properties": {
+            "title": title,
+            "gridProperties": {"rowCount": max(len(grid), 50), "columnCount": len(COLUMNS)},
+        }}}
+        for title, grid in grids.items() if title not in existing
+    ]
+    if add_requests:
+        sh.batch_update({"requests": add_requests})
+
+    ranges = [f"'{title}'" for title in grids]
+    sh.values_batch_clear(body={"ranges": ranges})
+    sh.values_batch_update(body={
+        "valueInputOption": "RAW",
+        "data": [{"range": f"'{title}'!A1", "values": grid} for title, grid in grids.items()],
+    })
+
+
+def open_spreadsheet(date_str: str):
+    """日付のスプレッドシートを開く（無ければ作成して閲覧共有）。"""
     # 認証
     creds = Credentials.from_service_account_file(
         filename="~/creds.json",
@@ -19,47 +190,24 @@ def export_date(date_str: str):
     except gspread.SpreadsheetNotFound:
         sh = gc.create(sh_title)
         sh.share(None, perm_type='anyone', role='reader')
+    return sh
+
+
+def export_date(date_str: str):
+    sh = open_spreadsheet(date_str)
 
-    client = bigquery.Client()
-    # 競馬場一覧
-    tracks = client.query(f"""
-      SELECT DISTINCT track FROM `{client.project}.jra_odds.race`
-      WHERE race_date = '{date_str}'
-    """).to_dataframe()["track"]
-    for track in tracks:
-        # タブ作成
-        try:
-            ws = sh.worksheet(track)
-        except gspread.WorksheetNotFound:
-            ws = sh.add_worksheet(track, rows=100, cols=20)
-        # レースごとにシートに書き込み
-        races = client.query(f"""
-          SELECT * FROM `{client.project}.jra_odds.race`
-          WHERE race_date = '{date_str}' AND track = '{track}'
-          ORDER BY start_time
-        """).to_dataframe()
-        for _, r in races.iterrows():
-            df = client.query(f"""
-              SELECT e.frame_no, e.horse_no, e.weight_kg, e.horse_name, e.jockey,
-                     o1.odds_avg FILTER(WHERE o1.label='1h_before') AS odds_1h,
-                     o2.odds_avg FILTER(WHERE o2.label='30m_before') AS odds_30m,
-                     o3.odds_avg FILTER(WHERE o3.label='5m_before') AS odds_5m,
-                     o4.odds_avg FILTER(WHERE o4.label='post_race') AS odds_post,
-                     f.fluctuation_value, f.fluctuation_rate,
-                     rr.finish_position
-              FROM `{client.project}.jra_odds.entries` e
-              LEFT JOIN `jra_odds.odds_snapshot` o1 ON e.race_id=o1.race_id AND e.horse_no=o1.horse_no AND o1.label='1h_before'
-              LEFT JOIN `jra_odds.odds_snapshot` o2 ON e.race_id=o2.race_id AND e.horse_no=o2.horse_no AND o2.label='30m_before'
-              LEFT JOIN `jra_odds.odds_snapshot` o3 ON e.race_id=o3.race_id AND e.horse_no=o3.horse_no AND o3.label='5m_before'
-              LEFT JOIN `jra_odds.odds_snapshot` o4 ON e.race_id=o4.race_id AND e.horse_no=o4.horse_no AND o4.label='post_race'
-              LEFT JOIN `{client.project}.jra_odds.odds_fluctuation` f ON e.race_id=f.race_id AND e.horse_no=f.horse_no
-              LEFT JOIN `{client.project}.jra_odds.race_results` rr ON e.race_id=rr.race_id AND e.horse_no=rr.horse_no
-              WHERE e.race_id = '{r.race_id}'
-              ORDER BY e.frame_no
-            """).to_dataframe()
-            # シートに書き込み
-            ws.clear()
-            ws.update([df.columns.values.tolist()] + df.values.tolist())
+    # 1日分を1クエリで取得し、競馬場・レースごとのタブにまとめて書き込み
+    with metrics.span("bq.query", date=date_str):
+        df = query_day(None if mirror.use_mirror() else bigquery.Client(), date_str)
+    if df.empty:
+        print(f"[WARN] {date_str} のレースデータがありません")
+        return
+    with metrics.span("sheets.build", rows=len(df)):
+        grids = build_grids(df)
+    with metrics.span("sheets.write", tabs=len(grids)):
+        write_grids(sh, grids)
+    metrics.inc("rows_written", len(df), stage="sheets.write")
+    print(f"[INFO] {len(grids)} タブを書き込みました → {sh.title}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -2,142 +2,196 @@
 
 import os
 import sys
-import time
-import random
-import logging
-import re
-from datetime import datetime, timezone
+import asyncio
+from datetime import datetime, timezone, timedelta
 
-from playwright.sync_api import sync_playwright
+from google.api_core.exceptions import GoogleAPIError
 from google.cloud import bigquery
 
-# --- 共通設定 ---
-USER_AGENTS = [
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:115.0) "
-    "Gecko/20100101 Firefox/115.0",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:115.0) "
-    "Gecko/20100101 Firefox/115.0",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-    "AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.2 Safari/605.1.15",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Edg/115.0.0.0",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 OPR/85.0.4341.72",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 OPR/85.0.4341.72",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Vivaldi/5.3.2679.55",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Vivaldi/5.3.2679.55",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Brave/1.40.107",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Brave/1.40.107",
-]
-
-BQ_PROJECT = bigquery.Client().project
-BQ_DATASET = "jra_odds"
-BQ_TABLE   = f"{BQ_PROJECT}.{BQ_DATASET}.odds"
+from scripts.ratelimit import AsyncHostBudget
+import scripts.metrics as metrics
+import scripts.netkeiba as nk
+import scripts.odds_sources as src
+import scripts.navigation as nav
+import scripts.page_cache as page_cache
+from scripts.odds_spool import get_spool
+import scripts.schema as schema
+
+JST = timezone(timedelta(hours=9))
+
+# --- 並列取得設定（fetch_odds_batch） ---
+BATCH_CONCURRENCY = int(os.getenv("ODDS_CONCURRENCY", "4"))     # 同時に開くページ数
+HOST_MAX_PARALLEL = int(os.getenv("ODDS_HOST_PARALLEL", "2"))   # 同一ホストへの同時接続数
+HOST_MIN_INTERVAL = float(os.getenv("ODDS_HOST_INTERVAL", "1.0"))  # 同一ホストへのアクセス間隔(秒)
+
+
+def odds_url_for(race_id: str) -> str:
+    return nk.SHUTUBA_URL.format(race_id=race_id)
+
 
 # --- 単勝オッズ取得 ---
-def fetch_odds_by_race_id(race_id: str, minutes_before_race: int) -> list[dict]:
-    odds_url = f"https://race.netkeiba.com/race/shutuba.html?race_id={race_id}"
-    print(f"[INFO] オッズページロード → {odds_url}")
-
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page(
-            user_agent=random.choice(USER_AGENTS),
-            viewport={"width": 1200, "height": 800}
-        )
-        try:
-            page.goto(odds_url, timeout=0)
-            page.wait_for_selector("table.Shutuba_Table", timeout=10000)
-
-            odds_list = []
-            rows = page.query_selector_all("table.Shutuba_Table tbody tr.HorseList")
-
-            for row in rows:
-                try:
-                    number_el = row.query_selector("td[class^='Umaban']")
-                    number_txt = number_el.inner_text().strip() if number_el else ""
-                    number = int(number_txt) if number_txt.isdigit() else None
-
-                    # 特定クラス名に依存せず、<td class="Txt_R Popular"> 内の <span> を取得
-                    odds_td = row.query_selector("td.Txt_R.Popular")
-                    odds_span = odds_td.query_selector("span") if odds_td else None
-                    odds_txt = odds_span.inner_text().strip() if odds_span else ""
-                    odds = float(odds_txt) if re.match(r"^\d+(\.\d+)?$", odds_txt) else None
-
-                    if number is not None and odds is not None:
-                        odds_list.append({
-                            "number": number,
-                            "odds": odds,
-                            "timestamp": datetime.now(timezone.utc).isoformat()
-                        })
-                except Exception as e:
-                    logging.warning(f"[WARNING] 行パース失敗: {e}")
-
-            return {
-                "race_id": race_id,
-                "minutes_before_race": minutes_before_race,
-                "odds_list": odds_list
-            }
-
-        finally:
-            browser.close()
+def fetch_odds_by_race_id(race_id: str, minutes_before_race: int,
+                          deadline: float = src.DEADLINE_SECONDS):
+    """
+    優先ソース（既定は JRA 発表値の API）に問い合わせ、失敗・遅延時だけ次のソースで補う。
+    deadline 秒以内にどのソースからも取れなければ None。
+    """
+    with metrics.span("odds.fetch", race_id=race_id):
+        result = src.fetch_with_fallback(race_id, deadline)
+    if not result["odds_list"]:
+        metrics.inc("failures", stage="odds.fetch")
+        return None
+    record = {
+        "race_id": race_id,
+        "minutes_before_race": minutes_before_race,
+        **result,
+    }
+    print(f"[INFO] オッズ取得({src.tag(record)}) → race_id={race_id} {len(result['odds_list'])} 頭")
+    return record
+
+
+# --- 複数レース並列取得（asyncio） ---
+async def _fetch_one_async(sem: asyncio.Semaphore, budget: AsyncHostBudget,
+                           race_id: str, minutes_before_race: int) -> dict:
+    async with sem, budget.acquire(odds_url_for(race_id)):
+        with metrics.span("odds.fetch", race_id=race_id):
+            result = await src.fetch_with_fallback_async(race_id)
+    if not result["odds_list"]:
+        raise TimeoutError(f"{src.DEADLINE_SECONDS:.0f}s 以内に応答したソースなし")
+    return {
+        "race_id": race_id,
+        "minutes_before_race": minutes_before_race,
+        **result,
+    }
+
+
+async def _fetch_odds_batch_async(targets, concurrency, budget) -> list[dict]:
+    sem = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(
+        *[_fetch_one_async(sem, budget, rid, mins) for rid, mins in targets],
+        return_exceptions=True,
+    )
+
+    records = []
+    for (rid, mins), res in zip(targets, results):
+        if isinstance(res, BaseException):
+            metrics.inc("failures", stage="odds.fetch")
+            print(f"[WARN] オッズ取得失敗: race_id={rid} ({mins}): {res}", file=sys.stderr)
+        else:
+            records.append(res)
+    return records
+
+
+def fetch_odds_batch(targets: list[tuple[str, int]],
+                     concurrency: int = BATCH_CONCURRENCY,
+                     host_parallel: int = HOST_MAX_PARALLEL,
+                     host_interval: float = HOST_MIN_INTERVAL) -> list[dict]:
+    """
+    (race_id, minutes_before_race) のリストを並列取得する。ブラウザは netkeiba の描画に
+    切り替えたときだけ、プロセスで共有する BrowserPool のものを使う（バッチごとに起動しない）。
+    concurrency でページ同時数、host_parallel / host_interval で
+    同一ホストへの同時接続数とアクセス間隔を制限する。
+    戻り値は fetch_odds_by_race_id と同じ形式のレコードのリスト
+    （失敗したレースは含まない）で、そのまま store_odds_to_bigquery に渡せる。
+    """
+    if not targets:
+        return []
+    budget = AsyncHostBudget(max_per_host=host_parallel, min_interval=host_interval)
+    return asyncio.run(_fetch_odds_batch_async(list(targets), concurrency, budget))
+
+
+def to_snapshot_rows(odds_data: dict, label: str) -> list[dict]:
+    """
+    fetch_odds_by_race_id の結果を jra_odds.odds_snapshot の行形式に展開する。
+    snapshot_at は DATETIME（日本時間）として格納する。
+    odds_jra / odds_netkeiba は採用したソースの列にだけ値が入り、odds_avg は採用した値（列名は従来のまま）。
+    """
+    by_source = odds_data.get("by_source", {})
+    rows = []
+    for o in odds_data["odds_list"]:
+        ts = datetime.fromisoformat(o["timestamp"]).astimezone(JST)
+        rows.append({
+            "race_id":       odds_data["race_id"],
+            "horse_no":      o["number"],
+            "snapshot_at":   ts.replace(tzinfo=None).isoformat(),
+            "odds_jra":      by_source.get("jra", {}).get(o["number"]),
+            "odds_netkeiba": by_source.get("netkeiba", {}).get(o["number"]),
+            "odds_avg":      o["odds"],
+            "label":         label,
+        })
+    return rows
 
 
 # --- BigQuery 登録処理 ---
+def race_date_of(odds_data: dict) -> str:
+    """レコードの開催日（最初のオッズ時刻の日本時間の日付, YYYY-MM-DD）。odds テーブルのパーティション列。"""
+    first = min(o["timestamp"] for o in odds_data["odds_list"])
+    return datetime.fromisoformat(first).astimezone(JST).date().isoformat()
+
+
 def store_odds_to_bigquery(odds_data: list[dict]):
-    client = bigquery.Client()
-
-    ddl = f"""
-    CREATE TABLE IF NOT EXISTS `{BQ_TABLE}` (
-        race_id   STRING,
-        minutes_before_race INT64,
-        odds_list ARRAY<STRUCT<
-            number INT64,
-            odds   FLOAT64,
-            timestamp TIMESTAMP
-        >>
-    )
     """
-    client.query(ddl).result()
-    time.sleep(1)
+    取得結果をまずローカルスプールに追記し（取得データはここで確定）、
+    その後スプールをロードジョブで BigQuery に流す。
+    BigQuery に届かなかった分はスプールに残り、次回の flush で登録される。
+    """
+    spool = get_spool()
+    table = schema.table_id("odds")
+    # odds テーブルの列だけを残す（ソース別の値は odds_snapshot 側に入る）
+    with metrics.span("spool.append", table="odds"):
+        spool.append(table, [
+            {**{k: rec[k] for k in ("race_id", "minutes_before_race", "odds_list")},
+             "race_date": race_date_of(rec)}
+            for rec in odds_data
+        ])
+    print(f"[INFO] {len(odds_data)} 件のオッズをスプールに保存しました → {spool.path}")
 
-    errors = client.insert_rows_json(BQ_TABLE, odds_data)
-    if errors:
-        print(f"[ERROR] BigQuery登録失敗: {errors}", file=sys.stderr)
-        sys.exit(1)
+    try:
+        client = bigquery.Client()
+        with metrics.span("bq.schema_check"):
+            schema.require(client)
+        spool.flush(client)
+    except GoogleAPIError as e:
+        metrics.inc("failures", stage="bq.load")
+        print(f"[WARN] BigQuery登録を保留（スプールに保持）: {e}", file=sys.stderr)
+        return
 
-    print(f"[INFO] {len(odds_data)} 件のオッズを登録しました → {BQ_TABLE}")
+    print(f"[INFO] {len(odds_data)} 件のオッズを登録しました → {table}")
 
 
 # --- エントリーポイント ---
 def fetch_odds():
-    if len(sys.argv) < 3:
-        print("Usage: python fetch_odds.py <race_id> <minutes_before_race>", file=sys.stderr)
-        sys.exit(1)
-
-    race_id = sys.argv[1]
-    try:
-        minutes_before_race = int(sys.argv[2])
-    except ValueError:
-        print("minutes_before_race must be an integer.", file=sys.stderr)
+    args = sys.argv[1:]
+    if len(args) < 2 or len(args) % 2 != 0:
+        print("Usage: python -m scripts.fetch_odds <race_id> <minutes_before_race> "
+              "[<race_id> <minutes_before_race> ...]", file=sys.stderr)
         sys.exit(1)
-        
-    odds_data = fetch_odds_by_race_id(race_id, minutes_before_race)
 
-    if not odds_data:
-        print(f"[WARN] オッズ取得失敗: race_id={race_id}", file=sys.stderr)
-        sys.exit(1)
-
-    store_odds_to_bigquery([odds_data]) 
+    targets = []
+    for race_id, minutes in zip(args[0::2], args[1::2]):
+        try:
+            targets.append((race_id, int(minutes)))
+        except ValueError:
+            print("minutes_before_race must be an integer.", file=sys.stderr)
+            sys.exit(1)
+
+    if len(targets) == 1:
+        race_id, minutes_before_race = targets[0]
+        odds_data = fetch_odds_by_race_id(race_id, minutes_before_race)
+        if not odds_data:
+            print(f"[WARN] オッズ取得失敗: race_id={race_id}", file=sys.stderr)
+            sys.exit(1)
+        records = [odds_data]
+    else:
+        # 複数レース指定時は並列取得し、まとめて1回で登録
+        records = fetch_odds_batch(targets)
+        if not records:
+            print("[WARN] オッズ取得失敗: 全レース", file=sys.stderr)
+            sys.exit(1)
+
+    store_odds_to_bigquery(records)
+    nav.STATS.log_summary()
+    page_cache.log_summary()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,183 @@
+# scripts/live_sheet.py
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+
+import gspread
+from gspread.utils import rowcol_to_a1
+from google.cloud import bigquery
+
+import scripts.mirror as mirror
+from scripts.export_sheets import COLUMNS, query_day, build_grids, open_spreadsheet
+
+STATE_DIR = os.getenv("LIVE_SHEET_STATE_DIR", "data/state")
+MAX_PUSH_ATTEMPTS = 6
+
+# スナップショットのラベル → シート上の列
+LABEL_COLUMN = {
+    "1h_before": "odds_1h", "30m_before": "odds_30m",
+    "5m_before": "odds_5m", "post_race": "odds_post",
+}
+COL_INDEX = {col: i for i, (_, col) in enumerate(COLUMNS)}
+ODDS_COLS = [COL_INDEX[c] for c in ("odds_1h", "odds_30m", "odds_5m", "odds_post")]
+
+
+def _cell(row: list, c: int):
+    return row[c] if c < len(row) else ""
+
+
+def diff_ranges(title: str, old: list, new: list) -> list[dict]:
+    """
+    2つのグリッドを比較し、変わったセルだけを覆う最小限の矩形範囲を返す。
+    行内で連続する変更セルを1範囲にまとめ、同じ列幅の範囲が縦に続けば1つの矩形に併合する
+    （1列だけ更新した場合はレースごとに1範囲になる）。
+    新グリッドで消えたセルは "" で上書きする。
+    """
+    runs = []
+    for r in range(max(len(old), len(new))):
+        o = old[r] if r < len(old) else []
+        n = new[r] if r < len(new) else []
+        width = max(len(o), len(n))
+        c = 0
+        while c < width:
+            if _cell(o, c) == _cell(n, c):
+                c += 1
+                continue
+            start = c
+            while c < width and _cell(o, c) != _cell(n, c):
+                c += 1
+            runs.append((r, start, c, [_cell(n, i) for i in range(start, c)]))
+
+    rects = []
+    for r, c0, c1, values in runs:
+        last = rects[-1] if rects else None
+        if last and last["c0"] == c0 and last["c1"] == c1 and last["r1"] == r:
+            last["values"].append(values)
+            last["r1"] = r + 1
+        else:
+            rects.append({"r0": r, "r1": r + 1, "c0": c0, "c1": c1, "values": [values]})
+
+    return [
+        {
+            "range": f"'{title}'!{rowcol_to_a1(x['r0'] + 1, x['c0'] + 1)}:"
+                     f"{rowcol_to_a1(x['r1'], x['c1'])}",
+            "values": x["values"],
+        }
+        for x in rects
+    ]
+
+
+def push_updates(sh, data: list[dict]):
+    """
+    変更範囲を1回の values_batch_update で送る。
+    クォータ超過(429)・一時エラー(5xx)は指数バックオフで再試行する。
+    """
+    if not data:
+        return
+    for attempt in range(1, MAX_PUSH_ATTEMPTS + 1):
+        try:
+            sh.values_batch_update(body={"valueInputOption": "RAW", "data": data})
+            return
+        except gspread.exceptions.APIError as e:
+            status = getattr(e.response, "status_code", None)
+            if status not in (429, 500, 502, 503) or attempt == MAX_PUSH_ATTEMPTS:
+                raise
+            # 429 は分単位のクォータなので長めに待つ
+            base = 10.0 if status == 429 else 2.0
+            delay = min(base * (2 ** (attempt - 1)), 120) * random.uniform(0.8, 1.2)
+            logging.warning(f"[WARNING] Sheets API {status} → {delay:.0f}s 後に再送 ({attempt})")
+            time.sleep(delay)
+
+
+class LiveSheetUpdater:
+    """
+    開催日のスプレッドシートをスナップショットごとに差分更新する。
+
+    各タブのセル内容をローカルのモデル（STATE_DIR/live_sheet_<date>.json）として保持し、
+    apply_snapshot() でモデル上のオッズ列を書き換え、flush() でモデルと送信済み内容の
+    差分だけを1回の API 呼び出しで送る。送る量はシートの大きさではなく変更量に比例する。
+    """
+
+    def __init__(self, date_str: str, sh=None):
+        self.date_str = date_str
+        self.sh = sh or open_spreadsheet(date_str)
+        self.path = os.path.join(STATE_DIR, f"live_sheet_{date_str}.json")
+        self._lock = threading.Lock()
+        self.sent = {}      # タブ名 → 送信済みグリッド
+        self.model = {}     # タブ名 → 最新グリッド
+        self.race_tab = {}  # race_id → タブ名
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+            self.sent = state["sent"]
+            self.race_tab = state["race_tab"]
+            self.model = {t: [list(r) for r in g] for t, g in self.sent.items()}
+
+    def _save(self):
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"sent": self.sent, "race_tab": self.race_tab}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def seed(self, client: bigquery.Client = None):
+        """BigQuery から当日の全タブを組み立ててモデルに取り込み、差分を送る（開始時に1回）。"""
+        df = query_day(client or (None if mirror.use_mirror() else bigquery.Client()), self.date_str)
+        grids = build_grids(df)
+        with self._lock:
+            for (race_id, venue, race_no) in df[["race_id", "venue", "race_no"]] \
+                    .drop_duplicates().itertuples(index=False):
+                self.race_tab[race_id] = f"{venue}{race_no}R"
+            new_tabs = [t for t in grids if t not in self.sent]
+            if new_tabs:
+                existing = {ws.title for ws in self.sh.worksheets()}
+                add = [{"addSheet": {"properties": {
+                    "title": t,
+                    "gridProperties": {"rowCount": max(len(grids[t]), 50),
+                                       "columnCount": len(COLUMNS)},
+                }}} for t in new_tabs if t not in existing]
+                if add:
+                    self.sh.batch_update({"requests": add})
+                # 既存タブの内容はモデルに無いので一度だけ消してから全体を送る
+                self.sh.values_batch_clear(body={"ranges": [f"'{t}'" for t in new_tabs]})
+            for title, grid in grids.items():
+                self.model[title] = grid
+        self.flush()
+
+    def apply_snapshot(self, race_id: str, label: str, odds_by_horse: dict):
+        """1レース分のスナップショットをモデルのオッズ列と変動列に反映する（送信は flush で）。"""
+        col = LABEL_COLUMN.get(label)
+        title = self.race_tab.get(race_id)
+        if col is None or title is None:
+            return
+        with self._lock:
+            grid = self.model.get(title)
+            if grid is None:
+                return
+            for row in grid[1:]:
+                odds = odds_by_horse.get(_cell(row, COL_INDEX["horse_no"]))
+                if odds is None:
+                    continue
+                row[COL_INDEX[col]] = odds
+                # 変動は最初に取れたオッズ → 最新のオッズ
+                seen = [row[i] for i in ODDS_COLS if _cell(row, i) != ""]
+                if len(seen) >= 2:
+                    row[COL_INDEX["fluctuation_value"]] = seen[-1] - seen[0]
+                    row[COL_INDEX["fluctuation_rate"]] = (seen[-1] - seen[0]) / seen[0] * 100
+
+    def flush(self) -> int:
+        """全タブの差分を1回の values_batch_update にまとめて送り、送った範囲数を返す。"""
+        with self._lock:
+            data = []
+            for title, grid in self.model.items():
+                data.extend(diff_ranges(title, self.sent.get(title, []), grid))
+            push_updates(self.sh, data)
+            self.sent = {t: [list(r) for r in g] for t, g in self.model.items()}
+            self._save()
+        if data:
+            print(f"[INFO] シート差分 {len(data)} 範囲を更新しました")
+        return len(data)
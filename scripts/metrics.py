@@ -0,0 +1,222 @@
+# scripts/metrics.py
+
+import os
+import sys
+import json
+import time
+import atexit
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+
+JST = timezone(timedelta(hours=9))
+
+# --- 設定 ---
+# 出力先（カンマ区切り）。jsonl: 区間ごとのトレース / prom: Prometheus の textfile。空なら無効
+OUTPUTS = {s.strip() for s in os.getenv("METRICS", "").split(",") if s.strip()}
+METRICS_DIR = os.getenv("METRICS_DIR", "data/metrics")
+FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "15"))
+# .prom ファイル名・job ラベル（既定は起動したスクリプト名。プロセスごとに別ファイルになる）
+JOB = os.getenv("METRICS_JOB") or os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0]
+PREFIX = "jra_odds"
+
+ENABLED = bool(OUTPUTS)
+
+
+# --- 集計 ---
+class Registry:
+    """
+    段階ごとの所要時間（回数・合計・最大）とカウンタを保持する。
+    jsonl 出力時は区間ごとのイベントも貯め、flush() でまとめて書き出す。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}     # stage → [count, sum_seconds, max_seconds]
+        self.counters = {}   # (name, stage) → 値
+        self._events = []
+        self._flusher = None
+
+    def observe(self, stage: str, seconds: float, started: float = None, ok: bool = True,
+                attrs: dict = None):
+        with self._lock:
+            s = self.stages.get(stage)
+            if s is None:
+                s = self.stages[stage] = [0, 0.0, 0.0]
+            s[0] += 1
+            s[1] += seconds
+            if seconds > s[2]:
+                s[2] = seconds
+            if "jsonl" in OUTPUTS:
+                event = {"ts": started if started is not None else time.time() - seconds,
+                         "stage": stage, "ms": round(seconds * 1000, 3)}
+                if not ok:
+                    event["ok"] = False
+                if attrs:
+                    event.update(attrs)
+                self._events.append(event)
+        self._ensure_flusher()
+
+    def inc(self, name: str, n: float = 1, stage: str = None):
+        with self._lock:
+            key = (name, stage)
+            self.counters[key] = self.counters.get(key, 0) + n
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._run, name="metrics-flush",
+                                                     daemon=True)
+                    self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_SECONDS)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"[WARN] メトリクス書き出し失敗: {e}", file=sys.stderr)
+
+    # --- 出力 ---
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+            stages = {k: list(v) for k, v in self.stages.items()}
+            counters = dict(self.counters)
+        if not stages and not counters:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        if "jsonl" in OUTPUTS and events:
+            path = os.path.join(METRICS_DIR, f"trace_{datetime.now(JST).date().isoformat()}.jsonl")
+            with open(path, "a", encoding="utf-8") as f:
+                for e in events:
+                    f.write(json.dumps({"job": JOB, "pid": os.getpid(), **e}, ensure_ascii=False) + "\n")
+        if "prom" in OUTPUTS:
+            path = os.path.join(METRICS_DIR, f"{JOB}.prom")
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(render_prom(stages, counters))
+            os.replace(tmp, path)   # textfile collector が書きかけを読まないように置き換える
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in labels.items() if v is not None)
+
+
+def render_prom(stages: dict, counters: dict) -> str:
+    """Prometheus の textfile 形式（段階の所要時間は summary の _sum / _count と _max）。"""
+    lines = [f"# TYPE {PREFIX}_stage_seconds summary"]
+    for stage, (count, total, _) in sorted(stages.items()):
+        lbl = _labels(job=JOB, stage=stage)
+        lines.append(f"{PREFIX}_stage_seconds_sum{{{lbl}}} {total:.6f}")
+        lines.append(f"{PREFIX}_stage_seconds_count{{{lbl}}} {count}")
+    lines.append(f"# TYPE {PREFIX}_stage_seconds_max gauge")
+    for stage, (_, _, peak) in sorted(stages.items()):
+        lines.append(f"{PREFIX}_stage_seconds_max{{{_labels(job=JOB, stage=stage)}}} {peak:.6f}")
+    for name in sorted({n for n, _ in counters}):
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        for (n, stage), value in sorted(counters.items(), key=lambda kv: str(kv[0])):
+            if n == name:
+                lines.append(f"{PREFIX}_{name}_total{{{_labels(job=JOB, stage=stage)}}} {value:g}")
+    lines.append(f"{PREFIX}_last_flush_timestamp_seconds{{{_labels(job=JOB)}}} {time.time():.0f}")
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+# --- 計測 API（無効時はほぼ何もしない） ---
+class _Span:
+    __slots__ = ("stage", "attrs", "_t0", "_wall")
+
+    def __init__(self, stage: str, attrs: dict):
+        self.stage = stage
+        self.attrs = attrs
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        REGISTRY.observe(self.stage, time.perf_counter() - self._t0, self._wall,
+                         ok=exc_type is None, attrs=self.attrs)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(stage: str, **attrs):
+    """
+    with span("page.goto", race_id=rid): ... の区間の所要時間を stage ごとに集計する。
+    attrs（race_id など）は JSONL のトレースにだけ書き、Prometheus は stage 単位で集計する。
+    """
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(stage, attrs)
+
+
+def observe(stage: str, seconds: float, **attrs):
+    """計測済みの所要時間（発火遅延・ソース別応答時間など）を記録する。"""
+    if ENABLED:
+        REGISTRY.observe(stage, seconds, attrs=attrs)
+
+
+def inc(name: str, n: float = 1, stage: str = None):
+    """カウンタ（rows_parsed / parse_failures / retries / bytes_fetched / rows_written など）を加算する。"""
+    if ENABLED and n:
+        REGISTRY.inc(name, n, stage)
+
+
+def flush():
+    if ENABLED:
+        REGISTRY.flush()
+
+
+atexit.register(flush)
+
+
+# --- トレースの集計 ---
+def summarize(path: str, race_id: str = None):
+    """JSONL トレースを stage ごとに集計して表示する。race_id 指定時はそのレースの区間を時系列で表示。"""
+    with open(path, encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    if race_id:
+        for e in sorted((e for e in events if e.get("race_id") == race_id), key=lambda e: e["ts"]):
+            ts = datetime.fromtimestamp(e["ts"], JST).strftime("%H:%M:%S.%f")[:-3]
+            flag = "" if e.get("ok", True) else "  (失敗)"
+            print(f"{ts}  {e['job']:<14} {e['stage']:<24} {e['ms']:10.1f} ms{flag}")
+        return
+    by_stage = {}
+    for e in events:
+        by_stage.setdefault(e["stage"], []).append(e["ms"])
+    print(f"{'stage':<24} {'n':>7} {'p50_ms':>10} {'p95_ms':>10} {'max_ms':>10}")
+    for stage, ms in sorted(by_stage.items()):
+        ms.sort()
+        print(f"{stage:<24} {len(ms):>7} {ms[len(ms) // 2]:>10.1f} "
+              f"{ms[min(int(0.95 * len(ms)), len(ms) - 1)]:>10.1f} {ms[-1]:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSONL トレースの段階別集計")
+    parser.add_argument("--trace", help="トレースファイル（既定: 今日の trace_<date>.jsonl）")
+    parser.add_argument("--race_id", help="このレースの区間を時系列で表示")
+    args = parser.parse_args()
+    path = args.trace or os.path.join(METRICS_DIR, f"trace_{datetime.now(JST).date().isoformat()}.jsonl")
+    if not os.path.exists(path):
+        print(f"[ERROR] トレースがありません: {path}（METRICS=jsonl で実行してください）", file=sys.stderr)
+        sys.exit(1)
+    summarize(path, args.race_id)
@@ -0,0 +1,204 @@
+# scripts/mirror.py
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import date, timedelta
+
+import pandas as pd
+from google.cloud import bigquery
+
+import scripts.schema as schema
+
+# --- 設定 ---
+MIRROR_DIR = os.getenv("MIRROR_DIR", "data/mirror")
+# DATA_BACKEND=mirror で calc_fluctuation / export_sheets / export_race_schedule / scheduler の
+# 読み出しを BigQuery からローカルミラーに切り替える（書き込みは常に BigQuery）
+BACKEND = os.getenv("DATA_BACKEND", "bigquery")
+
+PARTITION_COL = "dt"   # パーティションのディレクトリ名（<table>/dt=YYYY-MM-DD/）
+
+# テーブル → (パーティション日付の式, FROM 句)。BigQuery 側で評価する。
+# 日付の式は各テーブルのパーティション列そのものなので、日付の絞り込みでスキャンが刈り込まれる
+TABLES = {
+    "race":             ("t.race_date", "`{ds}.race` t"),
+    "odds":             ("t.race_date", "`{ds}.odds` t"),
+    "odds_snapshot":    ("DATE(t.snapshot_at)", "`{ds}.odds_snapshot` t"),
+    "odds_ticks":       ("DATE(t.ts)", "`{ds}.odds_ticks` t"),
+    "odds_fluctuation": ("t.race_date", "`{ds}.odds_fluctuation` t"),
+    "race_results":     ("t.race_date", "`{ds}.race_results` t"),
+    "odds_exotic":      ("t.race_date", "`{ds}.odds_exotic` t"),
+}
+
+
+def use_mirror() -> bool:
+    return BACKEND == "mirror"
+
+
+def _manifest_path() -> str:
+    return os.path.join(MIRROR_DIR, "_manifest.json")
+
+
+def load_manifest() -> dict:
+    """テーブル → {日付: {"rows": 行数, "checksum": 行内容のチェックサム}}。ミラーに持っているパーティションの一覧。"""
+    if not os.path.exists(_manifest_path()):
+        return {}
+    with open(_manifest_path(), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest: dict):
+    os.makedirs(MIRROR_DIR, exist_ok=True)
+    tmp = f"{_manifest_path()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp, _manifest_path())
+
+
+def partition_path(table: str, date_str: str) -> str:
+    return os.path.join(MIRROR_DIR, table, f"{PARTITION_COL}={date_str}", "part.parquet")
+
+
+def write_partition(table: str, date_str: str, df: pd.DataFrame):
+    """1日分を Parquet に書き出す（同じ日付のパーティションは置き換え）。"""
+    path = partition_path(table, date_str)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+
+# --- 同期 ---
+def stale_dates(remote: dict, local: dict) -> list[str]:
+    """
+    BigQuery 側とミラー側の {日付: {"rows", "checksum"}} を比べ、取り込み直す日付を返す。
+    MERGE で行が置き換わっても行数は変わらないので、行数とチェックサムの両方を比べる
+    （行数だけを記録していた古い manifest の日付は一度取り込み直す）。
+    """
+    return sorted(d for d, v in remote.items() if local.get(d) != v)
+
+
+def sync(start: str, end: str, tables: list[str] = None, client: bigquery.Client = None) -> dict:
+    """
+    start〜end の各テーブルについて、BigQuery 側の日別の行数とチェックサム
+    （全列の FARM_FINGERPRINT の BIT_XOR。行の追加・削除・更新のどれでも変わる）を manifest と比べ、
+    新しい日付と内容が変わった日付のパーティションだけを取り込む。
+    取り込んだパーティション数をテーブルごとに返す。
+    """
+    client = client or bigquery.Client()
+    ds = f"{client.project}.{schema.DATASET}"
+    manifest = load_manifest()
+    pulled = {}
+    for table in tables or TABLES:
+        date_expr, from_clause = TABLES[table]
+        from_clause = from_clause.format(ds=ds)
+        counts_sql = f"""
+          SELECT d, COUNT(*) AS n, BIT_XOR(FARM_FINGERPRINT(TO_JSON_STRING(r))) AS checksum
+          FROM (SELECT {date_expr} AS d, t AS r FROM {from_clause})
+          WHERE d BETWEEN '{start}' AND '{end}'
+          GROUP BY d
+        """
+        remote = {row["d"].isoformat(): {"rows": row["n"], "checksum": row["checksum"]}
+                  for row in client.query(counts_sql)}
+        local = manifest.setdefault(table, {})
+        stale = stale_dates(remote, local)
+        pulled[table] = len(stale)
+        if not stale:
+            print(f"[INFO] {table}: 更新なし（{len(remote)} 日）")
+            continue
+
+        started = time.perf_counter()
+        dates = ", ".join(f"'{d}'" for d in stale)
+        df = client.query(f"""
+          SELECT t.*, {date_expr} AS _d
+          FROM {from_clause}
+          WHERE {date_expr} IN ({dates})
+        """).to_dataframe()
+        for d, part in df.groupby("_d"):
+            d = pd.Timestamp(d).date().isoformat()
+            write_partition(table, d, part.drop(columns="_d"))
+            # チェックサムは比較に使った値を記録する（取り込み中に変わっていれば次回また取り込む）
+            local[d] = {"rows": len(part), "checksum": remote[d]["checksum"]}
+        _save_manifest(manifest)
+        print(f"[INFO] {table}: {len(stale)} 日分 {len(df)} 行を取り込み "
+              f"({time.perf_counter() - started:.1f}s)")
+    return pulled
+
+
+# --- 読み出し ---
+_conn = None
+_conn_lock = threading.Lock()
+
+
+def connect():
+    """
+    ミラーの各テーブルをビューとして登録した DuckDB 接続を返す（プロセス内で共有）。
+    パーティションの日付は dt 列（DATE）として参照できる。時刻は BigQuery と同じく UTC で扱う。
+    """
+    global _conn
+    import duckdb
+    with _conn_lock:
+        if _conn is None:
+            _conn = duckdb.connect()
+            _conn.execute("SET TimeZone = 'UTC'")
+            for table in TABLES:
+                if not os.path.isdir(os.path.join(MIRROR_DIR, table)):
+                    continue
+                pattern = os.path.join(MIRROR_DIR, table, "*", "*.parquet")
+                _conn.execute(
+                    f"CREATE OR REPLACE VIEW {table} AS SELECT * FROM read_parquet("
+                    f"'{pattern}', hive_partitioning = true, union_by_name = true)")
+        return _conn
+
+
+def query(sql: str, params: list = None) -> pd.DataFrame:
+    """DuckDB の SQL でミラーを問い合わせる。"""
+    conn = connect()
+    with _conn_lock:
+        return conn.execute(sql, params or []).df()
+
+
+def read(table: str, date_str: str) -> pd.DataFrame:
+    """1日分のパーティションを DataFrame で読む（無ければ空）。"""
+    path = partition_path(table, date_str)
+    return pd.read_parquet(path) if os.path.exists(path) else pd.DataFrame()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="jra_odds のローカルミラー（Parquet / DuckDB）")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_sync = sub.add_parser("sync", help="BigQuery から新しいパーティションだけを取り込む")
+    p_sync.add_argument("--start", help="YYYY-MM-DD（既定: --days 日前）")
+    p_sync.add_argument("--end", help="YYYY-MM-DD（既定: 今日）")
+    p_sync.add_argument("--days", type=int, default=7)
+    p_sync.add_argument("--tables", nargs="*", choices=list(TABLES))
+    sub.add_parser("status", help="ミラーのパーティション一覧")
+    p_query = sub.add_parser("query", help="DuckDB の SQL を実行して表示")
+    p_query.add_argument("sql")
+    args = parser.parse_args()
+
+    if args.command == "sync":
+        end = args.end or date.today().isoformat()
+        start = args.start or (date.fromisoformat(end) - timedelta(days=args.days)).isoformat()
+        sync(start, end, args.tables)
+    elif args.command == "status":
+        manifest = load_manifest()
+        if not manifest:
+            print(f"[INFO] ミラーは空です（{MIRROR_DIR}）")
+        for table, parts in sorted(manifest.items()):
+            if parts:
+                rows = sum(v["rows"] if isinstance(v, dict) else v for v in parts.values())
+                print(f"[INFO] {table}: {len(parts)} 日 {rows} 行 "
+                      f"({min(parts)} 〜 {max(parts)})")
+    else:
+        started = time.perf_counter()
+        try:
+            df = query(args.sql)
+        except Exception as e:
+            print(f"[ERROR] {e}", file=sys.stderr)
+            sys.exit(1)
+        print(df.to_string(index=False))
+        print(f"[INFO] {len(df)} 行 ({(time.perf_counter() - started) * 1000:.0f} ms)")
@@ -0,0 +1,196 @@
+# scripts/navigation.py
+
+import os
+import sys
+import time
+import argparse
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+
+import scripts.metrics as metrics
+
+# --- 設定 ---
+NAV_TIMEOUT_MS = int(os.getenv("NAV_TIMEOUT_MS", "15000"))   # 1ページの goto〜セレクタ待ちの合計上限
+LEAN_PAGES     = os.getenv("NAV_LEAN", "1") == "1"            # 0 で従来どおり全リソースを読み込む
+# 描画・抽出に不要なリソース種別（スクリプトと XHR は出馬表・オッズの描画に必要なので通す）
+BLOCKED_TYPES = {"image", "media", "font", "stylesheet", "imageset", "texttrack", "manifest", "beacon"}
+# これ以外のホストへのリクエスト（広告・計測タグ）は種別に関わらず止める
+ALLOWED_HOSTS = [h.strip() for h in os.getenv("NAV_ALLOWED_HOSTS", "netkeiba.com").split(",")
+                 if h.strip()]
+
+
+# --- ページ単位の転送量・所要時間 ---
+class NavStats:
+    """ページ読み込みごとの転送バイト数・所要時間と、ブロックしたリクエスト数を直近 window 件記録する。"""
+
+    def __init__(self, window: int = 500):
+        self._lock = threading.Lock()
+        self._pages = deque(maxlen=window)
+        self.blocked = 0
+        self.failed = 0
+
+    def record(self, url: str, nbytes: int, ms: float):
+        with self._lock:
+            self._pages.append((url, nbytes, ms))
+
+    def count_blocked(self):
+        with self._lock:
+            self.blocked += 1
+
+    def count_failed(self):
+        with self._lock:
+            self.failed += 1
+
+    def summary(self) -> dict:
+        """{pages, failed, blocked, avg_kb, total_kb, p50_ms, p95_ms}。"""
+        with self._lock:
+            pages = list(self._pages)
+            blocked, failed = self.blocked, self.failed
+        if not pages:
+            return {"pages": 0, "failed": failed, "blocked": blocked}
+        ms = sorted(p[2] for p in pages)
+        total_kb = sum(p[1] for p in pages) / 1024
+        return {
+            "pages": len(pages), "failed": failed, "blocked": blocked,
+            "avg_kb": total_kb / len(pages), "total_kb": total_kb,
+            "p50_ms": ms[len(ms) // 2], "p95_ms": ms[min(int(0.95 * len(ms)), len(ms) - 1)],
+        }
+
+    def log_summary(self):
+        s = self.summary()
+        if not s["pages"]:
+            return
+        print(f"[INFO] ページ読み込み: {s['pages']} 件 (失敗 {s['failed']}) "
+              f"平均 {s['avg_kb']:.0f} KB / 計 {s['total_kb'] / 1024:.1f} MB, "
+              f"p50 {s['p50_ms']:.0f} ms, p95 {s['p95_ms']:.0f} ms, ブロック {s['blocked']} リクエスト")
+
+
+STATS = NavStats()
+
+
+# --- リソースの遮断 ---
+def should_block(resource_type: str, url: str) -> bool:
+    if resource_type in BLOCKED_TYPES:
+        return True
+    host = urlsplit(url).hostname or ""
+    if not host:   # data: / blob: など
+        return False
+    return not any(host == h or host.endswith("." + h) for h in ALLOWED_HOSTS)
+
+
+async def _route_async(route):
+    request = route.request
+    if should_block(request.resource_type, request.url):
+        STATS.count_blocked()
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def prepare_context_async(context):
+    """コンテキスト内の全ページで不要リソースを止める（BrowserPool が貸し出し時に呼ぶ）。"""
+    if LEAN_PAGES:
+        await context.route("**/*", _route_async)
+
+
+# --- 転送量の計測（Chromium の CDP で実際に受信したバイト数を数える） ---
+class _Meter:
+    def __init__(self):
+        self.bytes = 0
+
+    def on_finished(self, params):
+        self.bytes += int(params.get("encodedDataLength", 0))
+
+
+async def _attach_meter_async(page):
+    """計測を開始する。CDP が使えない（Chromium 以外）場合は None（所要時間だけ記録する）。"""
+    try:
+        session = await page.context.new_cdp_session(page)
+        await session.send("Network.enable")
+    except Exception:
+        return None, None
+    meter = _Meter()
+    session.on("Network.loadingFinished", meter.on_finished)
+    return session, meter
+
+
+# --- ナビゲーション ---
+async def navigate_async(page, url: str, selector: str, timeout_ms: float = NAV_TIMEOUT_MS):
+    """
+    url を開き、selector が現れるまで待つ。load イベント（全サブリソースの完了）は待たず、
+    DOMContentLoaded の後は目的の要素だけを待つ。goto とセレクタ待ちを合わせて timeout_ms で打ち切る。
+    転送バイト数と所要時間を STATS に記録する。
+    """
+    started = time.perf_counter()
+    session, meter = await _attach_meter_async(page)
+    try:
+        with metrics.span("page.goto", url=url):
+            await page.goto(url, wait_until="domcontentloaded", timeout=timeout_ms)
+        remaining = timeout_ms - (time.perf_counter() - started) * 1000
+        with metrics.span("page.wait_selector", url=url, selector=selector):
+            await page.wait_for_selector(selector, timeout=max(remaining, 1))
+    except Exception:
+        STATS.count_failed()
+        metrics.inc("failures", stage="page.navigate")
+        raise
+    finally:
+        if session is not None:
+            try:
+                await session.detach()
+            except Exception:
+                pass
+    nbytes = meter.bytes if meter else 0
+    STATS.record(url, nbytes, (time.perf_counter() - started) * 1000)
+    metrics.inc("bytes_fetched", nbytes, stage="page")
+
+
+# --- 比較計測 ---
+def compare(url: str, selector: str, iterations: int):
+    """同じページを全リソース読み込み（従来の load 待ち）と軽量読み込みで開き、転送量と時間を比べる。"""
+    global LEAN_PAGES
+    from scripts.browser_pool import BrowserPool
+
+    results = {}
+    for lean in (False, True):
+        LEAN_PAGES = lean
+        pool = BrowserPool()
+        stats = NavStats()
+
+        async def _load(page, lean=lean, stats=stats):
+            started = time.perf_counter()
+            session, meter = await _attach_meter_async(page)
+            if lean:
+                await page.goto(url, wait_until="domcontentloaded", timeout=NAV_TIMEOUT_MS)
+            else:
+                await page.goto(url, timeout=0)
+            await page.wait_for_selector(selector, timeout=NAV_TIMEOUT_MS)
+            if session is not None:
+                await session.detach()
+            stats.record(url, meter.bytes if meter else 0, (time.perf_counter() - started) * 1000)
+
+        for _ in range(iterations):
+            pool.run(_load)
+        pool.close()
+        results["lean" if lean else "full"] = stats.summary()
+
+    full, lean = results["full"], results["lean"]
+    print(f"[BENCH] url={url} selector={selector} iterations={iterations}")
+    for name, s in results.items():
+        print(f"[BENCH] {name:<4}: 平均 {s['avg_kb']:8.1f} KB, p50 {s['p50_ms']:7.0f} ms, "
+              f"p95 {s['p95_ms']:7.0f} ms")
+    if full["avg_kb"]:
+        print(f"[BENCH] 転送量 {lean['avg_kb'] / full['avg_kb']:.1%} / "
+              f"時間 {lean['p50_ms'] / full['p50_ms']:.1%}（lean / full, p50）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="軽量ページ読み込みの転送量・時間を従来方式と比較する")
+    parser.add_argument("--url", required=True)
+    parser.add_argument("--selector", default="table.Shutuba_Table")
+    parser.add_argument("--n", type=int, default=5, help="各方式の計測回数")
+    args = parser.parse_args()
+    if args.n < 1:
+        print("--n は 1 以上を指定してください", file=sys.stderr)
+        sys.exit(1)
+    compare(args.url, args.selector, args.n)
@@ -0,0 +1,409 @@
+# scripts/netkeiba.py
+
+import os
+import re
+import random
+import logging
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup
+
+import scripts.metrics as metrics
+import scripts.page_cache as page_cache
+
+# requests / Playwright で共通に使う User-Agent（browser_pool・odds_sources もここから読む）
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:115.0) "
+    "Gecko/20100101 Firefox/115.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:115.0) "
+    "Gecko/20100101 Firefox/115.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+    "AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.2 Safari/605.1.15",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Edg/115.0.0.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 OPR/85.0.4341.72",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 OPR/85.0.4341.72",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Vivaldi/5.3.2679.55",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Vivaldi/5.3.2679.55",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Brave/1.40.107",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Brave/1.40.107",
+]
+
+# NETKEIBA_HTTP=0 でブラウザ無しの高速パスを無効化（常に Playwright を使う）
+USE_HTTP_FAST_PATH = os.getenv("NETKEIBA_HTTP", "1") != "0"
+HTTP_TIMEOUT = float(os.getenv("NETKEIBA_HTTP_TIMEOUT", "10"))
+
+SHUTUBA_URL = "https://race.netkeiba.com/race/shutuba.html?race_id={race_id}"
+# 過去日にも使える静的なレース一覧（race_list.html はこれを JS で読み込んでいる）と結果ページ
+RACE_LIST_SUB_URL = "https://race.netkeiba.com/top/race_list_sub.html?kaisai_date={kaisai_date}"
+RESULT_URL = "https://race.netkeiba.com/race/result.html?race_id={race_id}"
+# オッズの JSON API。type は券種（1: 単勝, 4: 馬連, 5: ワイド, 6: 馬単, 7: 3連複, 8: 3連単）。
+# 出馬表の odds 欄は type=1 の結果を JS で埋めている
+ODDS_API_URL = (
+    "https://race.netkeiba.com/api/api_get_jra_odds.html"
+    "?pid=api_get_jra_odds&input=UTF-8&output=json"
+    "&race_id={race_id}&type={bet_type}&action=update&sort=odds&compress=0"
+)
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+ODDS_RE = re.compile(r"^\d+(\.\d+)?$")
+RACE_ID_RE = re.compile(r"race_id=(\d{12})")
+
+HORSE_ROW_SELECTOR = "table.Shutuba_Table tbody tr.HorseList"
+
+# --- Playwright 用の一括抽出スクリプト ---
+# 行ごとに query_selector / inner_text を呼ぶと1回ごとにブラウザとの往復が発生するため、
+# page.eval_on_selector_all(HORSE_ROW_SELECTOR, ...) で全行のテキストを1往復で受け取る。
+# 値は innerText のまま返し、strip と型変換は Python 側（horse_from_texts 等）で行う。
+HORSE_ROWS_JS = """
+rows => rows.map(r => {
+  const t = sel => { const el = r.querySelector(sel); return el ? el.innerText : ""; };
+  const name = r.querySelector("td.HorseInfo .HorseName a");
+  if (!name) return null;
+  const oddsTd = r.querySelector("td.Txt_R.Popular");
+  const oddsSpan = oddsTd ? oddsTd.querySelector("span") : null;
+  return [
+    t("td[class^='Waku'] span"),
+    t("td[class^='Umaban']"),
+    name.innerText,
+    t("td.Barei"),
+    t("td.Weight"),
+    t("td.Jockey a"),
+    t("td.Trainer a"),
+    oddsSpan ? oddsSpan.innerText : "",
+  ];
+})
+"""
+
+ODDS_ROWS_JS = """
+rows => rows.map(r => {
+  const num = r.querySelector("td[class^='Umaban']");
+  const oddsTd = r.querySelector("td.Txt_R.Popular");
+  const oddsSpan = oddsTd ? oddsTd.querySelector("span") : null;
+  return [num ? num.innerText : "", oddsSpan ? oddsSpan.innerText : ""];
+})
+"""
+
+
+# --- HTTP セッション（コネクションプール＋keep-alive） ---
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(
+        total=2,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "User-Agent": random.choice(USER_AGENTS),
+        "Accept-Language": "ja,en;q=0.8",
+        "Connection": "keep-alive",
+    })
+    return session
+
+
+SESSION = _build_session()
+
+
+def fetch_soup(url: str, session: requests.Session = None, timeout: float = None,
+               max_age: float = None, limiter=None) -> BeautifulSoup:
+    """
+    静的 HTML を取得してパースする。文字コード（EUC-JP 等）は meta から判定させる。
+    レース一覧・出馬表・結果ページはページキャッシュ（page_cache）を通す。
+    max_age は許容する古さ（秒）で、0 なら毎回再検証する（オッズなど変わり続ける値を読む場合）。
+    limiter（RateLimiter）を渡すと、実際に送る HTTP リクエストごとに wait() する。
+    """
+    session = session or SESSION
+    timeout = timeout or HTTP_TIMEOUT
+    cache = page_cache.get_cache()
+    with metrics.span("http.get", url=url):
+        if cache is not None:
+            content = cache.get(session, url, timeout, max_age, limiter)
+        else:
+            if limiter is not None:
+                limiter.wait()
+            resp = session.get(url, timeout=timeout)
+            resp.raise_for_status()
+            content = resp.content
+            metrics.inc("bytes_fetched", len(content), stage="http")
+    return BeautifulSoup(content, HTML_PARSER)
+
+
+def _text(el) -> str:
+    return el.get_text(strip=True) if el is not None else ""
+
+
+# --- テキスト → レコード変換（Playwright 経路と共通） ---
+def odds_entry(number_txt: str, odds_txt: str):
+    """馬番・単勝オッズのテキストを odds_list の1要素に変換する（不正値は None）。"""
+    number = int(number_txt) if number_txt.isdigit() else None
+    odds = float(odds_txt) if ODDS_RE.match(odds_txt) else None
+    if number is None or odds is None:
+        return None
+    return {
+        "number": number,
+        "odds": odds,
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+
+def horse_from_texts(waku_txt: str, num_txt: str, name: str, sex_age: str,
+                     wt_txt: str, jockey: str, trainer: str, odds_txt: str) -> dict:
+    """出馬表1行分のテキストを upsert_entries の horses 要素に変換する。"""
+    m_wt = re.search(r"(\d+)", wt_txt)
+    return {
+        "waku":     int(waku_txt) if waku_txt.isdigit() else None,
+        "number":   int(num_txt)   if num_txt.isdigit()   else None,
+        "name":     name,
+        "sex_age":  sex_age,
+        "weight":   int(m_wt.group(1)) if m_wt else None,
+        "jockey":   jockey,
+        "trainer":  trainer,
+        "expect_odds": float(odds_txt) if ODDS_RE.match(odds_txt) else None,
+    }
+
+
+def race_info_from_texts(race_no_text: str, race_name: str, data01: str,
+                         data02_spans: list[str]) -> dict:
+    """RaceNum / RaceName / RaceData01 / RaceData02 のテキストからレース情報を組み立てる。"""
+    m = re.search(r"(\d+)R", race_no_text)
+    race_no = int(m.group(1)) if m else 0
+
+    tm = re.search(r"(\d{1,2}:\d{2})発走", data01)
+    start_time = tm.group(1) if tm else ""
+    dm = re.search(r"([芝ダ]\d+m)", data01)
+    distance_text = dm.group(1) if dm else ""
+    surface = "芝" if distance_text.startswith("芝") else "ダ"
+    distance = int(re.sub(r"\D", "", distance_text)) if distance_text else 0
+
+    class_text = data02_spans[4] if len(data02_spans) > 4 else ""
+    entries = 0
+    for t in data02_spans:
+        if re.match(r"\d+頭", t):
+            entries = int(re.sub(r"\D", "", t))
+            break
+
+    return {
+        "race_no":        race_no,
+        "race_name":      race_name,
+        "start_time":     start_time,
+        "track_surface":  surface,
+        "distance_m":     distance,
+        "race_class":     class_text,
+        "entries_count":  entries,
+    }
+
+
+def horses_from_rows(rows: list) -> list[dict]:
+    """HORSE_ROWS_JS の結果を horses に変換する（null 行＝馬名なしはスキップ）。"""
+    horses = []
+    for cells in rows:
+        if cells is None:
+            logging.info("[INFO] データなし行をスキップ")
+            continue
+        horses.append(horse_from_texts(*[c.strip() for c in cells]))
+    return horses
+
+
+def odds_list_from_rows(rows: list) -> list[dict]:
+    """ODDS_ROWS_JS の結果を odds_list に変換する。"""
+    odds_list = []
+    for number_txt, odds_txt in rows:
+        entry = odds_entry(number_txt.strip(), odds_txt.strip())
+        if entry is not None:
+            odds_list.append(entry)
+    return odds_list
+
+
+# --- 静的 HTML パーサ ---
+def parse_odds_rows(soup: BeautifulSoup) -> list[dict]:
+    """Shutuba_Table の各行から単勝オッズを取り出す（JS 未実行のため空のことが多い）。"""
+    odds_list = []
+    for row in soup.select(HORSE_ROW_SELECTOR):
+        entry = odds_entry(
+            _text(row.select_one("td[class^='Umaban']")),
+            _text(row.select_one("td.Txt_R.Popular span")),
+        )
+        if entry is not None:
+            odds_list.append(entry)
+    return odds_list
+
+
+def parse_horses(soup: BeautifulSoup) -> list[dict]:
+    """Shutuba_Table から fetch_horses と同じ形式の horses を取り出す。"""
+    horses = []
+    for r in soup.select(HORSE_ROW_SELECTOR):
+        name_el = r.select_one("td.HorseInfo .HorseName a")
+        if name_el is None:
+            logging.info("[INFO] データなし行をスキップ")
+            continue
+        horses.append(horse_from_texts(
+            _text(r.select_one("td[class^='Waku'] span")),
+            _text(r.select_one("td[class^='Umaban']")),
+            _text(name_el),
+            _text(r.select_one("td.Barei")),
+            _text(r.select_one("td.Weight")),
+            _text(r.select_one("td.Jockey a")),
+            _text(r.select_one("td.Trainer a")),
+            _text(r.select_one("td.Txt_R.Popular span")),
+        ))
+    return horses
+
+
+def parse_race_info(soup: BeautifulSoup):
+    """RaceData01/02 ブロックからレース情報を取り出す。ブロックが無ければ None。"""
+    race_num = soup.select_one(".RaceNum")
+    data01 = soup.select_one(".RaceData01")
+    if race_num is None or data01 is None:
+        return None
+    data02 = soup.select_one(".RaceData02")
+    spans = [_text(sp) for sp in data02.select("span")] if data02 else []
+    return race_info_from_texts(
+        _text(race_num),
+        _text(soup.select_one("h1.RaceName")),
+        data01.get_text(),
+        spans,
+    )
+
+
+def parse_race_list(soup: BeautifulSoup) -> list[dict]:
+    """
+    race_list_sub.html から開催場ごとのレースを取り出す。
+    戻り値は [{"race_id", "venue"}]（ページ内の出現順・重複なし）。
+    """
+    races, seen = [], set()
+    for block in soup.select(".RaceList_DataList"):
+        parts = _text(block.select_one(".RaceList_DataTitle")).split()   # 例: ["3回","東京","4日目"]
+        venue = parts[1] if len(parts) > 1 else ""
+        for a in block.select("a[href*='race_id=']"):
+            m = RACE_ID_RE.search(a.get("href", ""))
+            if m and m.group(1) not in seen:
+                seen.add(m.group(1))
+                races.append({"race_id": m.group(1), "venue": venue})
+    return races
+
+
+# 結果表の列（All_Result_Table の td 順）
+RESULT_COLUMNS = ["rank", "waku", "number", "name", "sex_age", "kinryo", "jockey",
+                  "time", "margin", "popularity", "odds", "last3f", "trainer", "weight"]
+
+
+def parse_results(soup: BeautifulSoup) -> list[dict]:
+    """
+    結果ページの着順表を取り出す。着順が数字でない馬（取消・除外・中止）は finish_position=None。
+    各要素は horse_from_texts と同じキーに finish_position / popularity / final_odds を加えたもの。
+    """
+    out = []
+    for row in soup.select("#All_Result_Table tr.HorseList"):
+        tds = row.find_all("td")
+        if len(tds) < len(RESULT_COLUMNS):
+            continue
+        cells = dict(zip(RESULT_COLUMNS, (_text(td) for td in tds)))
+        # 厩舎欄は「栗東」「美浦」のラベルを除いた調教師名だけを使う
+        cells["trainer"] = _text(tds[RESULT_COLUMNS.index("trainer")].select_one("a")) or cells["trainer"]
+        horse = horse_from_texts(cells["waku"], cells["number"], cells["name"], cells["sex_age"],
+                                 cells["weight"], cells["jockey"], cells["trainer"], cells["odds"])
+        horse["finish_position"] = int(cells["rank"]) if cells["rank"].isdigit() else None
+        horse["popularity"] = int(cells["popularity"]) if cells["popularity"].isdigit() else None
+        horse["final_odds"] = horse["expect_odds"]
+        out.append(horse)
+    return out
+
+
+# --- オッズ API ---
+def fetch_odds_api(race_id: str, bet_type: int, session: requests.Session = None,
+                   timeout: float = None, limiter=None) -> dict:
+    """
+    オッズ API を叩き、券種 bet_type の {組番: [オッズ文字列, ...]} をそのまま返す。
+    組番は馬番2桁の連結（馬連なら "0103"、3連単なら "010305"）。データが無い場合は空 dict。
+    """
+    if limiter is not None:
+        limiter.wait()
+    with metrics.span("http.odds_api", race_id=race_id, bet_type=bet_type):
+        resp = (session or SESSION).get(ODDS_API_URL.format(race_id=race_id, bet_type=bet_type),
+                                        timeout=timeout or HTTP_TIMEOUT)
+    resp.raise_for_status()
+    metrics.inc("bytes_fetched", len(resp.content), stage="http")
+    data = resp.json().get("data")
+    if not isinstance(data, dict):
+        return {}
+    return (data.get("odds") or {}).get(str(bet_type)) or {}
+
+
+def fetch_win_odds_api(race_id: str, session: requests.Session = None,
+                       timeout: float = None, limiter=None) -> dict:
+    """
+    単勝オッズ API を叩き {馬番: オッズ文字列} を返す。
+    発売前などでデータが無い場合は空 dict。
+    """
+    odds = fetch_odds_api(race_id, 1, session, timeout, limiter)
+    return {str(int(k)): (v[0] if isinstance(v, list) and v else "") for k, v in odds.items()}
+
+
+# --- 高速パス（失敗・データ欠落時は空を返し、呼び出し側が Playwright にフォールバック） ---
+def fetch_odds_http(race_id: str) -> list[dict]:
+    if not USE_HTTP_FAST_PATH:
+        return []
+    try:
+        api_odds = fetch_win_odds_api(race_id)
+        odds_list = [e for e in (odds_entry(n, o) for n, o in api_odds.items()) if e]
+        if odds_list:
+            return sorted(odds_list, key=lambda e: e["number"])
+        return parse_odds_rows(fetch_soup(SHUTUBA_URL.format(race_id=race_id), max_age=0))
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(f"[WARNING] HTTP オッズ取得失敗 race_id={race_id}: {e}")
+        return []
+
+
+def fetch_race_detail_http(url: str, limiter=None):
+    """
+    出馬表を HTTP で取得し、fetch_race_detail と同じ形式の dict を返す。
+    RaceData ブロックや馬柱が静的 HTML に無ければ None。
+    limiter は出馬表・オッズ API の各リクエストの前に wait() する（最大2回）。
+    """
+    if not USE_HTTP_FAST_PATH:
+        return None
+    race_id = url.split("race_id=")[-1]
+    try:
+        soup = fetch_soup(url, limiter=limiter)
+        info = parse_race_info(soup)
+        horses = parse_horses(soup)
+        if info is None or not horses:
+            return None
+        # 予想オッズ欄は JS で埋まるため、空なら API の値で補う
+        if all(h["expect_odds"] is None for h in horses):
+            api_odds = fetch_win_odds_api(race_id, limiter=limiter)
+            for h in horses:
+                odds_txt = api_odds.get(str(h["number"]), "")
+                h["expect_odds"] = float(odds_txt) if ODDS_RE.match(odds_txt) else None
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(f"[WARNING] HTTP 出馬表取得失敗 {url}: {e}")
+        return None
+
+    return {
+        "race_id":    race_id,
+        **info,
+        "detail_url": url,
+        "horses":     horses,
+    }
@@ -0,0 +1,261 @@
+# scripts/odds_sources.py
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional
+
+import scripts.metrics as metrics
+import scripts.netkeiba as nk
+import scripts.navigation as nav
+from scripts.browser_pool import BrowserPool, get_pool
+
+# 1スナップショットあたりの締め切り（秒）。これを過ぎて返ってこないソースは捨てる
+DEADLINE_SECONDS = float(os.getenv("ODDS_DEADLINE_SECONDS", "8"))
+# 使うソース（カンマ区切り、先頭ほど優先）。jra: netkeiba のオッズ API（JRA 発表の単勝）/
+# netkeiba: 出馬表ページのオッズ列。出馬表のオッズ列も同じ API の値なので、両方を取って平均はしない。
+# 先頭のソースだけに問い合わせ、失敗・空、または FALLBACK_SECONDS 以内に返らなければ次のソースにも問い合わせる
+SOURCES = [s.strip() for s in os.getenv("ODDS_SOURCES", "jra,netkeiba").split(",") if s.strip()]
+FALLBACK_SECONDS = float(os.getenv("ODDS_FALLBACK_SECONDS", "3"))
+
+
+# --- ソース別レイテンシ統計 ---
+class SourceStats:
+    """ソースごとの応答時間と結果（ok / empty / error / late）を直近 window 件ずつ記録する。"""
+
+    def __init__(self, window: int = 500):
+        self._lock = threading.Lock()
+        self._window = window
+        self._sources = {}
+
+    def record(self, source: str, latency_ms: float, outcome: str, race_id: str = None):
+        with self._lock:
+            s = self._sources.setdefault(source, {
+                "latency_ms": deque(maxlen=self._window),
+                "ok": 0, "empty": 0, "error": 0, "late": 0,
+            })
+            s["latency_ms"].append(latency_ms)
+            s[outcome] += 1
+        metrics.observe(f"source.{source}", latency_ms / 1000, race_id=race_id, outcome=outcome)
+        if outcome != "ok":
+            metrics.inc("failures", stage=f"source.{source}.{outcome}")
+
+    def summary(self) -> dict:
+        """ソース → {n, ok, empty, error, late, p50_ms, p95_ms, max_ms}。"""
+        with self._lock:
+            out = {}
+            for source, s in self._sources.items():
+                lat = sorted(s["latency_ms"])
+                pick = (lambda q: lat[min(int(q * len(lat)), len(lat) - 1)]) if lat else (lambda q: None)
+                out[source] = {
+                    "n": sum(s[k] for k in ("ok", "empty", "error", "late")),
+                    "ok": s["ok"], "empty": s["empty"], "error": s["error"], "late": s["late"],
+                    "p50_ms": pick(0.5), "p95_ms": pick(0.95), "max_ms": lat[-1] if lat else None,
+                }
+            return out
+
+    def log_summary(self):
+        for source, s in self.summary().items():
+            if s["p50_ms"] is None:
+                continue
+            print(f"[INFO] オッズソース {source}: {s['n']} 件 (ok {s['ok']} / 空 {s['empty']} / "
+                  f"失敗 {s['error']} / 締め切り超過 {s['late']}) "
+                  f"p50 {s['p50_ms']:.0f} ms, p95 {s['p95_ms']:.0f} ms")
+
+
+STATS = SourceStats()
+
+
+# --- 各ソース（戻り値は odds_list 形式。取れなければ空リスト） ---
+def fetch_jra(race_id: str, deadline: float = DEADLINE_SECONDS) -> list[dict]:
+    """JRA 発表の単勝オッズ（netkeiba の api_get_jra_odds、JSON 1回）。"""
+    api_odds = nk.fetch_win_odds_api(race_id, timeout=deadline)
+    return sorted((e for e in (nk.odds_entry(n, o) for n, o in api_odds.items()) if e),
+                  key=lambda e: e["number"])
+
+
+async def _odds_from_page(page, race_id: str, url: str, deadline: float) -> list[dict]:
+    await nav.navigate_async(page, url, "table.Shutuba_Table", timeout_ms=deadline * 1000)
+    with metrics.span("parse.odds_rows", race_id=race_id):
+        rows = await page.eval_on_selector_all(nk.HORSE_ROW_SELECTOR, nk.ODDS_ROWS_JS)
+        return nk.odds_list_from_rows(rows)
+
+
+def fetch_netkeiba(race_id: str, deadline: float = DEADLINE_SECONDS,
+                   pool: Optional[BrowserPool] = None) -> list[dict]:
+    """netkeiba の出馬表ページに表示されているオッズ（静的 HTML → 描画後ページ）。jra が取れないときの予備。"""
+    started = time.perf_counter()
+    url = nk.SHUTUBA_URL.format(race_id=race_id)
+    if nk.USE_HTTP_FAST_PATH:
+        soup = nk.fetch_soup(url, timeout=deadline, max_age=0)
+        with metrics.span("parse.odds_html", race_id=race_id):
+            odds_list = nk.parse_odds_rows(soup)
+        if odds_list:
+            metrics.inc("rows_parsed", len(odds_list), stage="parse.odds_html")
+            return odds_list
+    # 描画はプロセスで共有するブラウザのスレッドで行う
+    remaining = max(deadline - (time.perf_counter() - started), 0.1)
+    odds_list = (pool or get_pool()).run(_odds_from_page, race_id, url, remaining, timeout=remaining)
+    metrics.inc("rows_parsed", len(odds_list), stage="parse.odds_rows")
+    return odds_list
+
+
+async def fetch_netkeiba_async(race_id: str, deadline: float = DEADLINE_SECONDS) -> list[dict]:
+    """
+    fetch_netkeiba の asyncio 版（fetch_odds_batch 用）。描画が必要なときだけ共有ブラウザのスレッドに
+    ページ処理を渡す（バッチごとに Chromium を起動しない）。
+    """
+    started = time.perf_counter()
+    url = nk.SHUTUBA_URL.format(race_id=race_id)
+    if nk.USE_HTTP_FAST_PATH:
+        soup = await asyncio.to_thread(nk.fetch_soup, url, None, deadline, 0)
+        with metrics.span("parse.odds_html", race_id=race_id):
+            odds_list = nk.parse_odds_rows(soup)
+        if odds_list:
+            metrics.inc("rows_parsed", len(odds_list), stage="parse.odds_html")
+            return odds_list
+    remaining = max(deadline - (time.perf_counter() - started), 0.1)
+    odds_list = await asyncio.wait_for(
+        asyncio.wrap_future(get_pool().submit(_odds_from_page, race_id, url, remaining)), remaining)
+    metrics.inc("rows_parsed", len(odds_list), stage="parse.odds_rows")
+    return odds_list
+
+
+# --- 統合 ---
+def _result(src: str = None, odds_list: list[dict] = None, requests: int = 0) -> dict:
+    """
+    採用したソースの odds_list と、ソース名 → {馬番: オッズ}、問い合わせたソース数（HTTP リクエスト数の目安）。
+    取れなければ odds_list は空。
+    """
+    odds_list = odds_list or []
+    return {
+        "odds_list": odds_list,
+        "sources": [src] if odds_list else [],
+        "by_source": {src: {e["number"]: e["odds"] for e in odds_list}} if odds_list else {},
+        "requests": requests,
+    }
+
+
+def _outcome(odds_list) -> str:
+    return "ok" if odds_list else "empty"
+
+
+# ソース呼び出し用の共有スレッド。締め切りを過ぎたソースは結果を捨てるだけで、
+# 呼び出しは各ソースのタイムアウト（締め切りまでの残り時間）で自然に終わる
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("ODDS_SOURCE_WORKERS", "8")),
+                               thread_name_prefix="odds-source")
+
+_FETCHERS = {"jra": fetch_jra, "netkeiba": fetch_netkeiba}
+
+
+def fetch_with_fallback(race_id: str, deadline: float = DEADLINE_SECONDS,
+                        sources: list[str] = None, fallback_after: float = FALLBACK_SECONDS) -> dict:
+    """
+    sources を優先順に1つずつ問い合わせ、最初に空でないオッズを返したソースを採用する。
+    次のソースは、それまでのソースがすべて失敗・空だったとき、または fallback_after 秒待っても
+    返らないときだけ問い合わせる（通常は1リクエスト）。全体は deadline 秒で打ち切る。
+    戻り値 {"odds_list", "sources", "by_source", "requests"}。
+    """
+    queue = list(sources or SOURCES)
+    started = time.perf_counter()
+    cutoff = started + deadline
+    pending, launched = {}, 0
+    next_launch = started
+
+    def _launch():
+        nonlocal launched, next_launch
+        src = queue.pop(0)
+        # 後から問い合わせるソースには締め切りまでの残り時間だけを渡す
+        fut = _executor.submit(_FETCHERS[src], race_id, cutoff - time.perf_counter())
+
+        def _done(f, src=src):
+            latency = (time.perf_counter() - started) * 1000
+            if f.exception() is not None:
+                STATS.record(src, latency, "error", race_id)
+                logging.warning(f"[WARNING] オッズソース {src} 失敗 race_id={race_id}: {f.exception()}")
+            elif time.perf_counter() > cutoff:
+                STATS.record(src, latency, "late", race_id)
+            else:
+                STATS.record(src, latency, _outcome(f.result()), race_id)
+        fut.add_done_callback(_done)
+        pending[fut] = src
+        launched += 1
+        next_launch = time.perf_counter() + fallback_after
+
+    while pending or queue:
+        now = time.perf_counter()
+        if now >= cutoff:
+            break
+        if queue and (not pending or now >= next_launch):
+            _launch()
+            continue
+        timeout = cutoff - now
+        if queue:
+            timeout = min(timeout, next_launch - now)
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for f in done:
+            src = pending.pop(f)
+            if f.exception() is None and f.result():
+                return _result(src, f.result(), launched)
+    return _result(requests=launched)
+
+
+async def fetch_with_fallback_async(race_id: str, deadline: float = DEADLINE_SECONDS,
+                                    sources: list[str] = None,
+                                    fallback_after: float = FALLBACK_SECONDS) -> dict:
+    """fetch_with_fallback の asyncio 版。netkeiba に切り替えたときだけ共有ブラウザを使う。"""
+    queue = list(sources or SOURCES)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    cutoff = started + deadline
+    pending, launched = {}, 0
+    next_launch = started
+
+    async def _timed(src):
+        remaining = cutoff - loop.time()
+        try:
+            if src == "netkeiba":
+                odds_list = await fetch_netkeiba_async(race_id, remaining)
+            else:
+                odds_list = await asyncio.to_thread(_FETCHERS[src], race_id, remaining)
+        except Exception as e:
+            STATS.record(src, (loop.time() - started) * 1000, "error", race_id)
+            logging.warning(f"[WARNING] オッズソース {src} 失敗 race_id={race_id}: {e}")
+            raise
+        STATS.record(src, (loop.time() - started) * 1000, _outcome(odds_list), race_id)
+        return odds_list
+
+    try:
+        while pending or queue:
+            now = loop.time()
+            if now >= cutoff:
+                break
+            if queue and (not pending or now >= next_launch):
+                src = queue.pop(0)
+                pending[asyncio.ensure_future(_timed(src))] = src
+                launched += 1
+                next_launch = loop.time() + fallback_after
+                continue
+            timeout = cutoff - now
+            if queue:
+                timeout = min(timeout, next_launch - now)
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                src = pending.pop(task)
+                if task.exception() is None and task.result():
+                    return _result(src, task.result(), launched)
+        return _result(requests=launched)
+    finally:
+        for task, src in pending.items():
+            if not task.done():
+                STATS.record(src, deadline * 1000, "late", race_id)
+            task.cancel()
+
+
+def tag(record: dict) -> str:
+    """ログ用のソース表記（例: 'jra'）。"""
+    return "+".join(record.get("sources") or []) or "none"
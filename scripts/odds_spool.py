@@ -0,0 +1,309 @@
+# scripts/odds_spool.py
+
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import sqlite3
+import argparse
+import threading
+
+from google.api_core.exceptions import Conflict, GoogleAPIError
+from google.cloud import bigquery
+
+import scripts.bq_merge as bq_merge
+import scripts.metrics as metrics
+
+# --- 設定 ---
+SPOOL_PATH          = os.getenv("ODDS_SPOOL_PATH", "data/spool/odds_spool.sqlite3")
+FLUSH_MAX_ROWS      = int(os.getenv("SPOOL_FLUSH_ROWS", "500"))       # この行数たまったら即 flush
+FLUSH_INTERVAL_SEC  = float(os.getenv("SPOOL_FLUSH_SECONDS", "30"))   # 最古の行がこの秒数を超えたら flush
+BATCH_MAX_ROWS      = int(os.getenv("SPOOL_BATCH_ROWS", "10000"))     # 1ロードジョブあたりの最大行数
+MAX_LOAD_ATTEMPTS   = 5   # 登録に失敗した回数がこれに達したバッチは 'failed' として隔離
+
+
+class OddsSpool:
+    """
+    スナップショットを BigQuery に送る前に書き込むローカルの追記専用スプール（SQLite WAL）。
+
+    ・append() はローカル書き込みのみで、BigQuery の可用性に依存しない
+    ・flush() はテーブルごとにバッチを切り出し、ロードジョブで一括登録する
+    ・バッチには決定的な job_id を割り当てて記録するため、flush 途中でプロセスが落ちても
+      再実行時に同じ job_id で問い合わせ、二重登録せずに完了を判定できる（exactly-once）
+    ・登録に失敗したバッチは試行回数を進めてそのテーブルの flush を打ち切り、残りのテーブルは続ける。
+      MAX_LOAD_ATTEMPTS 回失敗したバッチは隔離し、後続の行は新しいバッチで流す
+    ・自然キーを持つテーブル（odds_snapshot・race など）は追記せず bq_merge で upsert する。
+      同じラベルを取り直した・バックフィルを再実行した場合も行は重複しない
+    複数プロセス（CLI と scheduler）から同じファイルへ同時に追記してよい。
+    """
+
+    def __init__(self, path: str = SPOOL_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS spool (
+              id         INTEGER PRIMARY KEY AUTOINCREMENT,
+              table_id   TEXT NOT NULL,
+              payload    TEXT NOT NULL,
+              created_at REAL NOT NULL,
+              batch_id   TEXT
+            );
+            CREATE INDEX IF NOT EXISTS spool_pending ON spool (table_id, batch_id, id);
+            CREATE TABLE IF NOT EXISTS batches (
+              batch_id   TEXT PRIMARY KEY,
+              table_id   TEXT NOT NULL,
+              attempt    INTEGER NOT NULL DEFAULT 0,
+              rows       INTEGER NOT NULL,
+              state      TEXT NOT NULL,          -- 'pending' / 'done' / 'failed'
+              created_at REAL NOT NULL,
+              done_at    REAL,
+              job_id     TEXT                    -- 投入済みのロードジョブ（結果未確認）
+            );
+        """)
+        cols = [c[1] for c in self._conn.execute("PRAGMA table_info(batches)")]
+        if "job_id" not in cols:
+            self._conn.execute("ALTER TABLE batches ADD COLUMN job_id TEXT")
+
+    # --- 追記 ---
+    def append(self, table_id: str, rows: list[dict]) -> int:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "INSERT INTO spool (table_id, payload, created_at) VALUES (?, ?, ?)",
+                [(table_id, json.dumps(r, ensure_ascii=False), now) for r in rows],
+            )
+            self._conn.execute("COMMIT")
+        return len(rows)
+
+    # --- 状態確認 ---
+    def pending(self) -> dict:
+        """テーブルごとの未登録行数と最古行の経過秒数を返す（隔離済みバッチは除く）。"""
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT table_id, COUNT(*), MIN(created_at) FROM spool "
+                "WHERE batch_id IS NULL OR batch_id NOT IN "
+                "  (SELECT batch_id FROM batches WHERE state = 'failed') "
+                "GROUP BY table_id")
+            now = time.time()
+            return {t: {"rows": n, "age_sec": now - oldest} for t, n, oldest in cur.fetchall()}
+
+    def should_flush(self, max_rows: int = FLUSH_MAX_ROWS,
+                     interval: float = FLUSH_INTERVAL_SEC) -> bool:
+        stats = self.pending().values()
+        return any(s["rows"] >= max_rows or s["age_sec"] >= interval for s in stats)
+
+    # --- バッチ管理 ---
+    def _claim_batch(self, table_id: str):
+        """未完了のバッチがあればそれを、無ければ未割当の行から新しいバッチを切り出す。"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT batch_id, attempt, job_id FROM batches WHERE table_id = ? AND state = 'pending' "
+                "ORDER BY created_at LIMIT 1", (table_id,)).fetchone()
+            if row is None:
+                batch_id = uuid.uuid4().hex
+                n = self._conn.execute(
+                    "UPDATE spool SET batch_id = ? WHERE id IN ("
+                    "  SELECT id FROM spool WHERE table_id = ? AND batch_id IS NULL "
+                    "  ORDER BY id LIMIT ?)", (batch_id, table_id, BATCH_MAX_ROWS)).rowcount
+                if n == 0:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "INSERT INTO batches (batch_id, table_id, rows, state, created_at) "
+                    "VALUES (?, ?, ?, 'pending', ?)", (batch_id, table_id, n, time.time()))
+                row = (batch_id, 0, None)
+            self._conn.execute("COMMIT")
+            payloads = self._conn.execute(
+                "SELECT payload FROM spool WHERE batch_id = ? ORDER BY id", (row[0],)).fetchall()
+        return row[0], row[1], row[2], [json.loads(p) for (p,) in payloads]
+
+    def _finish_batch(self, batch_id: str):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM spool WHERE batch_id = ?", (batch_id,))
+            self._conn.execute(
+                "UPDATE batches SET state = 'done', done_at = ? WHERE batch_id = ?",
+                (time.time(), batch_id))
+            self._conn.execute("COMMIT")
+
+    def _set_job_id(self, batch_id: str, job_id: str = None):
+        with self._lock:
+            self._conn.execute("UPDATE batches SET job_id = ? WHERE batch_id = ?", (job_id, batch_id))
+
+    def _bump_attempt(self, batch_id: str):
+        """失敗を1回数え、MAX_LOAD_ATTEMPTS に達したら隔離する。隔離したら True。"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE batches SET attempt = attempt + 1, "
+                "  state = CASE WHEN attempt + 1 >= ? THEN 'failed' ELSE state END "
+                "WHERE batch_id = ?", (MAX_LOAD_ATTEMPTS, batch_id))
+            (state,) = self._conn.execute(
+                "SELECT state FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+        return state == "failed"
+
+    def failed_batches(self) -> list[tuple]:
+        """隔離されたバッチ (batch_id, table_id, rows) の一覧。行はスプールに残っている。"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT batch_id, table_id, rows FROM batches WHERE state = 'failed'").fetchall()
+
+    def _load_batch(self, client: bigquery.Client, table_id: str,
+                    batch_id: str, attempt: int, job_id: str, rows: list[dict]):
+        name = bq_merge.keyed(table_id)
+        if name is not None:
+            self._merge_batch(client, name, batch_id, rows)
+            return
+        # 結果を確認できていないジョブがあれば同じ job_id で問い合わせる（二重登録しない）
+        if job_id is None:
+            job_id = f"odds_spool_{batch_id}_{attempt}"
+            self._set_job_id(batch_id, job_id)
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        with metrics.span("bq.load", table=table_id.rsplit(".", 1)[-1], rows=len(rows)):
+            try:
+                job = client.load_table_from_json(rows, table_id, job_id=job_id, job_config=job_config)
+            except Conflict:
+                # 前回の flush で投入済み → 結果だけ確認する
+                job = client.get_job(job_id)
+            try:
+                job.result()
+            except GoogleAPIError:
+                if job.done() and job.error_result:
+                    # 失敗したロードジョブは1行も書き込まないので、次回は別 job_id で出し直す
+                    self._set_job_id(batch_id, None)
+                raise
+        self._finish_batch(batch_id)
+        metrics.inc("rows_written", len(rows), stage="bq.load")
+
+    def _merge_batch(self, client: bigquery.Client, name: str, batch_id: str, rows: list[dict]):
+        # MERGE は何度流しても結果が同じなので job_id での重複判定は要らない
+        result = bq_merge.merge_rows(client, name, rows)
+        self._finish_batch(batch_id)
+        print(f"[INFO] スプール: {bq_merge.describe(name, result)}")
+
+    def flush(self, client: bigquery.Client = None) -> int:
+        """
+        スプール内の全行をロードジョブで登録し、登録した行数を返す。
+        失敗したバッチは試行回数を進め、そのテーブルの残り（MERGE の順序を崩さないよう後続バッチも）は
+        次回に回して他のテーブルを続ける（隔離したときだけ後続バッチを続ける）。
+        失敗があれば全テーブルを回った後に最初の例外を送出する。
+        """
+        client = client or bigquery.Client()
+        with self._lock:
+            tables = [t for (t,) in self._conn.execute(
+                "SELECT DISTINCT table_id FROM spool WHERE batch_id IS NULL OR batch_id NOT IN "
+                "  (SELECT batch_id FROM batches WHERE state = 'failed')")]
+        total, errors = 0, []
+        for table_id in tables:
+            while True:
+                claimed = self._claim_batch(table_id)
+                if claimed is None:
+                    break
+                batch_id, attempt, job_id, rows = claimed
+                try:
+                    self._load_batch(client, table_id, batch_id, attempt, job_id, rows)
+                except Exception as e:
+                    metrics.inc("failures", stage="spool.flush")
+                    quarantined = self._bump_attempt(batch_id)
+                    logging.warning(f"[WARNING] スプール登録失敗 {table_id} バッチ {batch_id} "
+                                    f"({attempt + 1}/{MAX_LOAD_ATTEMPTS}"
+                                    f"{'、隔離' if quarantined else ''}): {e}")
+                    errors.append(e)
+                    if quarantined:
+                        continue   # 隔離したバッチの後続は新しいバッチで流す
+                    break
+                total += len(rows)
+                print(f"[INFO] スプールから {len(rows)} 行を登録しました → {table_id}")
+        if errors:
+            raise errors[0]
+        return total
+
+
+class SpoolFlusher(threading.Thread):
+    """
+    バックグラウンドでスプールを監視し、行数または経過時間のしきい値を超えたら flush する。
+    失敗時は次回の周期で再試行する（行はスプールに残る）。
+    """
+
+    def __init__(self, spool: OddsSpool, max_rows: int = FLUSH_MAX_ROWS,
+                 interval: float = FLUSH_INTERVAL_SEC, poll: float = 5.0):
+        super().__init__(name="odds-spool-flusher", daemon=True)
+        self.spool = spool
+        self.max_rows = max_rows
+        self.interval = interval
+        self.poll = poll
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._client = None
+
+    def notify(self):
+        """追記直後に呼ぶと、しきい値判定をすぐに行う。"""
+        self._wake.set()
+
+    def _flush_once(self):
+        try:
+            self._client = self._client or bigquery.Client()
+            self.spool.flush(self._client)
+        except Exception as e:
+            logging.warning(f"[WARNING] スプール flush 失敗（次回再試行）: {e}")
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.poll)
+            self._wake.clear()
+            if self.spool.should_flush(self.max_rows, self.interval):
+                self._flush_once()
+
+    def stop(self):
+        """停止し、残っている行を最後にまとめて flush する。"""
+        self._stopping.set()
+        self._wake.set()
+        self.join()
+        self._flush_once()
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def get_spool() -> OddsSpool:
+    """プロセス内で共有するスプールを返す。"""
+    global _spool
+    with _spool_lock:
+        if _spool is None:
+            _spool = OddsSpool()
+        return _spool
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["status", "flush"])
+    args = parser.parse_args()
+
+    spool = get_spool()
+    if args.command == "status":
+        stats = spool.pending()
+        if not stats:
+            print("[INFO] スプールは空です")
+        for table_id, s in stats.items():
+            print(f"[INFO] {table_id}: {s['rows']} 行 (最古 {s['age_sec']:.0f} 秒前)")
+        for batch_id, table_id, rows in spool.failed_batches():
+            print(f"[WARN] 隔離中のバッチ {batch_id}: {table_id} {rows} 行")
+    else:
+        try:
+            n = spool.flush()
+        except GoogleAPIError as e:
+            print(f"[ERROR] flush 失敗: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"[INFO] 合計 {n} 行を登録しました")
@@ -0,0 +1,183 @@
+# scripts/odds_ticks.py
+
+import os
+import argparse
+import threading
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import bigquery
+
+import scripts.schema as schema
+
+# キーフレーム（全頭のオッズ）を挟む間隔。どちらかに達したら次のティックをキーフレームにする
+KEYFRAME_EVERY   = int(os.getenv("TICK_KEYFRAME_EVERY", "20"))      # ティック数
+KEYFRAME_SECONDS = float(os.getenv("TICK_KEYFRAME_SECONDS", "600"))  # 経過秒数
+
+JST = timezone(timedelta(hours=9))
+
+
+class TickEncoder:
+    """
+    fetch_odds のレコード（odds_list に馬ごとの timestamp を持つ形式）を差分ティックに変換する。
+
+    ティックは1スナップショットにつき1行で、タイムスタンプは1つだけ持ち、
+    前回からオッズが変わった馬だけを changes に入れる。消えた馬は odds=None で表す。
+    KEYFRAME_EVERY ティックまたは KEYFRAME_SECONDS 秒ごとに全頭を入れたキーフレームを出し、
+    前回から何も変わっていないスナップショットはキーフレーム時以外は出力しない。
+    レースごとの直前の状態はメモリにだけ持つので、プロセス再起動後の最初のティックは
+    必ずキーフレームになる。
+    """
+
+    def __init__(self, keyframe_every: int = KEYFRAME_EVERY,
+                 keyframe_seconds: float = KEYFRAME_SECONDS):
+        self.keyframe_every = keyframe_every
+        self.keyframe_seconds = keyframe_seconds
+        self._lock = threading.Lock()
+        self._races = {}   # race_id → {"odds", "seq", "since_key", "key_ts"}
+
+    def encode(self, record: dict):
+        """1レコードを1ティックに変換する。出力不要なら None。"""
+        odds_list = record["odds_list"]
+        if not odds_list:
+            return None
+        ts = max(datetime.fromisoformat(o["timestamp"]) for o in odds_list)
+        odds = {o["number"]: o["odds"] for o in odds_list}
+
+        with self._lock:
+            state = self._races.get(record["race_id"])
+            keyframe = (
+                state is None
+                or state["since_key"] + 1 >= self.keyframe_every
+                or (ts - state["key_ts"]).total_seconds() >= self.keyframe_seconds
+            )
+            if keyframe:
+                changes = sorted(odds.items())
+            else:
+                prev = state["odds"]
+                changes = sorted(
+                    [(n, v) for n, v in odds.items() if prev.get(n) != v]
+                    + [(n, None) for n in prev if n not in odds]
+                )
+                if not changes:
+                    return None
+
+            seq = state["seq"] + 1 if state else 0
+            self._races[record["race_id"]] = {
+                "odds": odds,
+                "seq": seq,
+                "since_key": 0 if keyframe else state["since_key"] + 1,
+                "key_ts": ts if keyframe else state["key_ts"],
+            }
+        return {
+            "race_id":             record["race_id"],
+            "seq":                 seq,
+            "ts":                  ts.astimezone(timezone.utc).isoformat(),
+            "minutes_before_race": record.get("minutes_before_race"),
+            "keyframe":            keyframe,
+            "changes":             [{"number": n, "odds": v} for n, v in changes],
+        }
+
+
+# --- 読み出し ---
+def _ts(tick: dict) -> datetime:
+    ts = tick["ts"]
+    return ts if isinstance(ts, datetime) else datetime.fromisoformat(ts)
+
+
+def _apply(ticks: list[dict]):
+    odds = None
+    for tick in sorted(ticks, key=lambda t: (_ts(t), t["seq"])):
+        if tick["keyframe"]:
+            odds = {}
+        elif odds is None:
+            continue
+        for c in tick["changes"]:
+            if c["odds"] is None:
+                odds.pop(c["number"], None)
+            else:
+                odds[c["number"]] = c["odds"]
+        yield tick, dict(odds)
+
+
+def replay(ticks: list[dict]):
+    """
+    1レース分のティックを時系列順に適用し、(時刻, {馬番: オッズ}) を順に返す。
+    最初のキーフレームより前のティックは読み飛ばす。
+    """
+    for tick, odds in _apply(ticks):
+        yield _ts(tick), odds
+
+
+def odds_at(ticks: list[dict], at: datetime) -> dict:
+    """
+    1レース分のティックから、時刻 at 時点の全頭のオッズ {馬番: オッズ} を復元する。
+    at 以前の最後のキーフレームから差分を当てるだけで、それより前は読まない。
+    at より前にキーフレームが無ければ空 dict。
+    """
+    ordered = sorted(ticks, key=lambda t: (_ts(t), t["seq"]))
+    end = bisect_right([_ts(t) for t in ordered], at)
+    start = next((i for i in range(end - 1, -1, -1) if ordered[i]["keyframe"]), None)
+    if start is None:
+        return {}
+    state = {}
+    for _, state in replay(ordered[start:end]):
+        pass
+    return state
+
+
+def to_odds_records(ticks: list[dict]) -> list[dict]:
+    """
+    ティックを従来の fetch_odds レコード形式（jra_odds.odds の行）に展開する。
+    各ティック時点の全頭を、そのティックの時刻で odds_list に並べる。
+    """
+    by_race = {}
+    for t in ticks:
+        by_race.setdefault(t["race_id"], []).append(t)
+    records = []
+    for race_id, race_ticks in by_race.items():
+        for tick, odds in _apply(race_ticks):
+            ts = _ts(tick).isoformat()
+            records.append({
+                "race_id": race_id,
+                "minutes_before_race": tick.get("minutes_before_race"),
+                "odds_list": [
+                    {"number": n, "odds": v, "timestamp": ts} for n, v in sorted(odds.items())
+                ],
+            })
+    return records
+
+
+# --- BigQuery ---
+def load_ticks(client: bigquery.Client, race_id: str, date_str: str = None) -> list[dict]:
+    """1レース分のティックを BigQuery から読む。開催日（日本時間）が分かれば ts のパーティションを絞る。"""
+    day = ""
+    if date_str:
+        day = (f"AND ts >= TIMESTAMP('{date_str}', 'Asia/Tokyo') "
+               f"AND ts < TIMESTAMP(DATE_ADD('{date_str}', INTERVAL 1 DAY), 'Asia/Tokyo')")
+    sql = f"""
+      SELECT race_id, seq, ts, minutes_before_race, keyframe, changes
+      FROM `{schema.table_id("odds_ticks", client.project)}`
+      WHERE race_id = '{race_id}' {day}
+      ORDER BY ts, seq
+    """
+    return [dict(row) for row in client.query(sql)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--race_id", required=True)
+    parser.add_argument("--at", help="ISO 形式の時刻。省略時は全ティックを展開して表示")
+    args = parser.parse_args()
+
+    if args.at:
+        at = datetime.fromisoformat(args.at)
+        if at.tzinfo is None:   # タイムゾーン無しは日本時間として扱う
+            at = at.replace(tzinfo=JST)
+        ticks = load_ticks(bigquery.Client(), args.race_id, at.astimezone(JST).date().isoformat())
+        for number, odds in sorted(odds_at(ticks, at).items()):
+            print(f"{number:>2}: {odds}")
+    else:
+        ticks = load_ticks(bigquery.Client(), args.race_id)
+        for ts, odds in replay(ticks):
+            print(ts.isoformat(), " ".join(f"{n}:{v}" for n, v in sorted(odds.items())))
@@ -0,0 +1,221 @@
+# scripts/page_cache.py
+
+import os
+import re
+import time
+import zlib
+import sqlite3
+import argparse
+import threading
+
+import scripts.metrics as metrics
+
+# --- 設定 ---
+CACHE_ENABLED = os.getenv("PAGE_CACHE", "1") == "1"
+CACHE_PATH    = os.getenv("PAGE_CACHE_PATH", "data/cache/pages.sqlite3")
+CACHE_MAX_MB  = float(os.getenv("PAGE_CACHE_MAX_MB", "200"))   # 圧縮後の合計サイズ上限（超えたら古い順に削除）
+
+# URL → 鮮度の上限（秒）。上から順に最初に一致したものを使い、どれにも一致しない URL はキャッシュしない。
+# 0 は「毎回再検証」: ETag / Last-Modified があれば条件付き GET（304 なら本文は送られない）
+TTL_RULES = [
+    (re.compile(r"/top/race_list"),       int(os.getenv("PAGE_CACHE_TTL_LIST", "600"))),
+    (re.compile(r"/race/shutuba\.html"),  int(os.getenv("PAGE_CACHE_TTL_SHUTUBA", "21600"))),
+    (re.compile(r"/race/result\.html"),   int(os.getenv("PAGE_CACHE_TTL_RESULT", "0"))),
+]
+
+
+def ttl_for(url: str):
+    """URL の既定の鮮度上限（秒）。キャッシュ対象外なら None。"""
+    for pattern, ttl in TTL_RULES:
+        if pattern.search(url):
+            return ttl
+    return None
+
+
+class PageCache:
+    """
+    URL 単位のディスクキャッシュ（SQLite WAL、本文は zlib 圧縮）。
+
+    ・鮮度上限内ならネットワークに出ずに保存済みの本文を返す
+    ・期限切れで ETag / Last-Modified があれば条件付き GET で再検証し、304 なら保存済みの本文を使う
+    ・合計サイズが CACHE_MAX_MB を超えたら最終参照が古い順に削除する（LRU）
+    複数スレッド・複数プロセス（scheduler と CLI）から同じファイルを使ってよい。
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = int(CACHE_MAX_MB * 1024 * 1024)):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+              url           TEXT PRIMARY KEY,
+              body          BLOB NOT NULL,     -- zlib 圧縮
+              size          INTEGER NOT NULL,  -- 圧縮後のバイト数
+              etag          TEXT,
+              last_modified TEXT,
+              fetched_at    REAL NOT NULL,     -- 取得または再検証した時刻
+              accessed_at   REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pages_lru ON pages (accessed_at);
+        """)
+        self._stores = 0
+        self.stats = {"hit": 0, "revalidated": 0, "miss": 0, "bytes_saved": 0}
+
+    # --- 読み書き ---
+    def _lookup(self, url: str):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT body, etag, last_modified, fetched_at FROM pages WHERE url = ?",
+                (url,)).fetchone()
+
+    def _touch(self, url: str, revalidated: bool):
+        now = time.time()
+        with self._lock:
+            if revalidated:
+                self._conn.execute("UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?",
+                                   (now, now, url))
+            else:
+                self._conn.execute("UPDATE pages SET accessed_at = ? WHERE url = ?", (now, url))
+
+    def store(self, url: str, content: bytes, etag: str = None, last_modified: str = None):
+        body = zlib.compress(content)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, body, len(body), etag, last_modified, now, now))
+            self._stores += 1
+            if self._stores % 20 == 0:
+                self._evict()
+
+    def _evict(self):
+        """合計サイズが上限を超えていれば、上限の 9 割まで最終参照の古い順に消す（ロック内で呼ぶ）。"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target, removed = total - int(self.max_bytes * 0.9), 0
+        victims = []
+        for url, size in self._conn.execute("SELECT url, size FROM pages ORDER BY accessed_at"):
+            victims.append((url,))
+            removed += size
+            if removed >= target:
+                break
+        self._conn.executemany("DELETE FROM pages WHERE url = ?", victims)
+        print(f"[INFO] ページキャッシュ: {len(victims)} 件 {removed / 1024 / 1024:.1f} MB を削除")
+
+    # --- 取得 ---
+    def get(self, session, url: str, timeout: float, max_age: float = None, limiter=None) -> bytes:
+        """
+        url の本文を返す。max_age（秒）を省略すると TTL_RULES の値を使う。
+        キャッシュ対象外の URL は毎回そのまま取得する。HTTP エラーは raise_for_status で送出する。
+        limiter（RateLimiter）は実際に HTTP リクエストを送るときだけ wait() する（キャッシュヒットは数えない）。
+        """
+        ttl = max_age if max_age is not None else ttl_for(url)
+        if ttl is None:
+            if limiter is not None:
+                limiter.wait()
+            resp = session.get(url, timeout=timeout)
+            resp.raise_for_status()
+            metrics.inc("bytes_fetched", len(resp.content), stage="http")
+            return resp.content
+
+        entry = self._lookup(url)
+        if entry is not None and time.time() - entry[3] < ttl:
+            content = zlib.decompress(entry[0])
+            self._touch(url, revalidated=False)
+            self._count("hit", len(content))
+            return content
+
+        headers = {}
+        if entry is not None:
+            if entry[1]:
+                headers["If-None-Match"] = entry[1]
+            if entry[2]:
+                headers["If-Modified-Since"] = entry[2]
+        if limiter is not None:
+            limiter.wait()
+        resp = session.get(url, timeout=timeout, headers=headers)
+        if resp.status_code == 304 and entry is not None:
+            content = zlib.decompress(entry[0])
+            self._touch(url, revalidated=True)
+            self._count("revalidated", len(content))
+            return content
+        resp.raise_for_status()
+        metrics.inc("bytes_fetched", len(resp.content), stage="http")
+        self.store(url, resp.content, resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+        self._count("miss", 0)
+        return resp.content
+
+    def _count(self, outcome: str, saved: int):
+        with self._lock:
+            self.stats[outcome] += 1
+            self.stats["bytes_saved"] += saved
+        metrics.inc(f"cache_{outcome}", stage="page_cache")
+        if saved:
+            metrics.inc("bytes_saved", saved, stage="page_cache")
+
+    # --- 集計 ---
+    def summary(self) -> dict:
+        with self._lock:
+            n, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+            return {**self.stats, "entries": n, "size_mb": size / 1024 / 1024}
+
+    def log_summary(self):
+        s = self.summary()
+        if s["hit"] + s["revalidated"] + s["miss"] == 0:
+            return
+        print(f"[INFO] ページキャッシュ: ヒット {s['hit']} / 再検証 {s['revalidated']} / 取得 {s['miss']}、"
+              f"節約 {s['bytes_saved'] / 1024 / 1024:.1f} MB（{s['entries']} 件 {s['size_mb']:.1f} MB）")
+
+    def clear(self, pattern: str = None) -> int:
+        """キャッシュを消す（pattern 指定時は URL にその文字列を含むものだけ）。"""
+        with self._lock:
+            if pattern:
+                cur = self._conn.execute("DELETE FROM pages WHERE url LIKE ?", (f"%{pattern}%",))
+            else:
+                cur = self._conn.execute("DELETE FROM pages")
+            return cur.rowcount
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """プロセス内で共有する PageCache（PAGE_CACHE=0 なら None）。"""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = PageCache()
+        return _cache
+
+
+def log_summary():
+    """このプロセスでキャッシュを使っていれば集計を表示する。"""
+    if _cache is not None:
+        _cache.log_summary()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ページキャッシュの確認・削除")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status")
+    p_clear = sub.add_parser("clear")
+    p_clear.add_argument("--match", help="URL にこの文字列を含むものだけ消す（例: shutuba）")
+    args = parser.parse_args()
+
+    cache = PageCache()
+    if args.command == "status":
+        s = cache.summary()
+        print(f"[INFO] {cache.path}: {s['entries']} 件 {s['size_mb']:.1f} MB (上限 {CACHE_MAX_MB:.0f} MB)")
+    else:
+        n = cache.clear(args.match)
+        print(f"[INFO] {n} 件を削除しました")
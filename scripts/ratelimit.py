@@ -0,0 +1,106 @@
+# scripts/ratelimit.py
+
+import time
+import random
+import logging
+import asyncio
+import threading
+import multiprocessing
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+import scripts.metrics as metrics
+
+
+class AsyncHostBudget:
+    """
+    asyncio 用のホスト単位の礼儀正しさ予算。
+    ・同一ホストへの同時接続数を max_per_host 以下に制限
+    ・同一ホストへのリクエスト開始間隔を min_interval 秒以上空ける
+    """
+
+    def __init__(self, max_per_host: int = 2, min_interval: float = 1.0):
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self._sems = {}
+        self._locks = {}
+        self._last = {}
+
+    def _host_state(self, host: str):
+        if host not in self._sems:
+            self._sems[host] = asyncio.Semaphore(self.max_per_host)
+            self._locks[host] = asyncio.Lock()
+            self._last[host] = 0.0
+        return self._sems[host], self._locks[host]
+
+    @asynccontextmanager
+    async def acquire(self, url: str):
+        host = urlsplit(url).hostname or ""
+        sem, lock = self._host_state(host)
+        async with sem:
+            # 開始時刻の予約だけをロックで直列化し、通信自体は並行させる
+            async with lock:
+                wait = self._last[host] + self.min_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._last[host] = time.monotonic()
+            yield
+
+
+class RateLimiter:
+    """
+    スレッド間で共有するグローバルなリクエストレート上限。
+    wait() を呼ぶたびに、直前の予約から 1/rate 秒以上空くまでブロックする。
+    """
+
+    def __init__(self, rate_per_sec: float):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SharedRateLimiter:
+    """
+    プロセス間で共有するリクエストレート上限（ProcessPoolExecutor の initializer で各プロセスに渡す）。
+    RateLimiter と同じく、次に使える開始時刻を共有メモリ上で予約する。
+    """
+
+    def __init__(self, rate_per_sec: float, ctx=None):
+        ctx = ctx or multiprocessing.get_context()
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self._lock = ctx.Lock()
+        self._next = ctx.Value("d", 0.0, lock=False)
+
+    def wait(self):
+        with self._lock:
+            now = time.time()   # プロセス間で比較するので壁時計を使う
+            slot = max(now, self._next.value)
+            self._next.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def retry_with_backoff(fn, attempts: int = 3, base_delay: float = 1.0,
+                       label: str = "", retry_on=(Exception,)):
+    """
+    fn() を最大 attempts 回試行する。失敗ごとに base_delay * 2^n 秒（±20% の揺らぎ付き）待つ。
+    最後の失敗はそのまま送出する。
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except retry_on as e:
+            if attempt == attempts:
+                raise
+            delay = base_delay * (2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+            metrics.inc("retries")
+            logging.warning(f"[WARNING] {label} 失敗 ({attempt}/{attempts}): {e} → {delay:.1f}s 後に再試行")
+            time.sleep(delay)
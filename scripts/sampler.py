@@ -0,0 +1,281 @@
+# scripts/sampler.py
+
+import os
+import json
+import math
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+import scripts.netkeiba as nk
+
+JST = timezone(timedelta(hours=9))
+
+# 既存ラベルのチェックポイント（発走時刻からのオフセット, minutes_before_race）。
+# この時刻を過ぎて最初に取れたサンプルに正規ラベルを付けるので、
+# calc_fluctuation やスプレッドシート出力はこれまで通り 4 ラベルで動く。
+CHECKPOINTS = [
+    ("1h_before", -timedelta(hours=1), 60),
+    ("30m_before", -timedelta(minutes=30), 30),
+    ("5m_before", -timedelta(minutes=5), 5),
+    ("post_race", timedelta(minutes=10), -10),
+]
+# チェックポイント以外のサンプルのラベル（差分ティック odds_ticks にのみ入る）
+INTERIM_LABEL = "interim"
+
+FINAL_INTERVAL = int(os.getenv("SAMPLER_FINAL_SECONDS", "45"))
+# 発走までの残り時間がしきい値を超えている間の取得間隔（秒）。上から順に判定する
+CADENCE = [
+    (timedelta(minutes=60), 900),
+    (timedelta(minutes=30), 300),
+    (timedelta(minutes=10), 120),
+    (timedelta(0), FINAL_INTERVAL),
+]
+DAILY_BUDGET = int(os.getenv("SAMPLER_DAILY_BUDGET", "3000"))   # 1日のリクエスト上限（発走時刻の再取得を含む）
+REFRESH_SECONDS = int(os.getenv("SAMPLER_REFRESH_SECONDS", "600"))   # 発走時刻の再取得間隔
+REFRESH_NEAR_SECONDS = 120   # 発走20分前〜レース後取得までは短い間隔で再取得する
+REFRESH_WINDOW = timedelta(minutes=90)   # 発走時刻の再取得はこの時間前から始める
+STATE_DIR = os.getenv("SAMPLER_STATE_DIR", "data/state")
+# チェックポイントの予定時刻からの遅れの許容幅（秒）。超えたものは取得せず記録だけ残す。
+# 確定オッズは発走後に変わらないので post_race だけは長めに待つ
+MISFIRE_GRACE_SECONDS   = int(os.getenv("SCHEDULER_MISFIRE_GRACE", "120"))
+POST_RACE_GRACE_SECONDS = int(os.getenv("SCHEDULER_POST_RACE_GRACE", "7200"))
+
+
+def post_time_jst(start: datetime) -> datetime:
+    """
+    race.start_time を日本時間の datetime にする。列は日本時間の壁時計をそのまま TIMESTAMP に入れているので
+    BigQuery からは UTC 付き（15:40 なら 15:40+00:00）で返る。変換はせず、時刻の数字を日本時間とみなす。
+    """
+    return start.replace(tzinfo=JST)
+
+
+def grace_for(label: str) -> int:
+    return POST_RACE_GRACE_SECONDS if label == "post_race" else MISFIRE_GRACE_SECONDS
+
+
+def cadence_for(remaining: timedelta) -> int:
+    """発走までの残り時間に対する基本の取得間隔（秒）。発走後は途中サンプルを取らない（None）。"""
+    if remaining <= timedelta(0):
+        return None
+    for threshold, interval in CADENCE:
+        if remaining > threshold:
+            return interval
+    return FINAL_INTERVAL
+
+
+def count_interim(start: datetime, frm: datetime) -> int:
+    """frm から発走までに基本の間隔で取る途中サンプル数。"""
+    n, t = 0, frm
+    while True:
+        interval = cadence_for(start - t)
+        if interval is None:
+            return n
+        n += 1
+        t += timedelta(seconds=interval)
+
+
+def count_refreshes(start: datetime, frm: datetime) -> int:
+    """frm からレース後取得までに行う発走時刻の再取得回数の見込み。"""
+    n, t = 0, max(frm, start - REFRESH_WINDOW)
+    while t < start + timedelta(minutes=10):
+        n += 1
+        near = start - t <= timedelta(minutes=20)
+        t += timedelta(seconds=REFRESH_NEAR_SECONDS if near else REFRESH_SECONDS)
+    return n
+
+
+class AdaptiveSampler:
+    """
+    発走時刻に応じて取得間隔を変えるサンプラー。
+
+    発走から遠いうちは疎に、最後の10分は FINAL_INTERVAL 秒ごとに密に取得し、
+    発走時刻は出馬表を定期的に取り直して遅延に追従する。
+    1日のリクエスト数が DAILY_BUDGET に収まるよう、残りのチェックポイント分を確保したうえで
+    途中サンプルの間隔を一律に引き延ばす。
+
+    scheduler から一定間隔で due() を呼び、取得に成功したサンプルを mark() で記録する。
+    due() は1サンプル1リクエストとして先に計上し、予備ソースへの切り替えや結果ページなどで
+    実際に増えた分は charge() で、追加の取得（馬連〜3連単など）は try_spend() で予算から引く。
+    checkpoint_cost はチェックポイント1回あたりに見込むリクエスト数で、その分を予算から確保しておく。
+    消費数・取得済みラベル・追従後の発走時刻は STATE_DIR/sampler_<date>.json に保存し、
+    再起動後も引き継ぐ。予定から grace_for(label) 秒以上遅れたチェックポイントは取得せず、
+    on_skip(race_id, label, 予定時刻, 理由) で通知する。
+    """
+
+    def __init__(self, races, date_str: str = None, budget: int = DAILY_BUDGET, on_skip=None,
+                 checkpoint_cost: int = 1):
+        self.date_str = date_str or datetime.now(JST).date().isoformat()
+        self.budget = budget
+        self.checkpoint_cost = checkpoint_cost
+        self.on_skip = on_skip
+        self.path = os.path.join(STATE_DIR, f"sampler_{self.date_str}.json")
+        self._lock = threading.Lock()
+        self.spent = 0
+        self.races = {}
+        done, starts = {}, {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+            self.spent = state.get("spent", 0)
+            done = state.get("done", {})
+            starts = state.get("start", {})
+        for rid, start in races:
+            if rid in starts:   # 前回までに追従した発走時刻（日本時間で保存している）
+                start = datetime.fromisoformat(starts[rid])
+            self.races[rid] = {
+                "start": post_time_jst(start),
+                "done": set(done.get(rid, [])),
+                "last_sample": None,
+                "next_refresh": None,
+            }
+
+    def _save(self):
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "spent": self.spent,
+                "done": {rid: sorted(r["done"]) for rid, r in self.races.items() if r["done"]},
+                "start": {rid: r["start"].isoformat() for rid, r in self.races.items()},
+            }, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    # --- 予算 ---
+    def _active(self):
+        return [(rid, r) for rid, r in self.races.items() if "post_race" not in r["done"]]
+
+    def _checkpoints_reserved(self) -> int:
+        return sum(len(CHECKPOINTS) - len(r["done"]) for _, r in self._active()) * self.checkpoint_cost
+
+    def charge(self, n: int):
+        """実際に使ったリクエストのうち due() で計上していない分を予算に加える。"""
+        if n <= 0:
+            return
+        with self._lock:
+            self.spent += n
+            self._save()
+
+    def try_spend(self, n: int) -> bool:
+        """n リクエストを予算から引く。残りが足りなければ引かずに False（取得を見送る）。"""
+        with self._lock:
+            if self.spent + n > self.budget:
+                return False
+            self.spent += n
+            self._save()
+            return True
+
+    def stretch(self, now: datetime) -> float:
+        """
+        途中サンプル間隔の倍率。残り予算から未取得チェックポイントと発走時刻の再取得の見込みを
+        除いた量で、基本の間隔のまま取り続けた場合の途中サンプル数を割る。予算が尽きていれば inf。
+        """
+        active = self._active()
+        reserved = self._checkpoints_reserved() + sum(
+            count_refreshes(r["start"], max(now, r["next_refresh"] or now)) for _, r in active)
+        available = self.budget - self.spent - reserved
+        if available <= 0:
+            return math.inf
+        demand = sum(count_interim(r["start"], max(now, r["last_sample"] or now))
+                     for _, r in active)
+        return max(1.0, demand / available)
+
+    # --- 取得対象の判定 ---
+    def _skip(self, rid: str, label: str, planned: datetime, reason: str):
+        self.races[rid]["done"].add(label)
+        if self.on_skip is not None:
+            self.on_skip(rid, label, planned, reason)
+
+    def _checkpoint_due(self, rid: str, r: dict, now: datetime):
+        """
+        時刻を過ぎた未取得チェックポイントのうち最も新しいもの。
+        それより古いもの、および猶予を超えて遅れたものは取得せずに済ませる（理由は on_skip へ）。
+        """
+        due = [(label, r["start"] + offset, minutes) for label, offset, minutes in CHECKPOINTS
+               if label not in r["done"] and now >= r["start"] + offset]
+        if not due:
+            return None
+        for label, planned, _ in due[:-1]:
+            self._skip(rid, label, planned, f"後続の {due[-1][0]} の時刻を過ぎている")
+        label, planned, minutes = due[-1]
+        late = (now - planned).total_seconds()
+        if late > grace_for(label):
+            self._skip(rid, label, planned, f"予定から {late:.0f}s 遅れ（猶予 {grace_for(label)}s）")
+            return None
+        return label, minutes
+
+    def due(self, now: datetime = None) -> list[tuple[str, str, int]]:
+        """今取得すべき (race_id, label, minutes_before_race) のリスト。予算を消費する。"""
+        now = now or datetime.now(JST)
+        with self._lock:
+            stretch = self.stretch(now)
+            targets = []
+            for rid, r in self._active():
+                checkpoint = self._checkpoint_due(rid, r, now)
+                if checkpoint is not None:
+                    targets.append((rid, checkpoint[0], checkpoint[1]))
+                    continue
+                interval = cadence_for(r["start"] - now)
+                if interval is None or math.isinf(stretch):
+                    continue
+                last = r["last_sample"]
+                if last is None or (now - last).total_seconds() >= interval * stretch:
+                    remaining = (r["start"] - now).total_seconds() / 60
+                    targets.append((rid, INTERIM_LABEL, max(int(math.ceil(remaining)), 0)))
+            self.spent += len(targets)
+            self._save()
+        return targets
+
+    def mark(self, race_id: str, label: str, at: datetime = None):
+        """取得に成功したサンプルを記録する。"""
+        with self._lock:
+            r = self.races[race_id]
+            r["last_sample"] = at or datetime.now(JST)
+            if label != INTERIM_LABEL:
+                r["done"].add(label)
+            self._save()
+
+    # --- 発走時刻の追従 ---
+    def refresh_post_times(self, now: datetime = None) -> list[str]:
+        """
+        再取得時期が来たレースの出馬表を取り直し、発走時刻が変わっていれば更新する。
+        更新したレースの race_id を返す。リクエスト数は予算に含める。
+        """
+        now = now or datetime.now(JST)
+        changed = []
+        for rid, r in self._active():
+            if now < r["start"] - REFRESH_WINDOW:
+                continue
+            if r["next_refresh"] is not None and now < r["next_refresh"]:
+                continue
+            with self._lock:
+                # 未取得チェックポイントの分は残しておく
+                if self.spent + self._checkpoints_reserved() >= self.budget:
+                    return changed
+                self.spent += 1
+            near = r["start"] - now <= timedelta(minutes=20)
+            r["next_refresh"] = now + timedelta(seconds=REFRESH_NEAR_SECONDS if near else REFRESH_SECONDS)
+            try:
+                info = nk.parse_race_info(nk.fetch_soup(nk.SHUTUBA_URL.format(race_id=rid), max_age=0))
+            except requests.RequestException as e:
+                logging.warning(f"[WARNING] 発走時刻の再取得失敗 race_id={rid}: {e}")
+                continue
+            if not info or not info["start_time"]:
+                continue
+            hh, mm = map(int, info["start_time"].split(":"))
+            start = r["start"].replace(hour=hh, minute=mm, second=0, microsecond=0)
+            if start != r["start"]:
+                print(f"[INFO] 発走時刻変更 race_id={rid}: "
+                      f"{r['start']:%H:%M} → {start:%H:%M}")
+                r["start"] = start
+                changed.append(rid)
+        with self._lock:
+            self._save()
+        return changed
+
+    def summary(self) -> str:
+        active = len(self._active())
+        return (f"予算 {self.spent}/{self.budget} リクエスト使用, "
+                f"未完了 {active}/{len(self.races)} レース")
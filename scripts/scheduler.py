@@ -1,44 +1,344 @@
+import os
+import logging
+import threading
 from apscheduler.schedulers.blocking import BlockingScheduler
-from datetime import timedelta
+from apscheduler.events import EVENT_JOB_MISSED
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from datetime import datetime, timedelta, timezone
 from google.cloud import bigquery
 import scripts.fetch_odds as fo
+from scripts.odds_spool import SpoolFlusher, get_spool
+from scripts.calc_fluctuation import IncrementalFluctuation
+from scripts.sampler import AdaptiveSampler, CHECKPOINTS, MISFIRE_GRACE_SECONDS, grace_for, post_time_jst
+from scripts.odds_ticks import TickEncoder
+from scripts.collect_results import ResultsCollector, RESULTS_RETRY_SECONDS
+import scripts.metrics as metrics
+import scripts.exotic_odds as exotic
+import scripts.mirror as mirror
+import scripts.navigation as nav
+import scripts.page_cache as page_cache
+import scripts.schema as schema
 import json
 
+JST = timezone(timedelta(hours=9))
+
+# (ラベル, 発走時刻からのオフセット, fetch_odds に渡す minutes_before_race)
+SNAPSHOT_OFFSETS = CHECKPOINTS
+MINUTES_BEFORE = {label: minutes for label, _, minutes in SNAPSHOT_OFFSETS}
+
+# adaptive: 発走時刻に追従して間隔を変えるサンプラー / fixed: 4ラベルの固定時刻のみ
+SAMPLING = os.getenv("ODDS_SAMPLING", "adaptive")
+SAMPLER_TICK_SECONDS = int(os.getenv("SAMPLER_TICK_SECONDS", "10"))
+
+# 予定時刻がこの幅（秒）に収まるスナップショットは1ジョブにまとめて取得・登録する
+BUCKET_SECONDS = int(os.getenv("ODDS_BUCKET_SECONDS", "30"))
+
+# LIVE_SHEET=1 で、スナップショットごとに当日のスプレッドシートを差分更新する
+LIVE_SHEET = os.getenv("LIVE_SHEET", "0") == "1"
+
+# 当日の計画（レースと発走時刻・バケット）と、見送ったスナップショットの記録の置き場所
+STATE_DIR = os.getenv("SCHEDULER_STATE_DIR", "data/state")
+# fixed モードの日付ジョブを保存する SQLite。再起動しても未実行のジョブが残る（テーブルは日付ごと）
+JOBSTORE_URL = os.getenv("SCHEDULER_JOBSTORE",
+                         f"sqlite:///{os.path.join(STATE_DIR, 'scheduler_jobs.sqlite3')}")
+
+# スナップショットはスプールに書いた時点で確定し、BigQuery への登録は flusher がまとめて行う
+_flusher = None
+_fluctuation = None
+_live = None
+_sampler = None
+_results = None
+_ticks = TickEncoder()
+_lags = []   # 実行時刻 - 予定時刻（秒）
+_buckets = {}   # job_id → (race_id, label, 予定時刻 ISO) のリスト（misfire の記録用）
+_skips = []
+_skip_lock = threading.Lock()
+
+def build_plan(races, bucket_seconds: int = BUCKET_SECONDS) -> list[dict]:
+    """
+    races: (race_id, start_time) の列。
+    各レース×ラベルの予定時刻を bucket_seconds 幅の時間枠に振り分け、
+    時間枠ごとに {run_at: 枠内で最も早い予定時刻, items: [(race_id, label, 予定時刻), ...]}
+    を run_at 順で返す。
+    """
+    buckets = {}
+    for rid, st in races:
+        st = post_time_jst(st)   # 日本時間の壁時計（UTC 付きで返っても時刻の数字をそのまま使う）
+        for label, offset, _ in SNAPSHOT_OFFSETS:
+            planned = st + offset
+            key = int(planned.timestamp()) // max(bucket_seconds, 1)
+            buckets.setdefault(key, []).append((rid, label, planned))
+    plan = []
+    for key in sorted(buckets):
+        items = sorted(buckets[key], key=lambda x: x[2])
+        plan.append({"run_at": items[0][2], "items": items})
+    return plan
+
+def _plan_path(date_str: str) -> str:
+    return os.path.join(STATE_DIR, f"plan_{date_str}.json")
+
+def load_plan(date_str: str):
+    """保存済みの当日の計画 {"races": [[race_id, 発走時刻 ISO], ...], "buckets": {...}}。無ければ None。"""
+    if not os.path.exists(_plan_path(date_str)):
+        return None
+    with open(_plan_path(date_str), encoding="utf-8") as f:
+        return json.load(f)
+
+def save_plan(date_str: str, races, buckets: dict):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp = f"{_plan_path(date_str)}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"races": [[rid, st.isoformat()] for rid, st in races], "buckets": buckets},
+                  f, ensure_ascii=False)
+    os.replace(tmp, _plan_path(date_str))
+
+def query_races(client: bigquery.Client, date_str: str) -> list:
+    """当日の (race_id, start_time)。race_date（パーティション列）で当日分だけを読む。"""
+    if mirror.use_mirror():
+        df = mirror.query("SELECT race_id, start_time FROM race WHERE dt = CAST(? AS DATE)", [date_str])
+        return [(r.race_id, r.start_time.to_pydatetime()) for r in df.itertuples(index=False)]
+    query = (f"SELECT race_id, start_time FROM `{schema.table_id('race', client.project)}` "
+             f"WHERE race_date = '{date_str}'")
+    return [(row["race_id"], row["start_time"]) for row in client.query(query)]
+
+def record_skip(race_id: str, label: str, planned: datetime, reason: str):
+    """取得を見送ったスナップショットを STATE_DIR/skipped_<date>.jsonl に理由付きで残す。"""
+    row = {"race_id": race_id, "label": label, "planned": planned.isoformat(),
+           "detected_at": datetime.now(JST).isoformat(), "reason": reason}
+    path = os.path.join(STATE_DIR, f"skipped_{datetime.now(JST).date().isoformat()}.jsonl")
+    with _skip_lock:
+        _skips.append(row)
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    logging.warning(f"[WARNING] スナップショット見送り race_id={race_id} {label}: {reason}")
+
+def _on_job_missed(event):
+    """猶予（misfire_grace_time）を過ぎて発火しなかったバケットの中身を記録する。"""
+    items = _buckets.get(event.job_id, [])
+    late = (datetime.now(JST) - event.scheduled_run_time).total_seconds()
+    grace = min((grace_for(label) for _, label, _ in items), default=MISFIRE_GRACE_SECONDS)
+    for rid, label, planned in items:
+        record_skip(rid, label, datetime.fromisoformat(planned),
+                    f"misfire: 予定から {late:.0f}s 遅れ（猶予 {grace}s）")
+
 def schedule_jobs():
+    global _flusher, _fluctuation, _live, _sampler, _results
     client = bigquery.Client()
-    query = "SELECT race_id, start_time FROM `jra_odds.race` WHERE race_date = CURRENT_DATE()"
-    sched = BlockingScheduler(timezone="Asia/Tokyo")
-
-    for row in client.query(query):
-        rid = row["race_id"]
-        st = row["start_time"]
-        for label, delta in [
-            ("1h_before", timedelta(hours=1)),
-            ("30m_before", timedelta(minutes=30)),
-            ("5m_before", timedelta(minutes=5)),
-            ("post_race", timedelta(minutes=10)),  # レース後10分後取得
-        ]:
-            run_at = st - delta if "before" in label else st + delta
-            sched.add_job(
-                func=job_fetch_store,
-                trigger="date",
-                run_date=run_at,
-                args=[rid, label]
-            )
-    sched.start()
+    today = datetime.now(JST).date().isoformat()
+    os.makedirs(STATE_DIR, exist_ok=True)
+    sched = BlockingScheduler(
+        timezone="Asia/Tokyo",
+        jobstores={
+            "default": SQLAlchemyJobStore(url=JOBSTORE_URL, tablename=f"jobs_{today.replace('-', '')}"),
+            "memory": MemoryJobStore(),   # 起動ごとに作り直す定期ジョブ
+        },
+        job_defaults={"coalesce": True, "misfire_grace_time": MISFIRE_GRACE_SECONDS},
+    )
+    sched.add_listener(_on_job_missed, EVENT_JOB_MISSED)
 
-def job_fetch_store(race_id: str, label: str):
-    from google.cloud import bigquery
-    client = bigquery.Client()
-    rows = fo.fetch_odds(race_id)
-    # label フィールドを追加
-    for r in rows:
-        r["label"] = label
-    errors = client.insert_rows_json(f"{client.project}.jra_odds.odds_snapshot", rows)
-    if errors:
-        print(f"Error at {race_id} {label}:", errors)
+    plan = load_plan(today)
+    if plan is not None:
+        # 再起動: BigQuery を引かずに計画を復元する。fixed の未実行ジョブは SQLite に残っていて、
+        # 予定を過ぎたものは猶予内なら直ちに実行、超えていれば _on_job_missed で記録される
+        races = [(rid, datetime.fromisoformat(st)) for rid, st in plan["races"]]
+        _buckets.update(plan["buckets"])
+        print(f"[INFO] 計画を復元: {len(races)} レース ({_plan_path(today)})")
     else:
-        print(f"Stored odds for {race_id} ({label}).")
+        schema.require(client)
+        races = query_races(client, today)
+        if SAMPLING != "adaptive":
+            # 時間枠ごとに1ジョブ。枠内のレースは fetch_odds_batch で並列取得し、まとめてスプールに積む
+            # （ジョブは文字列参照で SQLite に保存されるので、関数はモジュール名で指す）
+            plan = build_plan(races)
+            for bucket in plan:
+                job_id = f"bucket-{bucket['run_at']:%H%M%S}"
+                items = [(rid, label, planned.isoformat()) for rid, label, planned in bucket["items"]]
+                _buckets[job_id] = items
+                sched.add_job(
+                    func="scripts.scheduler:job_fetch_store_bucket",
+                    trigger="date",
+                    run_date=bucket["run_at"],
+                    args=[items],
+                    id=job_id,
+                    replace_existing=True,
+                    misfire_grace_time=min(grace_for(label) for _, label, _ in items),
+                )
+            sizes = [len(b["items"]) for b in plan]
+            if sizes:
+                print(f"[INFO] {sum(sizes)} スナップショットを {len(plan)} ジョブに集約 "
+                      f"(幅 {BUCKET_SECONDS}s, 最大 {max(sizes)} 件/ジョブ, 平均 {sum(sizes) / len(sizes):.1f} 件)")
+        save_plan(today, races, _buckets)
+
+    if SAMPLING == "adaptive":
+        # 一定間隔でサンプラーに問い合わせ、その時点で取得すべきレースをまとめて取得する
+        # （取得済みラベル・消費数・追従後の発走時刻はサンプラーの状態ファイルから引き継ぐ）
+        _sampler = AdaptiveSampler(races, today, on_skip=record_skip,
+                                   checkpoint_cost=1 + len(exotic.EXOTIC_BETS))
+        sched.add_job(job_sample_tick, trigger="interval", seconds=SAMPLER_TICK_SECONDS,
+                      max_instances=1, coalesce=True, jobstore="memory")
+        print(f"[INFO] 適応サンプリング: {len(races)} レース, {_sampler.summary()}")
+
+    _fluctuation = IncrementalFluctuation()
+    # 着順はレース後スナップショットの直後に取りに行き、未確定分は一定間隔で取り直す
+    _results = ResultsCollector(today)
+    sched.add_job(job_collect_results, trigger="interval", seconds=RESULTS_RETRY_SECONDS,
+                  max_instances=1, coalesce=True, jobstore="memory")
+    if LIVE_SHEET:
+        from scripts.live_sheet import LiveSheetUpdater
+        _live = LiveSheetUpdater(today)
+        _live.seed(client)
+    _flusher = SpoolFlusher(get_spool())
+    _flusher.start()
+    try:
+        sched.start()
+    finally:
+        _flusher.stop()
+        _fluctuation.flush()
+        # 1日分の着順は終了時にまとめて1回のロードで登録する
+        try:
+            _results.load(client)
+        except Exception as e:
+            logging.warning(f"[WARNING] 着順の登録失敗（{_results.path} に保持）: {e}")
+        print(f"[INFO] {_results.summary()}")
+        if _sampler is not None:
+            print(f"[INFO] {_sampler.summary()}")
+        fo.src.STATS.log_summary()
+        nav.STATS.log_summary()
+        page_cache.log_summary()
+        if _lags:
+            print(f"[INFO] 発火遅延: 平均 {sum(_lags) / len(_lags):.1f}s / 最大 {max(_lags):.1f}s "
+                  f"({len(_lags)} 件)")
+        if _skips:
+            print(f"[INFO] 見送ったスナップショット {len(_skips)} 件 "
+                  f"({os.path.join(STATE_DIR, 'skipped_<date>.jsonl')})")
+
+def job_fetch_store_bucket(items: list):
+    """
+    items: (race_id, label, 予定時刻 ISO) のリスト。
+    枠内の全レースをまとめて取得し、スナップショット・変動を1回ずつスプールに積む。
+    """
+    fired = datetime.now(JST)
+    lags = [(fired - datetime.fromisoformat(planned)).total_seconds() for _, _, planned in items]
+    _lags.extend(lags)
+    for (rid, label, _), lag in zip(items, lags):
+        metrics.observe("scheduler.lag", max(lag, 0.0), race_id=rid, label=label)
+    print(f"[INFO] バケット発火: {len(items)} 件, 予定との差 最大 {max(lags):+.1f}s")
+
+    fetch_and_store([(rid, label, MINUTES_BEFORE[label]) for rid, label, _ in items])
+
+def job_sample_tick():
+    """サンプラーの定期処理。発走時刻を追従したうえで、取得時期が来たレースをまとめて取得する。"""
+    if _sampler is None:
+        return
+    with metrics.span("sampler.refresh"):
+        _sampler.refresh_post_times()
+    targets = _sampler.due()
+    if not targets:
+        return
+    fetched_at = datetime.now(JST)
+    stored, requests = fetch_and_store(targets)
+    # due() は1レース1リクエストで計上済み。予備ソース・結果ページで増えた分を足す
+    _sampler.charge(requests - len(targets))
+    for rec, label in stored:
+        _sampler.mark(rec["race_id"], label, fetched_at)
+
+def job_collect_results():
+    """未確定だったレースの結果ページを取り直す。"""
+    if _results is not None and _results.pending:
+        _results.collect_pending()
+
+def fetch_and_store(targets: list) -> tuple[list[tuple[dict, str]], int]:
+    """
+    targets: (race_id, label, minutes_before_race) のリスト（1レースにつき1件）。
+    まとめて取得し、スナップショット・変動を1回ずつスプールに積む。
+    取得できた (レコード, ラベル) のリストと、使った HTTP リクエスト数（予算の計上用）を返す。
+    取得に失敗したレースは全ソースに問い合わせたものとして数える。
+    """
+    labels = {(rid, minutes): label for rid, label, minutes in targets}
+    with metrics.span("snapshot.fetch", races=len(targets)):
+        if len(targets) == 1:
+            rid, _, minutes = targets[0]
+            records = [r for r in [fo.fetch_odds_by_race_id(rid, minutes)] if r]
+        else:
+            records = fo.fetch_odds_batch(list(labels))
+
+    requests = (sum(rec.get("requests", 1) for rec in records)
+                + (len(targets) - len(records)) * len(fo.src.SOURCES))
+    snapshot_rows, fluct_rows, tick_rows, exotic_targets, stored = [], [], [], [], []
+    with metrics.span("snapshot.encode", races=len(records)):
+        for rec in records:
+            label = labels[(rec["race_id"], rec["minutes_before_race"])]
+            stored.append((rec, label))
+            # 全サンプルを差分ティックとして保存（変化した馬だけ・タイムスタンプは1つ）
+            tick = _ticks.encode(rec)
+            if tick is not None:
+                tick_rows.append(tick)
+            if label not in MINUTES_BEFORE:
+                continue   # 途中サンプルはティックのみ（スナップショット・変動・シートは4ラベルで扱う）
+            exotic_targets.append((rec["race_id"], fo.race_date_of(rec), label,
+                                   max(o["number"] for o in rec["odds_list"])))
+            # label フィールドを付けて odds_snapshot の行形式に展開
+            rows = fo.to_snapshot_rows(rec, label)
+            snapshot_rows.extend(rows)
+            odds_by_horse = {r["horse_no"]: r["odds_avg"] for r in rows}
+            # 直前のラベルからの変動と最初→最後の変動をその場で計算する
+            if _fluctuation is not None:
+                fluct_rows.extend(_fluctuation.update(rec["race_id"], label, odds_by_horse))
+            if _live is not None:
+                _live.apply_snapshot(rec["race_id"], label, odds_by_horse)
+
+    spool = get_spool()
+    with metrics.span("spool.append", rows=len(snapshot_rows) + len(fluct_rows) + len(tick_rows)):
+        if snapshot_rows:
+            spool.append(schema.table_id("odds_snapshot"), snapshot_rows)
+        if fluct_rows:
+            spool.append(schema.table_id("odds_fluctuation"), fluct_rows)
+        if tick_rows:
+            spool.append(schema.table_id("odds_ticks"), tick_rows)
+    if _flusher is not None:
+        _flusher.notify()
+
+    # シートは今回のレースのオッズ列だけを差分送信（失敗してもスナップショットは確定済み）
+    if _live is not None:
+        try:
+            with metrics.span("sheets.push"):
+                _live.flush()
+        except Exception as e:
+            metrics.inc("failures", stage="sheets.push")
+            logging.warning(f"[WARNING] シート差分更新失敗: {e}")
+    print(f"Spooled odds for {len(records)}/{len(targets)} races: "
+          f"{len(snapshot_rows)} snapshot rows, {len(tick_rows)} ticks.")
+
+    # 馬連〜3連単（EXOTIC_BETS 指定時のみ）は単勝を積んだ後に取る（単勝のスナップショットを待たせない）。
+    # 1レース×券種で1リクエストをサンプラーの予算から先に引き、足りなければ見送る
+    cost = len(exotic_targets) * len(exotic.EXOTIC_BETS)
+    if cost and _sampler is not None and not _sampler.try_spend(cost):
+        logging.warning(f"[WARNING] 予算不足のため馬連〜3連単の取得を見送り（{cost} リクエスト）")
+        exotic_targets = []
+    if exotic_targets and exotic.EXOTIC_BETS:
+        with metrics.span("exotic.capture", races=len(exotic_targets)):
+            exotic_rows = exotic.capture(exotic_targets)
+        if exotic_rows:
+            spool.append(schema.table_id("odds_exotic"), exotic_rows)
+            if _flusher is not None:
+                _flusher.notify()
+
+    # レース後スナップショットを取ったレースは続けて結果ページも取りに行く（HTTP 1回）
+    if _results is not None:
+        for rec, label in stored:
+            if label == "post_race":
+                _results.collect(rec["race_id"])
+                requests += 1
+    return stored, requests
+
+def job_fetch_store(race_id: str, label: str):
+    """1レース・1ラベルだけを即時取得する（手動実行用）。"""
+    job_fetch_store_bucket([(race_id, label, datetime.now(JST).isoformat())])
 
 if __name__ == "__main__":
-    schedule_jobs()
+    # 保存済みジョブは scripts.scheduler:job_fetch_store_bucket を参照するので、
+    # __main__ ではなくモジュールとして読み込んだ側で動かす（グローバル状態を1つにする）
+    from scripts.scheduler import schedule_jobs as _run
+    _run()
@@ -0,0 +1,396 @@
+# scripts/schema.py
+
+import os
+import re
+import sys
+import argparse
+import functools
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+# --- 設定 ---
+DATASET  = "jra_odds"
+LOCATION = os.getenv("BQ_LOCATION", "asia-northeast1")
+MIGRATIONS_TABLE = "_schema_migrations"   # 適用済みマイグレーションの履歴
+VERSION_LABEL    = "schema_version"       # データセットのラベル（起動時の確認はこれだけを見る）
+
+F = bigquery.SchemaField
+
+_HORSE = [
+    F("waku", "INT64"), F("number", "INT64"), F("name", "STRING"), F("sex_age", "STRING"),
+    F("weight", "FLOAT64"), F("jockey", "STRING"), F("trainer", "STRING"),
+    F("expect_odds", "FLOAT64"),
+]
+
+# jra_odds の全テーブル。
+#   fields    : 列定義
+#   partition : (パーティション列, 単位)。読み出しはこの列で日付を絞ってスキャン量を抑える
+#   cluster   : クラスタリング列（race_id / 馬番で引く読み出しが多い）
+#   derive    : 旧テーブルに無い列を移行時に埋める式（t は旧テーブル）
+#   keys      : 自然キー。あるテーブルは scripts/bq_merge.py の MERGE で upsert する（再実行しても重複しない）
+TABLES = {
+    "race": {
+        "fields": [
+            F("race_id", "STRING"), F("race_date", "DATE"), F("venue", "STRING"),
+            F("race_no", "INT64"), F("race_name", "STRING"), F("start_time", "TIMESTAMP"),
+            F("track_surface", "STRING"), F("distance_m", "INT64"), F("race_class", "STRING"),
+            F("entries_count", "INT64"), F("detail_url", "STRING"),
+            F("horses", "RECORD", mode="REPEATED", fields=_HORSE),
+        ],
+        "partition": ("race_date", "DAY"),
+        "cluster": ["venue", "race_id"],
+        "keys": ["race_id"],
+        # start_time は日本時間の壁時計をそのまま入れているので DATE() がそのまま開催日になる
+        "derive": {"race_date": "DATE(t.start_time)"},
+    },
+    "odds": {
+        "fields": [
+            F("race_id", "STRING"), F("race_date", "DATE"), F("minutes_before_race", "INT64"),
+            F("odds_list", "RECORD", mode="REPEATED", fields=[
+                F("number", "INT64"), F("odds", "FLOAT64"), F("timestamp", "TIMESTAMP"),
+            ]),
+        ],
+        "partition": ("race_date", "DAY"),
+        "cluster": ["race_id"],
+        "derive": {"race_date": "DATE((SELECT MIN(o.timestamp) FROM UNNEST(t.odds_list) o), 'Asia/Tokyo')"},
+    },
+    "odds_snapshot": {
+        "fields": [
+            F("race_id", "STRING"), F("horse_no", "INT64"), F("snapshot_at", "DATETIME"),
+            F("odds_jra", "FLOAT64"), F("odds_netkeiba", "FLOAT64"), F("odds_avg", "FLOAT64"),
+            F("label", "STRING"),
+        ],
+        "partition": ("snapshot_at", "DAY"),
+        "cluster": ["race_id", "horse_no"],
+        "keys": ["race_id", "horse_no", "label"],
+    },
+    "odds_ticks": {
+        "fields": [
+            F("race_id", "STRING"), F("seq", "INT64"), F("ts", "TIMESTAMP"),
+            F("minutes_before_race", "INT64"), F("keyframe", "BOOL"),
+            F("changes", "RECORD", mode="REPEATED", fields=[
+                F("number", "INT64"), F("odds", "FLOAT64"),
+            ]),
+        ],
+        # 開催は日本時間の日中なので、UTC の日付と開催日は一致する
+        "partition": ("ts", "DAY"),
+        "cluster": ["race_id"],
+    },
+    "odds_fluctuation": {
+        "fields": [
+            F("race_id", "STRING"), F("race_date", "DATE"), F("horse_no", "INT64"),
+            F("from_label", "STRING"), F("to_label", "STRING"),
+            F("fluctuation_value", "FLOAT64"), F("fluctuation_rate", "FLOAT64"),
+        ],
+        "partition": ("race_date", "DAY"),
+        "cluster": ["race_id", "horse_no"],
+        "keys": ["race_id", "horse_no", "from_label", "to_label"],
+        "derive": {"race_date": "(SELECT ANY_VALUE(r.race_date) FROM `{ds}.race` r "
+                                "WHERE r.race_id = t.race_id)"},
+    },
+    "race_results": {
+        "fields": [
+            F("race_id", "STRING"), F("race_date", "DATE"), F("horse_no", "INT64"),
+            F("finish_position", "INT64"), F("popularity", "INT64"), F("final_odds", "FLOAT64"),
+        ],
+        "partition": ("race_date", "DAY"),
+        "cluster": ["race_id", "horse_no"],
+        "keys": ["race_id", "horse_no"],
+        "derive": {"race_date": "(SELECT ANY_VALUE(r.race_date) FROM `{ds}.race` r "
+                                "WHERE r.race_id = t.race_id)"},
+    },
+    # 馬連・ワイド・馬単・3連複・3連単。1スナップショット×券種で1行、odds は組番の正準順に並べた
+    # オッズ×10 の uint32 配列を zlib 圧縮したもの（scripts/exotic_odds.py の encode / decode）
+    "odds_exotic": {
+        "fields": [
+            F("race_id", "STRING"), F("race_date", "DATE"), F("bet_type", "STRING"),
+            F("label", "STRING"), F("snapshot_at", "TIMESTAMP"), F("n_horses", "INT64"),
+            F("odds", "BYTES"),
+        ],
+        "partition": ("race_date", "DAY"),
+        "cluster": ["race_id", "bet_type"],
+    },
+    # 旧 <year>_race_calendar（年ごとのテーブル）を1テーブルにまとめたもの
+    "race_calendar": {
+        "fields": [F("race_date", "DATE"), F("track", "STRING")],
+        "partition": ("race_date", "YEAR"),
+        "cluster": ["track"],
+        "keys": ["race_date", "track"],
+    },
+}
+
+LEGACY_CALENDAR_RE = re.compile(r"^\d{4}_race_calendar$")
+
+
+# --- テーブル ID ---
+@functools.lru_cache(maxsize=1)
+def project() -> str:
+    """既定の GCP プロジェクト（最初に必要になった時点で1回だけ解決する）。"""
+    return bigquery.Client().project
+
+
+def table_id(name: str, project_id: str = None) -> str:
+    return f"{project_id or project()}.{DATASET}.{name}"
+
+
+def _table(name: str, project_id: str, suffix: str = "") -> bigquery.Table:
+    spec = TABLES[name]
+    table = bigquery.Table(table_id(name + suffix, project_id), schema=spec["fields"])
+    field, unit = spec["partition"]
+    table.time_partitioning = bigquery.TimePartitioning(type_=unit, field=field)
+    table.clustering_fields = spec["cluster"]
+    return table
+
+
+def _layout_matches(table: bigquery.Table, name: str) -> bool:
+    field, unit = TABLES[name]["partition"]
+    tp = table.time_partitioning
+    return (tp is not None and tp.field == field and tp.type_ == unit
+            and (table.clustering_fields or []) == TABLES[name]["cluster"])
+
+
+# --- バージョン確認 ---
+def current_version(client: bigquery.Client) -> int:
+    try:
+        dataset = client.get_dataset(f"{client.project}.{DATASET}")
+    except NotFound:
+        return 0
+    return int((dataset.labels or {}).get(VERSION_LABEL, 0))
+
+
+_checked = False
+
+
+def require(client: bigquery.Client = None):
+    """
+    スキーマが最新であることをプロセス内で1回だけ確認する（データセットのメタデータ取得1回）。
+    古ければ migrate の実行を促して終了する。DDL はここでは発行しない。
+    """
+    global _checked
+    if _checked:
+        return
+    version = current_version(client or bigquery.Client())
+    if version < SCHEMA_VERSION:
+        print(f"[ERROR] {DATASET} のスキーマが v{version} です（必要: v{SCHEMA_VERSION}）。"
+              f"python -m scripts.schema migrate を実行してください", file=sys.stderr)
+        sys.exit(1)
+    _checked = True
+
+
+# --- マイグレーション ---
+def _run(client: bigquery.Client, sql: str, dry_run: bool):
+    if dry_run:
+        print(f"[DRY-RUN] {' '.join(sql.split())}")
+        return None
+    return client.query(sql).result()
+
+
+def _select_list(name: str, old: bigquery.Table, ds: str) -> str:
+    """旧テーブル t から新しい列定義どおりの SELECT 句を組み立てる（無い列は derive か NULL）。"""
+    old_cols = {f.name for f in old.schema}
+    derive = TABLES[name].get("derive", {})
+    cols = []
+    for f in TABLES[name]["fields"]:
+        if f.name in old_cols:
+            cols.append(f"t.{f.name}" if f.field_type == "RECORD"
+                        else f"CAST(t.{f.name} AS {f.field_type}) AS {f.name}")
+        elif f.name in derive:
+            cols.append(f"{derive[f.name].format(ds=ds)} AS {f.name}")
+        else:
+            cols.append(f"NULL AS {f.name}")
+    return ",\n        ".join(cols)
+
+
+def rebuild_table(client: bigquery.Client, name: str, old: bigquery.Table, dry_run: bool = False):
+    """
+    パーティション・クラスタリングの無い（または異なる）既存テーブルを作り直す。
+    新レイアウトの空テーブルに旧データを INSERT ... SELECT で移し、名前を入れ替える。
+    旧テーブルは <name>_legacy_<日付> として残す（確認後に手で削除する）。
+    """
+    ds = f"{client.project}.{DATASET}"
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d")
+    staging = _table(name, client.project, suffix="__migrating")
+    print(f"[INFO] {name}: 作り直し（partition={TABLES[name]['partition']}, "
+          f"cluster={TABLES[name]['cluster']}, 旧 {old.num_rows} 行）")
+    if not dry_run:
+        client.delete_table(staging, not_found_ok=True)
+        client.create_table(staging)
+    _run(client, f"""
+      INSERT INTO `{ds}.{name}__migrating`
+      SELECT
+        {_select_list(name, old, ds)}
+      FROM `{ds}.{name}` t
+    """, dry_run)
+    if not dry_run:
+        moved = client.get_table(staging).num_rows
+        if moved != old.num_rows:
+            raise RuntimeError(f"{name}: 移行行数が一致しません（旧 {old.num_rows} / 新 {moved}）")
+    _run(client, f"ALTER TABLE `{ds}.{name}` RENAME TO `{name}_legacy_{stamp}`", dry_run)
+    _run(client, f"ALTER TABLE `{ds}.{name}__migrating` RENAME TO `{name}`", dry_run)
+
+
+def apply_table(client: bigquery.Client, name: str, dry_run: bool = False):
+    """1テーブルを定義どおりにする（無ければ作成 / レイアウト違いは作り直し / 列不足は追加）。"""
+    try:
+        existing = client.get_table(table_id(name, client.project))
+    except NotFound:
+        print(f"[INFO] {name}: 作成")
+        if not dry_run:
+            client.create_table(_table(name, client.project))
+        return
+    if not _layout_matches(existing, name):
+        rebuild_table(client, name, existing, dry_run)
+        return
+    have = {f.name for f in existing.schema}
+    missing = [f for f in TABLES[name]["fields"] if f.name not in have]
+    if missing:
+        print(f"[INFO] {name}: 列を追加 {[f.name for f in missing]}")
+        if not dry_run:
+            existing.schema = list(existing.schema) + missing
+            client.update_table(existing, ["schema"])
+    else:
+        print(f"[INFO] {name}: 変更なし")
+
+
+def merge_legacy_calendars(client: bigquery.Client, dry_run: bool = False):
+    """<year>_race_calendar を race_calendar に取り込む（既にある行は入れない）。元のテーブルは残す。"""
+    ds = f"{client.project}.{DATASET}"
+    for t in client.list_tables(ds):
+        if not LEGACY_CALENDAR_RE.match(t.table_id):
+            continue
+        print(f"[INFO] race_calendar: {t.table_id} を取り込み")
+        _run(client, f"""
+          INSERT INTO `{ds}.race_calendar` (race_date, track)
+          SELECT race_date, track FROM `{ds}.{t.table_id}`
+          EXCEPT DISTINCT
+          SELECT race_date, track FROM `{ds}.race_calendar`
+        """, dry_run)
+
+
+def dedupe_table(client: bigquery.Client, name: str, dry_run: bool = False):
+    """
+    自然キー（keys）が重複した行を1行に減らす（従来の streaming insert の再実行で入った重複）。
+    rebuild_table と同じく新しいテーブルに移して入れ替え、旧テーブルは <name>_dup_<日付> として残す。
+    """
+    ds = f"{client.project}.{DATASET}"
+    keys = ", ".join(TABLES[name]["keys"])
+    cols = ", ".join(f.name for f in TABLES[name]["fields"])
+    if not dry_run:
+        total, distinct = next(iter(client.query(f"""
+          SELECT COUNT(*), COUNT(DISTINCT TO_JSON_STRING(STRUCT({keys}))) FROM `{ds}.{name}`
+        """).result()))
+        if total == distinct:
+            print(f"[INFO] {name}: 重複なし（{total} 行）")
+            return
+        print(f"[INFO] {name}: 重複を除去（{total} 行 → {distinct} 行）")
+        staging = _table(name, client.project, suffix="__migrating")
+        client.delete_table(staging, not_found_ok=True)
+        client.create_table(staging)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d")
+    _run(client, f"""
+      INSERT INTO `{ds}.{name}__migrating` ({cols})
+      SELECT {cols} FROM `{ds}.{name}`
+      WHERE TRUE
+      QUALIFY ROW_NUMBER() OVER (PARTITION BY {keys}) = 1
+    """, dry_run)
+    _run(client, f"ALTER TABLE `{ds}.{name}` RENAME TO `{name}_dup_{stamp}`", dry_run)
+    _run(client, f"ALTER TABLE `{ds}.{name}__migrating` RENAME TO `{name}`", dry_run)
+
+
+def _migrate_v1(client: bigquery.Client, dry_run: bool):
+    # race を先に作り直す（odds_fluctuation / race_results の race_date は race から引く）
+    for name in TABLES:
+        apply_table(client, name, dry_run)
+    merge_legacy_calendars(client, dry_run)
+
+
+def _migrate_v2(client: bigquery.Client, dry_run: bool):
+    apply_table(client, "race_results", dry_run)
+
+
+def _migrate_v3(client: bigquery.Client, dry_run: bool):
+    apply_table(client, "odds_exotic", dry_run)
+
+
+def _migrate_v4(client: bigquery.Client, dry_run: bool):
+    for name, spec in TABLES.items():
+        if spec.get("keys"):
+            dedupe_table(client, name, dry_run)
+
+
+# (バージョン, 説明, 関数)。追加するときは末尾に足す
+MIGRATIONS = [
+    (1, "日付パーティション・クラスタリング（race_date 列の追加、年別カレンダーの統合）", _migrate_v1),
+    (2, "race_results に人気・確定単勝オッズを追加", _migrate_v2),
+    (3, "odds_exotic（馬連・ワイド・馬単・3連複・3連単）を追加", _migrate_v3),
+    (4, "自然キーの重複を除去（以降の登録は MERGE で upsert）", _migrate_v4),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(client: bigquery.Client = None, dry_run: bool = False) -> int:
+    """未適用のマイグレーションを順に適用し、適用後のバージョンを返す。"""
+    client = client or bigquery.Client()
+    ds_id = f"{client.project}.{DATASET}"
+    if not dry_run:
+        dataset = bigquery.Dataset(ds_id)
+        dataset.location = LOCATION
+        client.create_dataset(dataset, exists_ok=True)
+        client.create_table(bigquery.Table(f"{ds_id}.{MIGRATIONS_TABLE}", schema=[
+            F("version", "INT64"), F("description", "STRING"), F("applied_at", "TIMESTAMP"),
+        ]), exists_ok=True)
+
+    version = current_version(client)
+    pending = [m for m in MIGRATIONS if m[0] > version]
+    if not pending:
+        print(f"[INFO] {DATASET} は最新です（v{version}）")
+        return version
+    for number, description, func in pending:
+        print(f"[INFO] v{number}: {description}")
+        func(client, dry_run)
+        if dry_run:
+            continue
+        client.query(
+            f"INSERT INTO `{ds_id}.{MIGRATIONS_TABLE}` (version, description, applied_at) "
+            f"VALUES (@v, @d, CURRENT_TIMESTAMP())",
+            job_config=bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ScalarQueryParameter("v", "INT64", number),
+                bigquery.ScalarQueryParameter("d", "STRING", description),
+            ]),
+        ).result()
+        dataset = client.get_dataset(ds_id)
+        dataset.labels = {**(dataset.labels or {}), VERSION_LABEL: str(number)}
+        client.update_dataset(dataset, ["labels"])
+        version = number
+    return version
+
+
+def status(client: bigquery.Client = None):
+    client = client or bigquery.Client()
+    print(f"[INFO] {DATASET}: v{current_version(client)}（最新 v{SCHEMA_VERSION}）")
+    for name in TABLES:
+        try:
+            t = client.get_table(table_id(name, client.project))
+        except NotFound:
+            print(f"[INFO]   {name}: なし")
+            continue
+        tp = t.time_partitioning
+        layout = "OK" if _layout_matches(t, name) else "要移行"
+        print(f"[INFO]   {name}: {t.num_rows} 行, partition={tp.field if tp else None}, "
+              f"cluster={t.clustering_fields}, {layout}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="jra_odds のテーブル定義とマイグレーション")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_migrate = sub.add_parser("migrate", help="未適用のマイグレーションを適用する（既存データも移行）")
+    p_migrate.add_argument("--dry-run", action="store_true", help="実行する SQL を表示するだけ")
+    sub.add_parser("status", help="バージョンと各テーブルのレイアウトを表示")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate(dry_run=args.dry_run)
+    else:
+        status()
@@ -4,10 +4,11 @@ from datetime import datetime, date
 from icalendar import Calendar
 from google.cloud import bigquery
 
+import scripts.bq_merge as bq_merge
+import scripts.schema as schema
+
 # 環境変数 or デフォルトパス
 ICS_PATH = os.getenv('JRA_CALENDAR_ICS', 'data/race_calendar/jrarace2025.ics')
-PROJECT = bigquery.Client().project
-DATASET = 'jra_odds'
 
 def fetch_calendar_from_ics(path: str) -> list[dict]:
     """ICS ファイルから race_date(date) と track(string) を抽出"""
@@ -34,31 +35,19 @@ def upsert_calendar():
     # 日付順にソート
     rows.sort(key=lambda r: r['race_date'])
 
-    # テーブル名を "{year}_race_calendar" とする
-    year = rows[0]['race_date'].year
-    table_id = f"{PROJECT}.{DATASET}.{year}_race_calendar"
-
-    # DDL：テーブルがなければ作成
-    ddl = f"""
-    CREATE TABLE IF NOT EXISTS `{table_id}` (
-      race_date DATE,
-      track     STRING
-    )
-    """
-    client.query(ddl).result()
-    print(f"Ensured table exists: {table_id}")
+    # 全年分を race_calendar（race_date で年パーティション）に入れる。
+    # テーブル定義は scripts/schema.py で管理（旧 {year}_race_calendar は migrate で統合済み）
+    schema.require(client)
+    table_id = schema.table_id('race_calendar', client.project)
 
-    # BigQuery に挿入
+    # (race_date, track) で upsert（同じ ICS を読み直しても重複しない）
     # JSON にする際、日付は ISO フォーマット文字列で渡す
     bq_rows = [
         {'race_date': r['race_date'].isoformat(), 'track': r['track']}
         for r in rows
     ]
-    errors = client.insert_rows_json(table_id, bq_rows)
-    if errors:
-        print("Insert errors:", errors)
-    else:
-        print(f"Inserted {len(bq_rows)} rows into {table_id}.")
+    result = bq_merge.merge_rows(client, 'race_calendar', bq_rows)
+    print(f"[INFO] {bq_merge.describe('race_calendar', result)} → {table_id}")
 
 if __name__ == '__main__':
     upsert_calendar()
@@ -1,45 +1,25 @@
-# scripts/upsert_races.py
+# scripts/upsert_entries.py
 
 import os
 import sys
 import logging
-import re
-import random
 import time
+import queue
+import threading
 import requests
-from bs4 import BeautifulSoup 
 from datetime import datetime, date
+from typing import Optional
+from google.api_core.exceptions import GoogleAPIError
 from google.cloud import bigquery
 
-from playwright.sync_api import sync_playwright
-
-# User-Agent リスト（ランダムに選択）
-USER_AGENTS = [
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:115.0) "
-    "Gecko/20100101 Firefox/115.0",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:115.0) "
-    "Gecko/20100101 Firefox/115.0",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-    "AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.2 Safari/605.1.15",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Edg/115.0.0.0",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 OPR/85.0.4341.72",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 OPR/85.0.4341.72",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Vivaldi/5.3.2679.55",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Vivaldi/5.3.2679.55",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Brave/1.40.107",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Brave/1.40.107",
-]
+from scripts.browser_pool import BrowserPool, get_pool
+from scripts.ratelimit import RateLimiter, retry_with_backoff
+import scripts.bq_merge as bq_merge
+import scripts.metrics as metrics
+import scripts.netkeiba as nk
+import scripts.page_cache as page_cache
+import scripts.navigation as nav
+import scripts.schema as schema
 
 # 競馬場名→コードマップ
 TRACK_CODE_MAP = {
@@ -51,119 +31,103 @@ TRACK_CODE_MAP = {
 TARGET_DATE    = os.getenv("TARGET_DATE", date.today().isoformat())
 KAISAI_DATE    = TARGET_DATE.replace("-", "")
 
-# --- BigQuery client ---
-BQ_PROJECT = bigquery.Client().project
-BQ_DATASET = "jra_odds"
-BQ_TABLE   = f"{BQ_PROJECT}.{BQ_DATASET}.race"
+# --- 並列クロール設定 ---
+ENTRY_WORKERS  = int(os.getenv("ENTRY_WORKERS", "4"))      # 並列ワーカー数（各自ページを持つ）
+ENTRY_RPS      = float(os.getenv("ENTRY_RPS", "2"))        # 全ワーカー合計の毎秒リクエスト上限
+ENTRY_RETRIES  = int(os.getenv("ENTRY_RETRIES", "3"))      # レースごとの最大試行回数
 
 
-def build_race_urls(kaisai_date: str) -> list[dict]:
+def race_specs_from_titles(kaisai_date: str, titles: list[str]) -> list[dict]:
+    """
+    レース一覧の開催タイトル（例: "3回 東京 4日目"）から、
+    会場ごとに12レース分の出馬表 URL と venue 名を組み立てる。
+    race_id は 西暦4桁 + 会場コード + 回次2桁 + 日次2桁 + レース番号2桁。
+    """
+    year = kaisai_date[:4]  # race_id は西暦４桁から
+    specs = []
+    for title in titles:
+        parts    = title.split()                # 例: ["3回","東京","4日目"]
+        kaishu   = int(parts[0].replace("回",""))
+        venue_nm = parts[1]                     # 会場名文字列
+        nichime  = int(parts[2].replace("日目",""))
+
+        code = TRACK_CODE_MAP.get(venue_nm)
+        if code is None:
+            print(f"[WARN] 未定義の会場名: {venue_nm}")
+            continue
+
+        for no in range(1,13):
+            race_id = f"{year}{code}{kaishu:02d}{nichime:02d}{no:02d}"
+            specs.append({"url": nk.SHUTUBA_URL.format(race_id=race_id), "venue": venue_nm})
+    return specs
+
+
+def race_titles_http(kaisai_date: str) -> list[str]:
+    """レース一覧（race_list_sub.html の静的 HTML、ページキャッシュ経由）から開催タイトルを取る。取れなければ空。"""
+    if not nk.USE_HTTP_FAST_PATH:
+        return []
+    try:
+        soup = nk.fetch_soup(nk.RACE_LIST_SUB_URL.format(kaisai_date=kaisai_date))
+    except requests.RequestException as e:
+        logging.warning(f"[WARNING] HTTP レース一覧取得失敗 {kaisai_date}: {e}")
+        return []
+    return [el.get_text(" ", strip=True) for el in soup.select(".RaceList_DataList .RaceList_DataTitle")]
+
+
+def build_race_urls(kaisai_date: str, pool: Optional[BrowserPool] = None) -> list[dict]:
     """
     当日のレース一覧ページを開き、
     会場ごとに12レース分の出馬表 URL と venue 名を組み立てて返す。
+    静的 HTML で開催タイトルが取れればブラウザは使わない。
     """
-    list_url = f"https://race.netkeiba.com/top/race_list.html?kaisai_date={kaisai_date}"
-    print(f"[INFO] レース一覧ページ: {list_url}")
-
-    specs = []
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page(
-            user_agent=random.choice(USER_AGENTS),
-            viewport={"width": 1200, "height": 800}
-        )
-        page.goto(list_url, timeout=0)
-        page.wait_for_selector(".RaceList_DataTitle", timeout=20000)
-
-        year = kaisai_date[:4]  # race_id は西暦４桁から
-
-        for block in page.query_selector_all(".RaceList_DataList"):
-            title = block.query_selector(".RaceList_DataTitle") \
-                         .inner_text().strip()
-            parts    = title.split()                # 例: ["3回","東京","4日目"]
-            kaishu   = int(parts[0].replace("回",""))
-            venue_nm = parts[1]                     # 会場名文字列
-            nichime  = int(parts[2].replace("日目",""))
-
-            code = TRACK_CODE_MAP.get(venue_nm)
-            if code is None:
-                print(f"[WARN] 未定義の会場名: {venue_nm}")
-                continue
-
-            for no in range(1,13):
-                race_no = f"{no:02d}"
-                race_id = (
-                    f"{year}"
-                    f"{code}"
-                    f"{kaishu:02d}"
-                    f"{nichime:02d}"
-                    f"{race_no}"
-                )
-                url = (
-                    "https://race.netkeiba.com/race/shutuba.html"
-                    f"?race_id={race_id}"
-                )
-                specs.append({"url": url, "venue": venue_nm})
-                print(f"[DEBUG] {venue_nm} → {url}")
-
-        browser.close()
-
-    time.sleep(random.uniform(1,2))
+    titles = race_titles_http(kaisai_date)
+    if not titles:
+        list_url = f"https://race.netkeiba.com/top/race_list.html?kaisai_date={kaisai_date}"
+        print(f"[INFO] レース一覧ページ: {list_url}")
+        titles = (pool or get_pool()).run(race_titles_from_page, list_url)
+
+    specs = race_specs_from_titles(kaisai_date, titles)
+    for spec in specs:
+        print(f"[DEBUG] {spec['venue']} → {spec['url']}")
     return specs
 
 
-def fetch_race_detail(page, url: str) -> dict:
+async def race_titles_from_page(page, list_url: str) -> list[str]:
+    """描画後のレース一覧ページから開催タイトルを取る。"""
+    await nav.navigate_async(page, list_url, ".RaceList_DataTitle")
+    return [(await el.inner_text()).strip()
+            for el in await page.query_selector_all(".RaceList_DataList .RaceList_DataTitle")]
+
+
+async def fetch_race_detail(page, url: str) -> dict:
     """
     出馬表ページを読み込み、
     レースNo・レース名・発走時刻・芝orダート・距離・クラス・頭数 を抽出する。
     """
     print(f"[INFO] 詳細ページロード → {url}")
-    page.goto(url, timeout=0)
-    page.wait_for_selector(".RaceNum", timeout=15000)
-
-    # レースNo
-    race_no_text = page.query_selector(".RaceNum").inner_text().strip()
-    m = re.search(r"(\d+)R", race_no_text)
-    race_no = int(m.group(1)) if m else 0
-
-    # レース名
-    race_name = page.query_selector("h1.RaceName").inner_text().strip()
-
-    # RaceData01 から発走時刻／距離
-    data01 = page.query_selector(".RaceData01").inner_text()
-    tm = re.search(r"(\d{1,2}:\d{2})発走", data01)
-    start_time = tm.group(1) if tm else ""
-    dm = re.search(r"([芝ダ]\d+m)", data01)
-    distance_text = dm.group(1) if dm else ""
-    surface = "芝" if distance_text.startswith("芝") else "ダ"
-    distance = int(re.sub(r"\D","", distance_text)) if distance_text else 0
-
-    # RaceData02 内の <span> からクラス・頭数
-    spans = page.query_selector(".RaceData02").query_selector_all("span")
-    class_text = spans[4].inner_text().strip() if len(spans) > 4 else ""
-    entries = 0
-    for sp in spans:
-        t = sp.inner_text().strip()
-        if re.match(r"\d+頭", t):
-            entries = int(re.sub(r"\D","",t))
-            break
+    await nav.navigate_async(page, url, ".RaceNum")
+
+    # RaceNum / RaceName / RaceData01 / RaceData02 のテキストを集め、
+    # 解析は HTTP 高速パスと共通の race_info_from_texts に任せる
+    race_no_text = (await (await page.query_selector(".RaceNum")).inner_text()).strip()
+    race_name = (await (await page.query_selector("h1.RaceName")).inner_text()).strip()
+    data01 = await (await page.query_selector(".RaceData01")).inner_text()
+    spans = await (await page.query_selector(".RaceData02")).query_selector_all("span")
+    info = nk.race_info_from_texts(
+        race_no_text, race_name, data01,
+        [(await sp.inner_text()).strip() for sp in spans],
+    )
 
     detail = {
         "race_id":        url.split("race_id=")[-1],
-        "race_no":        race_no,
-        "race_name":      race_name,
-        "start_time":     start_time,
-        "track_surface":  surface,
-        "distance_m":     distance,
-        "race_class":     class_text,
-        "entries_count":  entries,
+        **info,
         "detail_url":     url,
     }
     # horse データを取って付与
-    detail["horses"] = fetch_horses(page)
+    detail["horses"] = await fetch_horses(page)
     return detail
 
-def fetch_horses(page) -> list[dict]:
+async def fetch_horses(page) -> list[dict]:
     """
     現在開いている出馬表ページから
     ・枠 waku
@@ -176,172 +140,122 @@ def fetch_horses(page) -> list[dict]:
     ・予想オッズ
     を全行取得して返す。
     """
-    page.wait_for_selector("table.Shutuba_Table tbody tr.HorseList", timeout=10000)
-    rows = page.query_selector_all("table.Shutuba_Table tbody tr.HorseList")
-    horses = []
-    import re
-    for r in rows:
-        # 馬名の要素を先に確認し、無ければその行はスキップ
-        name_el = r.query_selector("td.HorseInfo .HorseName a")
-        if not name_el:
-            logging.info("[INFO] データなし行をスキップ")
-            continue
-
-        # 枠
-        try:
-            waku_el = r.query_selector("td[class^='Waku'] span")
-            waku_txt = waku_el.inner_text().strip() if waku_el else ""
-        except Exception as e:
-            logging.warning(f"[WARNING] 枠の取得失敗: {e}")
-            waku_txt = ""
-
-        # 馬番
-        try:
-            num_el = r.query_selector("td[class^='Umaban']")
-            num_txt = num_el.inner_text().strip() if num_el else ""
-        except Exception as e:
-            logging.warning(f"[WARNING] 馬番の取得失敗: {e}")
-            num_txt = ""
-
-        # 馬名
-        try:
-            name = r.query_selector("td.HorseInfo .HorseName a").inner_text().strip()
-        except Exception as e:
-            logging.warning(f"[WARNING] 馬名の取得失敗: {e}")
-            name = ""
-
-        # 性別・年齢
-        try:
-            sex_age = r.query_selector("td.Barei").inner_text().strip()
-        except Exception as e:
-            logging.warning(f"[WARNING] 性齢の取得失敗: {e}")
-            sex_age = ""
-
-        # 馬体重
-        try:
-            wt_el = r.query_selector("td.Weight")
-            wt_txt = wt_el.inner_text().strip() if wt_el else ""
-            m_wt = re.search(r"(\d+)", wt_txt)
-            weight_val = int(m_wt.group(1)) if m_wt else None
-        except Exception as e:
-            logging.warning(f"[WARNING] 馬体重の取得失敗: {e}")
-            weight_val = None
-
-        # 騎手
-        try:
-            jockey = r.query_selector("td.Jockey a").inner_text().strip()
-        except Exception as e:
-            logging.warning(f"[WARNING] 騎手の取得失敗: {e}")
-            jockey = ""
-
-        # 調教師
-        try:
-            trainer = r.query_selector("td.Trainer a").inner_text().strip()
-        except Exception as e:
-            logging.warning(f"[WARNING] 調教師の取得失敗: {e}")
-            trainer = ""
-        
-        #予想オッズ
-        try:
-            odds_td = r.query_selector("td.Txt_R.Popular")
-            odds_span = odds_td.query_selector("span") if odds_td else None
-            odds_txt = odds_span.inner_text().strip() if odds_span else ""
-            expect_odds = float(odds_txt) if re.match(r"^\d+(\.\d+)?$", odds_txt) else None
-        except Exception as e:
-            logging.warning(f"[WARNING] 予想オッズの取得失敗: {e}")
-            odds = ""
-
-        horses.append({
-            "waku":     int(waku_txt) if waku_txt.isdigit() else None,
-            "number":   int(num_txt)   if num_txt.isdigit()   else None,
-            "name":     name,
-            "sex_age":  sex_age,
-            "weight":   weight_val,
-            "jockey":   jockey,
-            "trainer":  trainer,
-            "expect_odds": expect_odds,
-        })
+    await page.wait_for_selector(nk.HORSE_ROW_SELECTOR, timeout=10000)
+    # 全行のセルテキストを1回の evaluate で受け取り、Python 側で整形する
+    with metrics.span("parse.horses"):
+        rows = await page.eval_on_selector_all(nk.HORSE_ROW_SELECTOR, nk.HORSE_ROWS_JS)
+        horses = nk.horses_from_rows(rows)
+    metrics.inc("rows_parsed", len(horses), stage="parse.horses")
     return horses
 
-def upsert_entries():
-    client = bigquery.Client()
-
-    # ── テーブル作成 DDL ─────────────────────────────────────────
-    # horses を REPEATED RECORD で定義
-    ddl = f"""
-    CREATE TABLE IF NOT EXISTS `{BQ_TABLE}` (
-      race_id        STRING,
-      venue          STRING,
-      race_no        INT64,
-      race_name      STRING,
-      start_time     TIMESTAMP,
-      track_surface  STRING,
-      distance_m     INT64,
-      race_class     STRING,
-      entries_count  INT64,
-      detail_url     STRING,
-      horses         ARRAY<STRUCT<
-        waku       INT64,
-        number     INT64,
-        name       STRING,
-        sex_age    STRING,
-        weight     FLOAT64,
-        jockey     STRING,
-        trainer    STRING,
-        expect_odds FLOAT64
-      >>
-    )
+def fetch_race(spec: dict, pool: BrowserPool, limiter: RateLimiter = None) -> dict:
+    """
+    1レース分の詳細を取得し、venue と ISO 形式の start_time を付与して返す。
+    静的 HTML で揃えば HTTP のみ、欠けていれば Playwright で描画して取得する。
     """
-    time.sleep(3)
-    client.query(ddl).result()
-    time.sleep(3)
-    print(f"[INFO] Ensured table exists: {BQ_TABLE}")
-    # ─────────────────────────────────────────────────────────────
-
-    specs = build_race_urls(KAISAI_DATE)
-    races = []
-
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page(
-            user_agent=random.choice(USER_AGENTS),
-            viewport={"width":1200,"height":800}
+    url = spec["url"]
+    with metrics.span("race.detail_http", url=url):
+        detail = nk.fetch_race_detail_http(url, limiter)
+    if detail is None:
+        if limiter is not None:
+            limiter.wait()
+        with metrics.span("race.detail_browser", url=url):
+            detail = pool.run(fetch_race_detail, url)
+    # 取得レコードに venue と開催日（パーティション列）をセット
+    detail["venue"] = spec["venue"]         # → "東京" 等の文字列
+    detail["race_date"] = TARGET_DATE
+
+    # ISO フォーマット Timestamp に変換
+    if detail["start_time"]:
+        dt = datetime.strptime(
+            f"{KAISAI_DATE} {detail['start_time']}",
+            "%Y%m%d %H:%M"
         )
+        detail["start_time"] = dt.isoformat()
+    return detail
+
+
+def crawl_races(specs: list[dict], workers: int = ENTRY_WORKERS,
+                rps: float = ENTRY_RPS, retries: int = ENTRY_RETRIES) -> list[dict]:
+    """
+    specs を共有キューに積み、workers 個のスレッドで並列に取得する。
+    ・リクエスト開始は全ワーカー合計で rps 回/秒以下に制限（出馬表とオッズ API、描画ページを1回ずつ数える）
+    ・失敗したレースは指数バックオフで retries 回まで再試行
+    Playwright が必要になったレースはプロセスで共有する BrowserPool に渡す（Chromium は1つ）。
+    戻り値は specs の順に並べた取得成功分。
+    """
+    jobs = queue.Queue()
+    for i, spec in enumerate(specs):
+        jobs.put((i, spec))
+
+    limiter = RateLimiter(rps)
+    results = {}
+    failed = []
+    lock = threading.Lock()
+
+    def _worker():
+        pool = get_pool()
+        while True:
+            try:
+                i, spec = jobs.get_nowait()
+            except queue.Empty:
+                return
 
-        for spec in specs:
-            url   = spec["url"]
-            venue = spec["venue"]         # → "東京" 等の文字列
             try:
-                detail = fetch_race_detail(page, url)
-                # 取得レコードに venue をセット
-                detail["venue"] = venue
-
-                # ISO フォーマット Timestamp に変換
-                if detail["start_time"]:
-                    dt = datetime.strptime(
-                        f"{KAISAI_DATE} {detail['start_time']}",
-                        "%Y%m%d %H:%M"
-                    )
-                    detail["start_time"] = dt.isoformat()
-
-                races.append(detail)
-                time.sleep(random.uniform(0.5,1.5))
+                detail = retry_with_backoff(lambda: fetch_race(spec, pool, limiter),
+                                            attempts=retries, label=spec["url"])
+                with lock:
+                    results[i] = detail
             except Exception as e:
-                print(f"[ERROR] {url} のパース失敗: {e}", file=sys.stderr)
+                metrics.inc("failures", stage="parse.race")
+                print(f"[ERROR] {spec['url']} のパース失敗: {e}", file=sys.stderr)
+                with lock:
+                    failed.append(spec["url"])
+
+    threads = [threading.Thread(target=_worker, name=f"entries-{n}")
+               for n in range(max(1, min(workers, len(specs))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
 
-        browser.close()
+    if failed:
+        print(f"[WARN] 取得失敗 {len(failed)} 件: {failed}", file=sys.stderr)
+    return [results[i] for i in sorted(results)]
+
+
+def upsert_entries():
+    client = bigquery.Client()
+
+    # テーブル定義は scripts/schema.py で管理（ここでは DDL を発行しない）
+    with metrics.span("bq.schema_check"):
+        schema.require(client)
+    table = schema.table_id("race", client.project)
+
+    started = time.perf_counter()
+    # レース一覧を取得し、詳細はワーカーで並列取得
+    with metrics.span("race.list"):
+        specs = build_race_urls(KAISAI_DATE, get_pool())
+    with metrics.span("race.crawl", races=len(specs)):
+        races = crawl_races(specs)
+    elapsed = time.perf_counter() - started
+    print(f"[INFO] クロール完了: {len(races)}/{len(specs)} レース "
+          f"{elapsed:.1f} 秒 (workers={ENTRY_WORKERS}, rps={ENTRY_RPS})")
+    nav.STATS.log_summary()
+    page_cache.log_summary()
 
     if not races:
         print("[ERROR] レースデータ取得できず", file=sys.stderr)
         sys.exit(1)
 
-    # 一括 INSERT
-    errors = client.insert_rows_json(BQ_TABLE, races)
-    if errors:
-        print("[ERROR] BigQuery 登録エラー:", errors, file=sys.stderr)
+    # race_id で upsert（朝のジョブを再実行しても重複しない）
+    try:
+        result = bq_merge.merge_rows(client, "race", races)
+    except GoogleAPIError as e:
+        metrics.inc("failures", stage="bq.merge")
+        print(f"[ERROR] BigQuery 登録エラー: {e}", file=sys.stderr)
         sys.exit(1)
-
-    print(f"[INFO] {len(races)} 件のレースを登録しました → {BQ_TABLE}")
+    print(f"[INFO] {bq_merge.describe('race', result)} → {table}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,12 @@
+import os
+import tempfile
+
+# scripts.* は import 時に環境変数を読むので、テストでは先に書き出し先を一時ディレクトリへ向ける
+_TMP = tempfile.mkdtemp(prefix="jra_odds_test_")
+os.environ["METRICS"] = ""
+os.environ["PAGE_CACHE"] = "0"
+os.environ.setdefault("SAMPLER_STATE_DIR", os.path.join(_TMP, "state"))
+os.environ.setdefault("SCHEDULER_STATE_DIR", os.path.join(_TMP, "state"))
+os.environ.setdefault("RESULTS_STATE_DIR", os.path.join(_TMP, "state"))
+os.environ.setdefault("FLUCT_STATE_PATH", os.path.join(_TMP, "state", "fluctuation_state.json"))
+os.environ.setdefault("ODDS_SPOOL_PATH", os.path.join(_TMP, "spool", "odds_spool.sqlite3"))
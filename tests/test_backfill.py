@@ -0,0 +1,42 @@
+import json
+
+from scripts.backfill import BackfillState
+
+
+def _out(races, failed):
+    return {"races": [{"race_id": r} for r in races], "failed": failed}
+
+
+def test_date_with_failed_races_is_not_done(tmp_path):
+    state = BackfillState(str(tmp_path / "bf.json"))
+    state.record("2024-01-06", _out(["r01", "r02"], ["r03"]))
+    assert "2024-01-06" not in state.done
+    assert state.todo(["2024-01-06", "2024-01-07"]) == [("2024-01-06", ["r03"]), ("2024-01-07", None)]
+
+
+def test_retry_of_failed_races_completes_date(tmp_path):
+    path = str(tmp_path / "bf.json")
+    state = BackfillState(path)
+    state.record("2024-01-06", _out(["r01", "r02"], ["r03"]))
+    state.save()
+
+    # 再実行: 失敗したレースだけを取り直し、成功すれば done になる
+    state = BackfillState(path)
+    state.record("2024-01-06", _out(["r03"], []))
+    state.save()
+    assert state.done == {"2024-01-06": 3}
+    assert state.failed == {} and state.partial == {}
+    assert state.todo(["2024-01-06"]) == []
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f)["done"] == {"2024-01-06": 3}
+
+
+def test_date_level_error_retries_whole_day(tmp_path):
+    state = BackfillState(str(tmp_path / "bf.json"))
+    state.record_error("2024-01-06", RuntimeError("race_list timeout"))
+    assert state.todo(["2024-01-06"]) == [("2024-01-06", None)]
+
+    # 失敗レースの記録がある日付は、日付ごとの失敗で上書きしない
+    state.record("2024-01-07", _out(["r01"], ["r02"]))
+    state.record_error("2024-01-07", RuntimeError("timeout"))
+    assert state.todo(["2024-01-07"]) == [("2024-01-07", ["r02"])]
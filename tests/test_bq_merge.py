@@ -0,0 +1,140 @@
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import scripts.bq_merge as bq_merge
+
+
+def test_dedupe_keeps_last_row_per_key():
+    rows = [{"race_id": "r1", "horse_no": 1, "odds": 2.0},
+            {"race_id": "r1", "horse_no": 2, "odds": 5.0},
+            {"race_id": "r1", "horse_no": 1, "odds": 2.4}]
+    assert bq_merge.dedupe(rows, ["race_id", "horse_no"]) == [
+        {"race_id": "r1", "horse_no": 1, "odds": 2.4}, {"race_id": "r1", "horse_no": 2, "odds": 5.0}]
+
+
+def test_partition_range_only_when_partition_column_is_a_key():
+    assert bq_merge._partition_range("race_calendar", [{"race_date": "2025-06-02", "track": "東京"},
+                                                       {"race_date": date(2025, 6, 1), "track": "京都"}]) == \
+        ("race_date", "DATE", date(2025, 6, 1), date(2025, 6, 3))
+    assert bq_merge._partition_range("race_calendar", [{"race_date": None, "track": "東京"}]) is None
+    # キーがパーティション値を決めないテーブルは絞らない
+    assert bq_merge._partition_range("race", [{"race_id": "r1", "race_date": "2025-06-01"}]) is None
+    assert bq_merge._partition_range("odds_snapshot", [{"snapshot_at": "2025-06-01T15:00:00"}]) is None
+    assert bq_merge._partition_range("odds_ticks", [{"ts": "2025-06-01T06:00:00+00:00"}]) is None
+
+
+def test_merge_sql_uses_keys_and_prunes_partition():
+    sql = bq_merge.merge_sql("odds_snapshot", "p.jra_odds.odds_snapshot", "p.jra_odds._stage_x")
+    assert "ON T.race_id = S.race_id AND T.horse_no = S.horse_no AND T.label = S.label" in sql
+    assert "T.snapshot_at >= @lo AND T.snapshot_at < @hi" in sql
+    assert "UPDATE SET snapshot_at = S.snapshot_at, odds_jra = S.odds_jra" in sql
+    assert "label = S.label" not in sql.split("UPDATE SET")[1].split("\n")[0]   # キーは更新しない
+    assert "@lo" not in bq_merge.merge_sql("odds_snapshot", "t", "s", prune=False)
+
+
+def test_merge_sql_keys_only_table_inserts_only():
+    sql = bq_merge.merge_sql("race_calendar", "t", "s", prune=False)
+    assert "WHEN MATCHED" not in sql and "INSERT (race_date, track)" in sql
+
+
+def test_keyed():
+    assert bq_merge.keyed("p.jra_odds.odds_snapshot") == "odds_snapshot"
+    assert bq_merge.keyed("p.jra_odds.odds_ticks") is None
+    assert bq_merge.keyed("p.other.unknown") is None
+
+
+class FakeClient:
+    project = "p"
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.created, self.deleted, self.loaded, self.queries = [], [], [], []
+
+    def create_table(self, table):
+        self.created.append(str(table.reference))
+
+    def load_table_from_json(self, rows, table, job_config=None):
+        self.loaded.append(list(rows))
+        return SimpleNamespace(result=lambda: None)
+
+    def query(self, sql, job_config=None):
+        if self.fail:
+            raise RuntimeError("query failed")
+        self.queries.append((sql, {p.name: p.value for p in job_config.query_parameters}))
+        return SimpleNamespace(result=lambda: None,
+                               dml_stats=SimpleNamespace(inserted_row_count=1, updated_row_count=1))
+
+    def delete_table(self, table, not_found_ok=False):
+        self.deleted.append(str(table.reference))
+
+
+def _fluct(hn, value):
+    return {"race_id": "r1", "race_date": "2025-06-01", "horse_no": hn, "from_label": "first",
+            "to_label": "last", "fluctuation_value": value, "fluctuation_rate": value * 10}
+
+
+def test_merge_rows_stages_dedupes_and_counts():
+    client = FakeClient()
+    result = bq_merge.merge_rows(client, "odds_fluctuation", [_fluct(1, -1.0), _fluct(2, 0.5), _fluct(1, -2.0)])
+    assert result == {"inserted": 1, "updated": 1, "unchanged": 0}
+    assert client.loaded == [[_fluct(1, -2.0), _fluct(2, 0.5)]]
+    (sql, params), = client.queries
+    assert sql.startswith("MERGE `p.jra_odds.odds_fluctuation` T")
+    assert params == {} and "@lo" not in sql
+    assert client.created == client.deleted and client.created[0].startswith("p.jra_odds._stage_odds_fluctuation_")
+
+
+def test_merge_rows_drops_staging_on_failure_and_skips_empty():
+    client = FakeClient(fail=True)
+    with pytest.raises(RuntimeError):
+        bq_merge.merge_rows(client, "odds_fluctuation", [_fluct(1, -1.0)])
+    assert client.created == client.deleted != []
+    assert bq_merge.merge_rows(FakeClient(), "odds_fluctuation", []) == \
+        {"inserted": 0, "updated": 0, "unchanged": 0}
+
+
+def _merge_in_memory(name, table, rows):
+    """merge_rows が出す MERGE 文の ON 条件（キーの一致とパーティション範囲）を辞書の行で評価する。"""
+    import re
+    client = FakeClient()
+    bq_merge.merge_rows(client, name, rows)
+    (sql, params), = client.queries
+    on = sql.split("\nON ", 1)[1].split("\nWHEN", 1)[0]
+    keys = re.findall(r"T\.(\w+) = S\.\1", on)
+    bounds = re.findall(r"T\.(\w+) (>=|<) @(lo|hi)", on)
+
+    def matches(t, s):
+        if any(str(t[k]) != str(s[k]) for k in keys):
+            return False
+        return all((str(t[c]) >= str(params[p])) if op == ">=" else (str(t[c]) < str(params[p]))
+                   for c, op, p in bounds)
+    for s in bq_merge.dedupe(rows, bq_merge.schema.TABLES[name]["keys"]):
+        hit = next((t for t in table if matches(t, s)), None)
+        if hit is None:
+            table.append(dict(s))
+        else:
+            hit.update(s)
+    return table
+
+
+def test_remerge_with_changed_partition_value_updates_in_place():
+    # 延期で race_date が変わったレース
+    table = [{"race_id": "r1", "race_date": "2025-06-01", "race_name": "日本ダービー"}]
+    _merge_in_memory("race", table, [{"race_id": "r1", "race_date": "2025-06-08", "race_name": "日本ダービー"}])
+    assert table == [{"race_id": "r1", "race_date": "2025-06-08", "race_name": "日本ダービー"}]
+
+    # 同じラベルを取り直して snapshot_at が日をまたいだスナップショット
+    snap = [{"race_id": "r1", "horse_no": 1, "label": "post_race", "snapshot_at": "2025-06-01T23:59:00"}]
+    _merge_in_memory("odds_snapshot", snap,
+                     [{"race_id": "r1", "horse_no": 1, "label": "post_race", "snapshot_at": "2025-06-02T00:01:00"}])
+    assert len(snap) == 1 and snap[0]["snapshot_at"] == "2025-06-02T00:01:00"
+
+
+def test_remerge_calendar_prunes_and_stays_idempotent():
+    table = [{"race_date": "2025-06-01", "track": "東京"}]
+    rows = [{"race_date": "2025-06-01", "track": "東京"}, {"race_date": "2025-06-01", "track": "京都"}]
+    _merge_in_memory("race_calendar", table, rows)
+    _merge_in_memory("race_calendar", table, rows)
+    assert sorted(r["track"] for r in table) == ["京都", "東京"]
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import scripts.browser_pool as bp
+
+
+class FakeContext:
+    def __init__(self, browser):
+        self.browser = browser
+        self.closed = False
+
+    async def route(self, pattern, handler):
+        pass
+
+    async def new_page(self):
+        return self
+
+    async def close(self):
+        self.closed = True
+        self.browser.open_pages -= 1
+
+
+class FakeBrowser:
+    def __init__(self, pw):
+        self.pw = pw
+        self.closed = False
+        self.open_pages = 0
+
+    def is_connected(self):
+        return not self.closed
+
+    async def new_context(self, **kwargs):
+        self.open_pages += 1
+        self.pw.peak = max(self.pw.peak, sum(b.open_pages for b in self.pw.browsers))
+        ctx = FakeContext(self)
+        self.pw.contexts.append(ctx)
+        return ctx
+
+    async def close(self):
+        self.closed = True
+
+
+class FakePlaywright:
+    def __init__(self):
+        self.browsers, self.contexts, self.peak, self.stopped = [], [], 0, False
+        self.chromium = self
+
+    async def start(self):
+        return self
+
+    async def launch(self, headless=True):
+        self.browsers.append(FakeBrowser(self))
+        return self.browsers[-1]
+
+    async def stop(self):
+        self.stopped = True
+
+
+@pytest.fixture
+def fake_pw(monkeypatch):
+    pw = FakePlaywright()
+    monkeypatch.setattr(bp, "async_playwright", lambda: pw)
+    return pw
+
+
+async def _sleepy(page, seconds=0.02):
+    await asyncio.sleep(seconds)
+    return threading.current_thread().name
+
+
+def test_one_lazy_browser_shared_across_threads(fake_pw):
+    pool = bp.BrowserPool(max_pages=3)
+    try:
+        assert fake_pw.browsers == []   # 貸し出すまで起動しない
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            names = list(ex.map(lambda _: pool.run(_sleepy), range(16)))
+        assert len(fake_pw.browsers) == 1
+        assert set(names) == {"browser-pool"}
+        assert fake_pw.peak <= 3
+        assert all(c.closed for c in fake_pw.contexts)
+    finally:
+        pool.close()
+    assert fake_pw.browsers[0].closed and fake_pw.stopped
+
+
+def test_recycles_after_max_uses_without_closing_open_pages(fake_pw):
+    pool = bp.BrowserPool(max_uses=2)
+    try:
+        slow = pool.submit(_sleepy, 0.2)
+        time.sleep(0.05)
+        pool.run(_sleepy)
+        pool.run(_sleepy)   # 3回目で再起動
+        first, second = fake_pw.browsers
+        assert not first.closed   # 使用中のページが残っている間は閉じない
+        slow.result(1)
+        assert first.closed and not second.closed
+    finally:
+        pool.close()
+
+
+def test_relaunches_after_disconnect(fake_pw):
+    pool = bp.BrowserPool()
+    try:
+        pool.run(_sleepy)
+        fake_pw.browsers[0].closed = True   # クラッシュ
+        pool.run(_sleepy)
+        assert len(fake_pw.browsers) == 2
+    finally:
+        pool.close()
+
+
+def test_run_timeout_closes_the_page(fake_pw):
+    pool = bp.BrowserPool()
+    try:
+        with pytest.raises(TimeoutError):
+            pool.run(_sleepy, 5, timeout=0.05)
+        time.sleep(0.05)
+        assert fake_pw.contexts[0].closed
+    finally:
+        pool.close()
+
+
+def test_get_pool_is_process_wide(fake_pw):
+    try:
+        with ThreadPoolExecutor(max_workers=4) as ex:
+            pools = set(ex.map(lambda _: id(bp.get_pool()), range(8)))
+        assert len(pools) == 1
+    finally:
+        bp.close_pool()
@@ -0,0 +1,126 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import scripts.calc_fluctuation as cf
+
+
+def _rows(out, frm, to):
+    return {r["horse_no"]: round(r["fluctuation_value"], 6) for r in out
+            if (r["from_label"], r["to_label"]) == (frm, to)}
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / "fluctuation_state.json")
+
+
+def test_incremental_emits_adjacent_and_first_to_last(state_path):
+    inc = cf.IncrementalFluctuation(state_path)
+    assert inc.update("r1", "1h_before", {1: 4.0, 2: 10.0}) == []
+    out = inc.update("r1", "30m_before", {1: 3.0, 2: 12.0})
+    assert _rows(out, "1h_before", "30m_before") == {1: -1.0, 2: 2.0}
+    assert _rows(out, "first", "last") == {1: -1.0, 2: 2.0}
+
+    out = inc.update("r1", "5m_before", {1: 2.0, 2: 15.0})
+    assert _rows(out, "30m_before", "5m_before") == {1: -1.0, 2: 3.0}
+    # first→last は最初のラベル（1h_before）からの変動で作り直す
+    assert _rows(out, "first", "last") == {1: -2.0, 2: 5.0}
+    (row,) = [r for r in out if r["horse_no"] == 1 and r["from_label"] == "first"]
+    assert row["fluctuation_rate"] == pytest.approx(-50.0)
+
+
+def test_incremental_skipped_label_emits_no_non_adjacent_pair(state_path):
+    inc = cf.IncrementalFluctuation(state_path)
+    inc.update("r1", "1h_before", {1: 4.0})
+    out = inc.update("r1", "5m_before", {1: 2.0})   # 30m_before を見送った
+    assert {(r["from_label"], r["to_label"]) for r in out} == {("first", "last"), ("min", "max")}
+
+
+def _merged(rows):
+    """MERGE（キーごとに後勝ち）した後の行。"""
+    keys = ["race_id", "horse_no", "from_label", "to_label"]
+    latest = {tuple(r[k] for k in keys): round(r["fluctuation_value"], 9) for r in rows}
+    return latest
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_incremental_matches_batch(state_path, seed):
+    rng = np.random.default_rng(seed)
+    snaps = []
+    for label in cf.LABEL_ORDER:
+        for rid in ("r1", "r2"):
+            odds = {hn: round(float(rng.uniform(1, 50)), 1) for hn in range(1, 9) if rng.random() < 0.7}
+            if odds:
+                snaps.append((rid, label, odds))
+    inc = cf.IncrementalFluctuation(state_path)
+    live = [r for rid, label, odds in snaps for r in inc.update(rid, label, odds)]
+
+    df = pd.DataFrame([{"race_id": rid, "horse_no": hn, "label": label, "odds_avg": o}
+                       for rid, label, odds in snaps for hn, o in odds.items()])
+    batch = cf.fluctuation_from_cube(*cf.build_odds_cube(df)).to_dict(orient="records")
+    assert _merged(live) == _merged(batch)
+
+
+def test_incremental_debounces_saves_and_restores(state_path):
+    inc = cf.IncrementalFluctuation(state_path, save_seconds=3600)
+    inc.update("r1", "1h_before", {1: 4.0})   # 新しい馬はすぐ保存する
+    with open(state_path, encoding="utf-8") as f:
+        assert json.load(f)["races"]["r1"]["1"] == {"1h_before": 4.0}
+
+    inc.update("r1", "30m_before", {1: 3.0})
+    with open(state_path, encoding="utf-8") as f:
+        assert json.load(f)["races"]["r1"]["1"] == {"1h_before": 4.0}   # まだ書き出さない
+    inc.flush()
+
+    restored = cf.IncrementalFluctuation(state_path)
+    out = restored.update("r1", "5m_before", {1: 2.0})
+    assert _rows(out, "30m_before", "5m_before") == {1: -1.0}
+    assert _rows(out, "first", "last") == {1: -2.0}
+
+
+@pytest.mark.parametrize("old", [["30m_before", 4.0],
+                                 {"first": ["30m_before", 4.0], "last": ["30m_before", 4.0]}])
+def test_incremental_reads_old_state_format(state_path, old):
+    inc = cf.IncrementalFluctuation(state_path)
+    with open(state_path, "w", encoding="utf-8") as f:
+        json.dump({"date": inc._today, "races": {"r1": {"1": old}}}, f)
+    out = cf.IncrementalFluctuation(state_path).update("r1", "5m_before", {1: 5.0})
+    assert _rows(out, "30m_before", "5m_before") == {1: 1.0}
+    assert _rows(out, "first", "last") == {1: 1.0}
+
+
+def test_cube_keeps_last_duplicate_and_drops_unknown_labels():
+    df = pd.DataFrame([
+        {"race_id": "r2", "horse_no": 3, "label": "1h_before", "odds_avg": 5.0},
+        {"race_id": "r1", "horse_no": 1, "label": "1h_before", "odds_avg": 2.0},
+        {"race_id": "r1", "horse_no": 1, "label": "1h_before", "odds_avg": 2.5},
+        {"race_id": "r1", "horse_no": 1, "label": "interim", "odds_avg": 9.9},
+    ])
+    race_ids, horse_nos, cube = cf.build_odds_cube(df)
+    assert race_ids.tolist() == ["r1", "r2"] and horse_nos.tolist() == [1, 3]
+    assert cube.shape == (2, 2, len(cf.LABEL_ORDER))
+    assert cube[0, 0, 0] == 2.5
+    assert np.isnan(cube[0, 1]).all() and np.isnan(cube[1, 0]).all()
+
+
+def test_cube_fluctuation_pairs_first_last_and_swing():
+    df = pd.DataFrame([{"race_id": "r1", "horse_no": 1, "label": label, "odds_avg": o}
+                       for label, o in [("1h_before", 4.0), ("5m_before", 2.0), ("post_race", 3.0)]]
+                      + [{"race_id": "r1", "horse_no": 2, "label": "30m_before", "odds_avg": 7.0}])
+    out = cf.fluctuation_from_cube(*cf.build_odds_cube(df)).to_dict(orient="records")
+    assert _rows(out, "5m_before", "post_race") == {1: 1.0}
+    assert _rows(out, "1h_before", "30m_before") == {}   # 30m_before が欠けている馬は出さない
+    assert _rows(out, "first", "last") == {1: -1.0}       # 1ラベルしかない馬2は出さない
+    assert _rows(out, "min", "max") == {1: 2.0}
+    (swing,) = [r for r in out if r["from_label"] == "min"]
+    assert swing["fluctuation_rate"] == pytest.approx(100.0)
+
+
+def test_cube_skips_zero_base_odds():
+    df = pd.DataFrame([{"race_id": "r1", "horse_no": 1, "label": "1h_before", "odds_avg": 0.0},
+                       {"race_id": "r1", "horse_no": 1, "label": "30m_before", "odds_avg": 3.0}])
+    out = cf.fluctuation_from_cube(*cf.build_odds_cube(df))
+    assert out[out["from_label"] == "1h_before"].empty   # 率が無限大になる行は出さない
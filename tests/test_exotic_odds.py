@@ -0,0 +1,44 @@
+import base64
+import itertools
+
+import numpy as np
+
+import scripts.exotic_odds as ex
+
+
+def _api(bet, n):
+    _, k, ordered = ex.BET_TYPES[bet]
+    gen = itertools.permutations(range(1, n + 1), k) if ordered else itertools.combinations(range(1, n + 1), k)
+    return {"".join(f"{h:02d}" for h in c): [f"{10 + i * 0.1:.1f}", f"{20 + i * 0.1:.1f}", "1"]
+            for i, c in enumerate(gen)}
+
+
+def test_encode_decode_round_trip_all_bets():
+    for bet in ex.BET_TYPES:
+        matrix = ex.parse_api(_api(bet, 8), bet)
+        back = ex.decode(ex.encode(matrix, bet), bet, 8)
+        np.testing.assert_allclose(np.nan_to_num(back), np.nan_to_num(matrix), atol=0.05)
+
+
+def test_parse_api_indexes_by_horse_number_and_skips_scratched():
+    api = _api("umatan", 5)
+    api["0305"] = ["---.-", "", ""]   # 取消
+    m = ex.parse_api(api, "umatan")
+    assert m.shape == (5, 5)
+    assert m[0, 1] == np.float32(10.0)        # "0102" が正準順の先頭
+    assert np.isnan(m[2, 4]) and np.isnan(m[1, 1])
+
+
+def test_capture_is_rate_limited_and_builds_rows(monkeypatch):
+    waits = []
+    monkeypatch.setattr(ex._limiter, "wait", lambda: waits.append(1))
+    monkeypatch.setattr(ex.nk, "fetch_odds_api", lambda rid, t, *a, **k: _api(
+        {4: "umaren", 8: "sanrentan"}[t], 6))
+    rows = ex.capture([("r1", "2025-06-01", "5m_before", 6), ("r2", "2025-06-01", "5m_before", 6)],
+                      bets=["umaren", "sanrentan"])
+    assert len(waits) == 4 and len(rows) == 4
+    row = next(r for r in rows if r["race_id"] == "r1" and r["bet_type"] == "sanrentan")
+    assert row["n_horses"] == 6
+    m = ex.decode(base64.b64decode(row["odds"]), "sanrentan", 6)
+    assert np.isfinite(ex.to_vector(m, "sanrentan")).all()
+
@@ -0,0 +1,40 @@
+import json
+from datetime import date, datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from scripts.export_sheets import COLUMNS, build_grids, to_cell
+
+
+def test_to_cell_timestamp_is_json_serializable():
+    # race.start_time（日本時間の壁時計の TIMESTAMP）は UTC 付きの pd.Timestamp で返る
+    ts = pd.Timestamp("2025-06-01 15:40:00", tz="UTC")
+    assert to_cell(ts) == "2025-06-01 15:40"
+    assert to_cell(datetime(2025, 6, 1, 15, 40, tzinfo=timezone.utc)) == "2025-06-01 15:40"
+    assert to_cell(date(2025, 6, 1)) == "2025-06-01"
+    json.dumps([to_cell(ts)])
+
+
+def test_to_cell_missing_and_numpy_values():
+    assert to_cell(None) == ""
+    assert to_cell(np.nan) == ""
+    assert to_cell(pd.NaT) == ""
+    assert to_cell(pd.NA) == ""
+    v = to_cell(np.int64(3))
+    assert v == 3 and type(v) is int
+    assert type(to_cell(np.float64(1.5))) is float
+    assert to_cell("") == ""
+
+
+def test_build_grids_rows_serialize():
+    row = {col: None for _, col in COLUMNS}
+    row.update({"race_id": "202505021211", "venue": "東京", "race_no": np.int64(11),
+                "start_time": pd.Timestamp("2025-06-01 15:40", tz="UTC"),
+                "horse_no": np.int64(1), "odds_1h": np.float64(3.2)})
+    df = pd.DataFrame([row])
+    grids = build_grids(df)
+    json.dumps(grids, ensure_ascii=False)
+    (grid,) = grids.values()
+    assert grid[0] == [title for title, _ in COLUMNS]
+    assert len(grid) == 2
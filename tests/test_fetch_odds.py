@@ -0,0 +1,141 @@
+import asyncio
+import time
+
+import pytest
+
+import scripts.fetch_odds as fo
+import scripts.odds_sources as src
+
+TS = "2025-06-01T06:00:00+00:00"
+
+
+def _odds(*pairs):
+    return [{"number": n, "odds": o, "timestamp": TS} for n, o in pairs]
+
+
+@pytest.fixture
+def fetchers(monkeypatch):
+    calls = []
+
+    def install(**behaviours):
+        def make(name, behaviour):
+            def fetch(race_id, deadline):
+                calls.append(name)
+                return behaviour()
+            return fetch
+        monkeypatch.setattr(src, "_FETCHERS", {k: make(k, v) for k, v in behaviours.items()})
+        return calls
+    return install
+
+
+def _fail():
+    raise RuntimeError("boom")
+
+
+def test_primary_only_when_it_answers(fetchers):
+    calls = fetchers(jra=lambda: _odds((1, 2.5), (2, 4.0)), netkeiba=lambda: _odds((1, 9.9)))
+    res = src.fetch_with_fallback("r1", deadline=2, sources=["jra", "netkeiba"], fallback_after=1)
+    assert calls == ["jra"]
+    assert res["sources"] == ["jra"] and res["requests"] == 1
+    assert [e["odds"] for e in res["odds_list"]] == [2.5, 4.0]   # 平均しない
+    assert res["by_source"] == {"jra": {1: 2.5, 2: 4.0}}
+
+
+@pytest.mark.parametrize("primary", [_fail, lambda: []])
+def test_fallback_on_error_or_empty(fetchers, primary):
+    calls = fetchers(jra=primary, netkeiba=lambda: _odds((1, 3.0)))
+    res = src.fetch_with_fallback("r1", deadline=2, sources=["jra", "netkeiba"], fallback_after=1)
+    assert calls == ["jra", "netkeiba"]
+    assert res["sources"] == ["netkeiba"] and res["requests"] == 2
+
+
+def test_fallback_when_primary_is_slow(fetchers):
+    def slow():
+        time.sleep(0.5)
+        return _odds((1, 2.5))
+    calls = fetchers(jra=slow, netkeiba=lambda: _odds((1, 3.0)))
+    started = time.perf_counter()
+    res = src.fetch_with_fallback("r1", deadline=2, sources=["jra", "netkeiba"], fallback_after=0.1)
+    assert time.perf_counter() - started < 0.4
+    assert calls == ["jra", "netkeiba"]
+    assert res["sources"] == ["netkeiba"]
+
+
+def test_nothing_within_deadline(fetchers):
+    fetchers(jra=lambda: (time.sleep(0.3), _odds((1, 2.5)))[1])
+    res = src.fetch_with_fallback("r1", deadline=0.1, sources=["jra"], fallback_after=1)
+    assert res["odds_list"] == [] and res["sources"] == [] and res["requests"] == 1
+
+
+def test_async_fallback_on_error(fetchers):
+    calls = fetchers(jra=_fail, netkeiba=lambda: _odds((1, 3.0)))
+    res = asyncio.run(src.fetch_with_fallback_async("r1", deadline=2, sources=["jra"],
+                                                    fallback_after=1))
+    assert calls == ["jra"] and res["odds_list"] == []
+
+    async def fake_netkeiba(race_id, deadline):
+        return _odds((1, 3.0))
+    src.fetch_netkeiba_async, orig = fake_netkeiba, src.fetch_netkeiba_async
+    try:
+        res = asyncio.run(src.fetch_with_fallback_async("r1", deadline=2,
+                                                        sources=["jra", "netkeiba"], fallback_after=1))
+    finally:
+        src.fetch_netkeiba_async = orig
+    assert res["sources"] == ["netkeiba"] and res["requests"] == 2
+
+
+def test_snapshot_rows_fill_only_adopted_source_column():
+    rec = {"race_id": "r1", "minutes_before_race": 5, **src._result("jra", _odds((1, 2.5)), 1)}
+    (row,) = fo.to_snapshot_rows(rec, "5m_before")
+    assert row["odds_jra"] == 2.5 and row["odds_netkeiba"] is None and row["odds_avg"] == 2.5
+    assert row["snapshot_at"] == "2025-06-01T15:00:00"   # 日本時間の DATETIME
+    assert fo.race_date_of(rec) == "2025-06-01"
+
+
+def test_batch_does_not_start_a_browser_when_jra_answers(fetchers, monkeypatch):
+    fetchers(jra=lambda: _odds((1, 2.5)))
+    monkeypatch.setattr(src, "get_pool", lambda: pytest.fail("ブラウザを使った"))
+    records = fo.fetch_odds_batch([("r1", 5), ("r2", 5)], host_interval=0)
+    assert sorted(r["race_id"] for r in records) == ["r1", "r2"]
+
+
+def test_async_netkeiba_renders_on_shared_pool(monkeypatch):
+    from concurrent.futures import Future
+    submitted = []
+
+    class FakePool:
+        def submit(self, fn, *args):
+            submitted.append((fn, args))
+            fut = Future()
+            fut.set_result(_odds((1, 3.0)))
+            return fut
+    monkeypatch.setattr(src, "get_pool", FakePool)
+    monkeypatch.setattr(src.nk, "fetch_soup", lambda *a, **k: src.nk.BeautifulSoup("", "html.parser"))
+    odds = asyncio.run(src.fetch_netkeiba_async("r1", deadline=2))
+    assert [e["odds"] for e in odds] == [3.0]
+    ((fn, (race_id, url, remaining)),) = submitted
+    assert fn is src._odds_from_page and race_id == "r1" and 0 < remaining <= 2
+
+
+def test_fallback_gets_only_the_remaining_deadline(monkeypatch):
+    given = {}
+
+    def record(name, result, delay=0.0):
+        def fetch(race_id, deadline):
+            given[name] = deadline
+            time.sleep(delay)
+            return result
+        return fetch
+    monkeypatch.setattr(src, "_FETCHERS", {"jra": record("jra", [], delay=0.3),
+                                           "netkeiba": record("netkeiba", _odds((1, 3.0)))})
+    src.fetch_with_fallback("r1", deadline=1, sources=["jra", "netkeiba"], fallback_after=0.2)
+    assert given["jra"] == pytest.approx(1, abs=0.05)
+    assert 0.7 < given["netkeiba"] < 0.85
+
+    async def netkeiba_async(race_id, deadline):
+        given["netkeiba_async"] = deadline
+        return _odds((1, 3.0))
+    monkeypatch.setattr(src, "fetch_netkeiba_async", netkeiba_async)
+    asyncio.run(src.fetch_with_fallback_async("r1", deadline=1, sources=["jra", "netkeiba"],
+                                              fallback_after=0.2))
+    assert 0.7 < given["netkeiba_async"] < 0.85
@@ -0,0 +1,62 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import scripts.mirror as mirror
+
+
+class _Job(list):
+    def __init__(self, rows=(), df=None):
+        super().__init__(rows)
+        self._df = df
+
+    def to_dataframe(self):
+        return self._df
+
+
+class FakeClient:
+    """日別の行数・チェックサムのクエリと、パーティションの取り込みクエリだけに答える。"""
+    project = "p"
+
+    def __init__(self, days):
+        self.days = days   # 日付 → DataFrame
+        self.pulls = 0
+
+    def query(self, sql):
+        if "BIT_XOR" in sql:
+            return _Job([{"d": date.fromisoformat(d), "n": len(df),
+                          "checksum": int(pd.util.hash_pandas_object(df, index=False).sum() % 2**62)}
+                         for d, df in self.days.items()])
+        self.pulls += 1
+        wanted = [d for d in self.days if f"'{d}'" in sql]
+        return _Job(df=pd.concat([df.assign(_d=pd.Timestamp(d)) for d, df in self.days.items()
+                                  if d in wanted]))
+
+
+@pytest.fixture(autouse=True)
+def mirror_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(mirror, "MIRROR_DIR", str(tmp_path))
+
+
+def test_stale_dates_compares_rows_and_checksum():
+    local = {"2025-06-01": {"rows": 2, "checksum": 1}, "2025-06-02": 3}
+    remote = {"2025-06-01": {"rows": 2, "checksum": 1}, "2025-06-02": {"rows": 3, "checksum": 5},
+              "2025-06-03": {"rows": 1, "checksum": 7}}
+    assert mirror.stale_dates(remote, local) == ["2025-06-02", "2025-06-03"]
+    remote["2025-06-01"] = {"rows": 2, "checksum": 9}   # 行数は同じで内容だけ変わった
+    assert "2025-06-01" in mirror.stale_dates(remote, local)
+
+
+def test_sync_repulls_day_updated_in_place():
+    day = pd.DataFrame({"race_id": ["r1", "r2"], "finish_position": [1, 2]})
+    client = FakeClient({"2025-06-01": day})
+    assert mirror.sync("2025-06-01", "2025-06-01", ["race_results"], client) == {"race_results": 1}
+    assert mirror.sync("2025-06-01", "2025-06-01", ["race_results"], client) == {"race_results": 0}
+
+    # MERGE で着順が訂正された（行数は同じ）
+    client.days["2025-06-01"] = day.assign(finish_position=[2, 1])
+    assert mirror.sync("2025-06-01", "2025-06-01", ["race_results"], client) == {"race_results": 1}
+    got = mirror.read("race_results", "2025-06-01")
+    assert got["finish_position"].tolist() == [2, 1]
+    assert client.pulls == 2
@@ -0,0 +1,156 @@
+import pytest
+from google.api_core.exceptions import BadRequest, Conflict
+
+import scripts.odds_spool as odds_spool
+
+TICKS = "p.jra_odds.odds_ticks"          # 自然キーなし → ロードジョブで追記
+SNAPSHOT = "p.jra_odds.odds_snapshot"    # 自然キーあり → MERGE
+
+
+class FakeJob:
+    def __init__(self, error=None):
+        self.error = error
+        self.error_result = {"reason": "invalid"} if error else None
+
+    def result(self):
+        if self.error:
+            raise self.error
+
+    def done(self):
+        return True
+
+
+class FakeClient:
+    """job_id ごとに1回だけ行を書き込む BigQuery の代わり。"""
+    project = "p"
+
+    def __init__(self, fail_with=None):
+        self.fail_with = fail_with
+        self.jobs = {}
+        self.written = []
+        self.calls = 0
+
+    def load_table_from_json(self, rows, table_id, job_id=None, job_config=None):
+        self.calls += 1
+        if job_id in self.jobs:
+            raise Conflict(f"Already Exists: Job {job_id}")
+        self.jobs[job_id] = FakeJob(self.fail_with)
+        if self.fail_with is None:
+            self.written.extend(rows)
+        return self.jobs[job_id]
+
+    def get_job(self, job_id):
+        return self.jobs[job_id]
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return odds_spool.OddsSpool(str(tmp_path / "spool.sqlite3"))
+
+
+def _rows(n):
+    return [{"race_id": "r1", "seq": i} for i in range(n)]
+
+
+def test_flush_loads_and_empties_spool(spool):
+    spool.append(TICKS, _rows(3))
+    assert spool.pending()[TICKS]["rows"] == 3
+    client = FakeClient()
+    assert spool.flush(client) == 3
+    assert client.written == _rows(3)
+    assert spool.pending() == {}
+    assert spool.flush(client) == 0
+
+
+def test_retry_after_crash_reuses_job_id_and_writes_once(spool, monkeypatch):
+    spool.append(TICKS, _rows(2))
+    client = FakeClient()
+    finish = spool._finish_batch
+
+    def crash(batch_id):
+        raise RuntimeError("killed before the batch was marked done")
+    monkeypatch.setattr(spool, "_finish_batch", crash)
+    with pytest.raises(RuntimeError):
+        spool.flush(client)
+
+    # 再実行では同じ job_id で投入し、Conflict から前回のジョブの結果を確認する
+    monkeypatch.setattr(spool, "_finish_batch", finish)
+    assert spool.flush(client) == 2
+    assert client.written == _rows(2)
+    assert len(client.jobs) == 1 and client.calls == 2
+    assert spool.pending() == {}
+
+
+def test_failed_load_is_quarantined_after_max_attempts(spool):
+    spool.append(TICKS, _rows(1))
+    client = FakeClient(fail_with=BadRequest("bad row"))
+    for _ in range(odds_spool.MAX_LOAD_ATTEMPTS):
+        with pytest.raises(BadRequest):
+            spool.flush(client)
+    # 試行ごとに別 job_id で出し直している
+    assert len(client.jobs) == odds_spool.MAX_LOAD_ATTEMPTS
+    ((batch_id, table_id, rows),) = spool.failed_batches()
+    assert (table_id, rows) == (TICKS, 1)
+    assert spool.pending() == {} and not spool.should_flush(max_rows=1, interval=0)
+
+    # 隔離後に追記された行は別バッチで流れる
+    spool.append(TICKS, _rows(1))
+    client.fail_with = None
+    assert spool.flush(client) == 1
+    assert len(spool.failed_batches()) == 1
+
+
+def test_keyed_table_goes_through_merge(spool, monkeypatch):
+    merged = []
+
+    def fake_merge(client, name, rows):
+        merged.append((name, rows))
+        return {"inserted": len(rows), "updated": 0, "unchanged": 0}
+    monkeypatch.setattr(odds_spool.bq_merge, "merge_rows", fake_merge)
+    spool.append(SNAPSHOT, [{"race_id": "r1", "horse_no": 1, "label": "1h_before"}])
+    client = FakeClient()
+    assert spool.flush(client) == 1
+    assert merged == [("odds_snapshot", [{"race_id": "r1", "horse_no": 1, "label": "1h_before"}])]
+    assert client.calls == 0
+
+
+def test_merge_bad_request_is_quarantined(spool, monkeypatch):
+    def bad(client, name, rows):
+        raise BadRequest("invalid value")
+    monkeypatch.setattr(odds_spool.bq_merge, "merge_rows", bad)
+    spool.append(SNAPSHOT, [{"race_id": "r1", "horse_no": 1, "label": "1h_before"}])
+    for _ in range(odds_spool.MAX_LOAD_ATTEMPTS):
+        with pytest.raises(BadRequest):
+            spool.flush(FakeClient())
+    assert [t for _, t, _ in spool.failed_batches()] == [SNAPSHOT]
+    assert spool.flush(FakeClient()) == 0
+
+
+def test_failing_table_does_not_block_other_tables(spool, monkeypatch):
+    def bad(client, name, rows):
+        raise RuntimeError("merge backend unavailable")
+    monkeypatch.setattr(odds_spool.bq_merge, "merge_rows", bad)
+    spool.append(SNAPSHOT, [{"race_id": "r1", "horse_no": 1, "label": "1h_before"}])
+    spool.append(TICKS, _rows(2))
+    client = FakeClient()
+    with pytest.raises(RuntimeError):
+        spool.flush(client)
+    # 壊れたテーブルの後ろでも、他のテーブルは同じ flush で登録済み
+    assert client.written == _rows(2)
+    assert list(spool.pending()) == [SNAPSHOT]
+    assert spool.failed_batches() == []   # 1回目はまだ隔離しない
+
+
+def test_old_spool_file_gets_job_id_column(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "old.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE batches (batch_id TEXT PRIMARY KEY, table_id TEXT NOT NULL,
+          attempt INTEGER NOT NULL DEFAULT 0, rows INTEGER NOT NULL, state TEXT NOT NULL,
+          created_at REAL NOT NULL, done_at REAL);
+    """)
+    conn.close()
+    spool = odds_spool.OddsSpool(path)
+    spool.append(TICKS, _rows(1))
+    assert spool.flush(FakeClient()) == 1
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import scripts.sampler as sampler
+
+JST = timezone(timedelta(hours=9))
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(sampler, "STATE_DIR", str(tmp_path))
+
+
+def test_post_time_jst_keeps_wall_clock_of_utc_timestamp():
+    # BigQuery は日本時間の壁時計を入れた TIMESTAMP を UTC 付きで返す
+    st = datetime(2025, 6, 1, 15, 40, tzinfo=timezone.utc)
+    assert sampler.post_time_jst(st) == datetime(2025, 6, 1, 15, 40, tzinfo=JST)
+
+
+def test_post_time_jst_naive_and_jst_inputs():
+    assert sampler.post_time_jst(datetime(2025, 6, 1, 15, 40)) == datetime(2025, 6, 1, 15, 40, tzinfo=JST)
+    jst = datetime(2025, 6, 1, 15, 40, tzinfo=JST)
+    assert sampler.post_time_jst(jst) == jst
+
+
+def test_sampler_start_from_tz_aware_timestamp():
+    st = datetime(2025, 6, 1, 15, 40, tzinfo=timezone.utc)
+    s = sampler.AdaptiveSampler([("r1", st)], date_str="2025-06-01")
+    assert s.races["r1"]["start"] == datetime(2025, 6, 1, 15, 40, tzinfo=JST)
+
+    # 1時間前のチェックポイントは 14:40 JST に来る
+    assert s.due(datetime(2025, 6, 1, 14, 39, tzinfo=JST)) == [("r1", "interim", 61)]
+    assert s.due(datetime(2025, 6, 1, 14, 40, 5, tzinfo=JST)) == [("r1", "1h_before", 60)]
+
+
+def test_sampler_restores_followed_start_time(tmp_path):
+    st = datetime(2025, 6, 1, 15, 40, tzinfo=timezone.utc)
+    s = sampler.AdaptiveSampler([("r1", st)], date_str="2025-06-01")
+    s.races["r1"]["start"] = datetime(2025, 6, 1, 15, 55, tzinfo=JST)   # 発走時刻の変更に追従した
+    s.mark("r1", "1h_before", datetime(2025, 6, 1, 14, 56, tzinfo=JST))
+
+    restored = sampler.AdaptiveSampler([("r1", st)], date_str="2025-06-01")
+    assert restored.races["r1"]["start"] == datetime(2025, 6, 1, 15, 55, tzinfo=JST)
+    assert restored.races["r1"]["done"] == {"1h_before"}
+
+
+def test_checkpoint_past_grace_is_skipped():
+    skipped = []
+    st = datetime(2025, 6, 1, 15, 40, tzinfo=timezone.utc)
+    s = sampler.AdaptiveSampler([("r1", st)], date_str="2025-06-01",
+                                on_skip=lambda *a: skipped.append(a[:2]))
+    s.due(datetime(2025, 6, 1, 15, 20, tzinfo=JST))
+    # 1h_before は 30m_before より古いので見送り、30m_before は猶予（120秒）を超えて遅れている
+    assert skipped == [("r1", "1h_before"), ("r1", "30m_before")]
+
+
+def test_charge_and_try_spend_count_against_budget():
+    st = datetime(2025, 6, 1, 15, 40, tzinfo=timezone.utc)
+    s = sampler.AdaptiveSampler([("r1", st)], date_str="2025-06-01", budget=10)
+    s.charge(3)
+    s.charge(0)
+    assert s.spent == 3
+    assert s.try_spend(7)
+    assert not s.try_spend(1)
+    assert s.spent == 10
+    # 消費数は状態ファイルに残る
+    assert sampler.AdaptiveSampler([("r1", st)], date_str="2025-06-01").spent == 10
+
+
+def test_checkpoint_cost_reserves_budget_for_checkpoints():
+    st = datetime(2025, 6, 1, 15, 40, tzinfo=timezone.utc)
+    now = datetime(2025, 6, 1, 13, 0, tzinfo=JST)
+    cheap = sampler.AdaptiveSampler([("r1", st)], date_str="2025-06-01", budget=40)
+    costly = sampler.AdaptiveSampler([("r2", st)], date_str="2025-06-02", budget=40, checkpoint_cost=6)
+    # 4 チェックポイント × 6 リクエストを確保する分、途中サンプルの間隔がより引き延ばされる
+    assert costly.stretch(now) > cheap.stretch(now)
+    costly.spent = 40 - 4 * 6
+    assert costly.stretch(now) == float("inf")
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta, timezone
+
+import scripts.scheduler as scheduler
+
+JST = timezone(timedelta(hours=9))
+
+
+def _planned(plan):
+    return {(rid, label): planned for b in plan for rid, label, planned in b["items"]}
+
+
+def test_build_plan_tz_aware_start_time_is_jst_wall_clock():
+    # race.start_time は日本時間の壁時計を入れた TIMESTAMP なので UTC 付きで返る
+    plan = scheduler.build_plan([("r1", datetime(2025, 6, 1, 15, 40, tzinfo=timezone.utc))])
+    planned = _planned(plan)
+    assert planned[("r1", "1h_before")] == datetime(2025, 6, 1, 14, 40, tzinfo=JST)
+    assert planned[("r1", "5m_before")] == datetime(2025, 6, 1, 15, 35, tzinfo=JST)
+    assert planned[("r1", "post_race")] == datetime(2025, 6, 1, 15, 50, tzinfo=JST)
+    assert [b["run_at"] for b in plan] == sorted(b["run_at"] for b in plan)
+
+
+def test_build_plan_naive_and_utc_inputs_agree():
+    naive = scheduler.build_plan([("r1", datetime(2025, 6, 1, 15, 40))])
+    aware = scheduler.build_plan([("r1", datetime(2025, 6, 1, 15, 40, tzinfo=timezone.utc))])
+    assert _planned(naive) == _planned(aware)
+
+
+def test_build_plan_buckets_close_snapshots():
+    races = [
+        ("r1", datetime(2025, 6, 1, 15, 40, 0)),
+        ("r2", datetime(2025, 6, 1, 15, 40, 20)),   # 同じ30秒枠
+        ("r3", datetime(2025, 6, 1, 15, 45, 0)),    # 別の枠
+    ]
+    plan = scheduler.build_plan(races, bucket_seconds=30)
+    # 4ラベル × (r1+r2 の枠, r3 の枠)
+    assert len(plan) == 8
+    first = plan[0]
+    assert [rid for rid, _, _ in first["items"]] == ["r1", "r2"]
+    assert first["run_at"] == datetime(2025, 6, 1, 14, 40, tzinfo=JST)
+    assert sum(len(b["items"]) for b in plan) == 12
+
+
+def test_build_plan_bucket_seconds_zero_keeps_one_per_second():
+    races = [("r1", datetime(2025, 6, 1, 15, 40)), ("r2", datetime(2025, 6, 1, 15, 40, 1))]
+    assert len(scheduler.build_plan(races, bucket_seconds=0)) == 8
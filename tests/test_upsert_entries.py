@@ -0,0 +1,80 @@
+from pathlib import Path
+
+import scripts.netkeiba as nk
+import scripts.page_cache as page_cache
+import scripts.upsert_entries as ue
+
+SHUTUBA = (Path(__file__).parent.parent / "benchmarks" / "fixtures" / "shutuba.html").read_bytes()
+URL = nk.SHUTUBA_URL.format(race_id="202505021211")
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.waits = 0
+
+    def wait(self):
+        self.waits += 1
+
+
+class FakeResponse:
+    def __init__(self, content=b"", payload=None):
+        self.content = content
+        self.status_code = 200
+        self.headers = {}
+        self._payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._payload
+
+
+class FakeSession:
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url, timeout=None, headers=None):
+        self.urls.append(url)
+        if "api_get_jra_odds" in url:
+            return FakeResponse(payload={"data": {"odds": {"1": {"01": ["3.5", "", "1"]}}}})
+        return FakeResponse(SHUTUBA)
+
+
+def _setup(monkeypatch, blank_expect_odds):
+    session = FakeSession()
+    monkeypatch.setattr(nk, "SESSION", session)
+    monkeypatch.setattr(page_cache, "get_cache", lambda: None)
+    if blank_expect_odds:
+        parse = nk.parse_horses
+        monkeypatch.setattr(nk, "parse_horses",
+                            lambda soup: [{**h, "expect_odds": None} for h in parse(soup)])
+    return session
+
+
+def test_limiter_charged_per_http_request(monkeypatch):
+    session = _setup(monkeypatch, blank_expect_odds=True)
+    limiter = CountingLimiter()
+    detail = ue.fetch_race({"url": URL, "venue": "東京"}, pool=None, limiter=limiter)
+    # 出馬表＋予想オッズを補うオッズ API の2リクエスト
+    assert len(session.urls) == 2 and limiter.waits == 2
+    assert detail["horses"][0]["expect_odds"] == 3.5
+
+
+def test_limiter_charged_once_when_page_is_complete(monkeypatch):
+    session = _setup(monkeypatch, blank_expect_odds=False)
+    limiter = CountingLimiter()
+    ue.fetch_race({"url": URL, "venue": "東京"}, pool=None, limiter=limiter)
+    assert len(session.urls) == 1 and limiter.waits == 1
+
+
+def test_browser_fallback_is_charged(monkeypatch):
+    _setup(monkeypatch, blank_expect_odds=False)
+    monkeypatch.setattr(nk, "fetch_race_detail_http", lambda url, limiter=None: None)
+    limiter = CountingLimiter()
+
+    class FakePool:
+        def run(self, fn, url):
+            return {"race_id": "202505021211", "start_time": "15:40", "horses": []}
+    detail = ue.fetch_race({"url": URL, "venue": "東京"}, pool=FakePool(), limiter=limiter)
+    assert limiter.waits == 1 and detail["start_time"].endswith("15:40:00")